@@ -0,0 +1,110 @@
+from collections import namedtuple
+import hashlib
+import itertools
+import json
+import os
+
+import numpy as np
+import scipy.sparse
+from sklearn.feature_extraction.text import CountVectorizer
+
+ANALYSIS_CACHE_DIR = "./cache"
+ANALYSIS_CHUNK_SIZE = 256
+
+# vocabulary: dict of {term: term_id}, counts: (documents x terms) CSR matrix of term counts
+Analysis = namedtuple("Analysis", ["vocabulary", "counts"])
+
+
+def corpus_hash(documents):
+    """ Return a hash identifying the content of the collection (and the order of the documents). """
+    digest = hashlib.sha256()
+    for document in documents:
+        encoded = document.encode("utf-8")
+        digest.update(len(encoded).to_bytes(8, "little"))
+        digest.update(encoded)
+    return digest.hexdigest()
+
+
+def corpus_key(documents):
+    """
+    Return a key identifying the collection: Corpus.stamp() for a corpus.Corpus (file metadata only, no file is
+    read), corpus_hash() of the content otherwise.
+    """
+    stamp = getattr(documents, "stamp", None)
+    return stamp() if stamp is not None else corpus_hash(documents)
+
+
+def analyze(documents, cache_dir=None, key=None):
+    """
+    Tokenize and count terms of all documents in a single pass.
+
+    Args:
+        documents: Iterable of document strings, e.g. a list or a corpus.Corpus. Not iterated at all when the result
+                   is cached.
+        cache_dir: If set, the result is stored there under the key of the collection and reused by later calls with
+                   the same collection instead of tokenizing it again.
+        key: Key of the collection in the cache, corpus_key(documents) if None. Pass it when the caller computed it
+             already.
+
+    Returns:
+        Analysis.
+    """
+    if cache_dir is not None:
+        filename = os.path.join(cache_dir, "analysis-{}".format(corpus_key(documents) if key is None else key))
+        if os.path.exists(filename + ".json"):
+            with open(filename + ".json") as f:
+                vocabulary = json.load(f)
+            return Analysis(vocabulary, scipy.sparse.load_npz(filename + ".npz"))
+
+    analysis = count_terms(documents)
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        scipy.sparse.save_npz(filename + ".npz", analysis.counts)
+        with open(filename + ".json", mode="w") as f:  # written last, marks a complete entry
+            json.dump(analysis.vocabulary, f)
+
+    return analysis
+
+
+def count_terms(documents, chunk_size=ANALYSIS_CHUNK_SIZE):
+    """
+    Count terms of the documents like CountVectorizer().fit_transform(), but streaming: documents are consumed in
+    chunks, only term counts of the chunks are kept and the vocabulary grows as new terms appear. Memory does not
+    depend on the length of the documents, only on the size of the result.
+
+    Returns:
+        Analysis, with the vocabulary ordered alphabetically (same term ids as CountVectorizer).
+    """
+    analyzer = CountVectorizer().build_analyzer()
+    vocabulary = {}
+    chunk_counts = []
+
+    documents = iter(documents)
+    while True:
+        chunk = list(itertools.islice(documents, chunk_size))
+        if not chunk:
+            break
+
+        term_ids, doc_offsets = [], [0]
+        for document in chunk:
+            term_ids.extend(vocabulary.setdefault(token, len(vocabulary)) for token in analyzer(document))
+            doc_offsets.append(len(term_ids))
+
+        counts = scipy.sparse.csr_matrix((np.ones(len(term_ids), dtype=np.int32), term_ids, doc_offsets),
+                                         shape=(len(chunk), len(vocabulary)))
+        counts.sum_duplicates()
+        chunk_counts.append(counts)
+
+    # Widen counts of earlier chunks to the final vocabulary and renumber terms alphabetically
+    terms = sorted(vocabulary)
+    new_ids = np.empty(len(terms), dtype=np.int32)
+    new_ids[[vocabulary[term] for term in terms]] = np.arange(len(terms))
+    counts = scipy.sparse.vstack([scipy.sparse.csr_matrix((c.data, new_ids[c.indices], c.indptr),
+                                                          shape=(c.shape[0], len(terms)))
+                                  for c in chunk_counts] or [scipy.sparse.csr_matrix((0, 0), dtype=np.int32)],
+                                 format="csr")
+    counts.sort_indices()
+
+    return Analysis({term: i for i, term in enumerate(terms)}, counts)
+
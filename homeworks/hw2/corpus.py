@@ -0,0 +1,60 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+
+CHUNK_SIZE = 256
+
+
+def read_file(filename):
+    with open(filename) as f:
+        return f.read()
+
+
+class Corpus:
+    """
+    Collection of documents stored one per file, read lazily.
+
+    Iterating over the corpus reads the files in chunks of `chunk_size` documents, so at most one chunk of document
+    texts is held in memory at a time. Files of a chunk can be read by a thread pool. The corpus can be iterated
+    repeatedly, every iteration reads the files again.
+    """
+
+    def __init__(self, filenames, chunk_size=CHUNK_SIZE, threads=None):
+        """
+        Args:
+            filenames: List of document files, in the order of the documents.
+            chunk_size: Number of documents read at once.
+            threads: Number of threads reading files of a chunk, files are read sequentially if None.
+        """
+        self.filenames = filenames
+        self.chunk_size = chunk_size
+        self.threads = threads
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def stamp(self):
+        """
+        Return a hash of paths, sizes and modification times of the files (in the order of the documents). It changes
+        when a file is added, removed, replaced or modified, and is computed without reading the files.
+        """
+        digest = hashlib.sha256()
+        for filename in self.filenames:
+            stat = os.stat(filename)
+            digest.update("{}\0{}\0{}\0".format(os.path.abspath(filename), stat.st_size,
+                                                  stat.st_mtime_ns).encode("utf-8"))
+        return digest.hexdigest()
+
+    def chunks(self):
+        """ Generate lists of document strings, `chunk_size` documents each (the last one may be shorter). """
+        if self.threads:
+            with ThreadPoolExecutor(max_workers=self.threads) as executor:
+                for start in range(0, len(self.filenames), self.chunk_size):
+                    yield list(executor.map(read_file, self.filenames[start:start + self.chunk_size]))
+        else:
+            for start in range(0, len(self.filenames), self.chunk_size):
+                yield [read_file(filename) for filename in self.filenames[start:start + self.chunk_size]]
+
+    def __iter__(self):
+        for chunk in self.chunks():
+            yield from chunk
@@ -0,0 +1,129 @@
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy.sparse
+
+from inverted_index import InvertedIndex, WEIGHTINGS, METRIC_EUCLIDEAN, METRIC_COSINE
+
+METRICS = [METRIC_EUCLIDEAN, METRIC_COSINE]
+
+# Every field is a (queries x cutoffs) matrix, column `j` holds the measure of the first ks[j] retrieved documents
+Evaluation_Result = namedtuple("Evaluation_Result", ["precision", "recall", "fmeasure", "average_precision", "ndcg"])
+
+
+def relevance_matrix(relevant_docs, doc_count):
+    """
+    Build a sparse (queries x documents) relevance matrix.
+
+    Args:
+        relevant_docs: List with a list of relevant document ids (indexed from 1) for every query.
+        doc_count: Number of documents in the collection.
+
+    Returns:
+        scipy.sparse.csr_matrix of booleans, True where the document is relevant to the query.
+    """
+    offsets = np.cumsum([0] + [len(docs) for docs in relevant_docs])
+    docs = np.concatenate([np.asarray(docs, dtype=np.int64) - 1 for docs in relevant_docs] + [np.empty(0, int)])
+    relevance = scipy.sparse.csr_matrix((np.ones(len(docs), dtype=bool), docs, offsets),
+                                        shape=(len(relevant_docs), doc_count))
+    relevance.sum_duplicates()
+    return relevance
+
+
+def evaluate_rankings(rankings, relevance, ks):
+    """
+    Calculate retrieval measures of all queries at all cutoffs at once.
+
+    Args:
+        rankings: (queries x n) matrix of retrieved document ids (indexed from 1), best first, n >= max(ks).
+        relevance: (queries x documents) relevance matrix, see relevance_matrix().
+        ks: Cutoffs (numbers of retrieved documents) to evaluate.
+
+    Returns:
+        Evaluation_Result.
+    """
+    ks = np.asarray(ks)
+    depth = ks.max()
+    rankings = np.asarray(rankings)[:, :depth]
+    rows = np.repeat(np.arange(rankings.shape[0]), rankings.shape[1])
+    hits = np.asarray(relevance[rows, rankings.ravel() - 1]).reshape(rankings.shape).astype(float)
+
+    relevant_counts = np.asarray(relevance.sum(1), dtype=float)  # column vector
+    positions = np.arange(1, depth + 1)
+
+    hits_cumulative = np.cumsum(hits, axis=1)
+    precision = hits_cumulative / positions
+    recall = hits_cumulative / np.maximum(relevant_counts, 1)
+    fmeasure = np.divide(2 * precision * recall, precision + recall,
+                         out=np.zeros_like(precision), where=(precision + recall) > 0)
+
+    # Sum of precisions at the ranks of relevant documents, divided by the number of relevant documents
+    average_precision = np.cumsum(precision * hits, axis=1) / np.maximum(relevant_counts, 1)
+
+    discounts = 1 / np.log2(positions + 1)
+    dcg = np.cumsum(hits * discounts, axis=1)
+    ideal_hits = positions <= relevant_counts  # all relevant documents first
+    idcg = np.cumsum(ideal_hits * discounts, axis=1)
+    ndcg = np.divide(dcg, idcg, out=np.zeros_like(dcg), where=idcg > 0)
+
+    columns = ks - 1
+    return Evaluation_Result(precision=precision[:, columns],
+                             recall=recall[:, columns],
+                             fmeasure=fmeasure[:, columns],
+                             average_precision=average_precision[:, columns],
+                             ndcg=ndcg[:, columns])
+
+
+def _rank_chunk(index_dir, queries, limit):
+    """ Rank a chunk of queries with all weighting schemes and metrics (in a worker process). """
+    index = InvertedIndex.load(index_dir)
+    return {(weighting, metric): index.rank_batch(queries, weighting, metric, limit)
+            for weighting in WEIGHTINGS for metric in METRICS}
+
+
+def evaluate(index_dir, queries, relevance, ks, processes=None, chunk_size=64, cache=None):
+    """
+    Evaluate all weighting schemes and metrics on all queries.
+
+    The query set is split into chunks ranked by a process pool. Workers memory-map the stored index, so it is
+    neither copied nor rebuilt per process. The measures are then computed for all queries at once.
+
+    Args:
+        index_dir: Directory with an index stored by InvertedIndex.save().
+        queries: List of query strings.
+        relevance: (queries x documents) relevance matrix, see relevance_matrix().
+        ks: Cutoffs (numbers of retrieved documents) to evaluate.
+        processes: Number of worker processes, rank in this process if 1.
+        chunk_size: Number of queries handed to a worker at once.
+        cache: query_cache.QueryCache, only queries without cached rankings are ranked, the new rankings are added
+               to the cache.
+
+    Returns:
+        Dict of {(weighting, metric): Evaluation_Result}.
+    """
+    ks = list(ks)
+    limit = max(ks)
+    keys = [(weighting, metric) for weighting in WEIGHTINGS for metric in METRICS]
+    rankings = {key: [None] * len(queries) for key in keys}
+
+    if cache is not None:
+        index = InvertedIndex.load(index_dir)
+        for key in keys:
+            rankings[key] = [cache.get(index, query, *key, limit) for query in queries]
+    missing = [i for i in range(len(queries)) if any(rankings[key][i] is None for key in keys)]
+
+    chunks = [missing[start:start + chunk_size] for start in range(0, len(missing), chunk_size)]
+    arguments = [(index_dir, [queries[i] for i in chunk], limit) for chunk in chunks]
+    if processes == 1 or not chunks:
+        chunk_results = [_rank_chunk(*chunk_arguments) for chunk_arguments in arguments]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            chunk_results = list(executor.map(_rank_chunk, *zip(*arguments)))
+
+    for chunk, result in zip(chunks, chunk_results):
+        for key in keys:
+            for i, ranking in zip(chunk, result[key]):
+                rankings[key][i] = ranking if cache is None else cache.put(index, queries[i], *key, limit, ranking)
+
+    return {key: evaluate_rankings(np.vstack(rankings[key]), relevance, ks) for key in keys}
@@ -1,13 +1,27 @@
-from collections import namedtuple
+import csv
+
 import numpy as np
-import scipy.sparse
-from sklearn.feature_extraction.text import TfidfVectorizer, CountVectorizer
-from sklearn.metrics.pairwise import cosine_similarity, euclidean_distances
+
+from analysis import ANALYSIS_CACHE_DIR, analyze, corpus_key
+from corpus import Corpus, read_file
+from evaluation import Evaluation_Result, METRICS, relevance_matrix, evaluate
+from inverted_index import InvertedIndex, WEIGHTINGS, WEIGHTING_BINARY, WEIGHTING_TF, WEIGHTING_TFIDF, \
+    METRIC_EUCLIDEAN, METRIC_COSINE
+from query_cache import QueryCache, QUERY_CACHE_DIR
+from segmented_index import SegmentedIndex
 
 data = []
+index = None
+segmented_index = None
+query_cache = QueryCache(cache_dir=QUERY_CACHE_DIR)
 RELEVANT_DOCUMENT_COUNT = 150
+INDEX_DIR = "./index"
+CORPUS_READ_THREADS = 4
+
 
-Weighting_Result = namedtuple("Weighting_Result", ["euclidean", "cosine"])
+def get_corpus():
+    """ Return the documents as a corpus.Corpus, read lazily in chunks. """
+    return Corpus(["./data/d/" + str(d + 1) + ".txt" for d in range(1400)], threads=CORPUS_READ_THREADS)
 
 
 def get_data():
@@ -15,14 +29,14 @@ def get_data():
     # return data if data else ['this is a sample string',
     #                           'second string is like the first',
     #                           "the the the xoxoxo"]
-    return data if data else [open("./data/d/" + str(d + 1) + ".txt").read() for d in range(1400)]
+    return data if data else list(get_corpus())
 
 
 def get_queries():
     """ Return list of strings, each string is a query. """
     # return ['the string is a']
     # return [open("./data/q/" + str(q) + ".txt").read() for q in range(1, 10)]
-    return [open("./data/q/" + str(q) + ".txt").read() for q in range(1, 226)]
+    return [read_file("./data/q/" + str(q) + ".txt") for q in range(1, 226)]
 
 
 def get_relevant_docs(query_id):
@@ -35,451 +49,176 @@ def get_relevant_docs(query_id):
     return res
 
 
-def calculate_distances_euclidean(query_vector, data_vectors):
+def get_index():
     """
-    Calculate distances of query_vector from all of data_vectors using Euclidean distance.
-    Return sorted indices based on the distance.
+    Return inverted index of the documents. It is built and stored on disk on the first run, then only loaded, as
+    long as the documents do not change. Whether they changed is told by the sizes and modification times of the
+    document files (see corpus.Corpus.stamp()), so opening a stored index does not read the documents. The analysis
+    of the documents is cached as well, see analysis.analyze().
+    """
+    global index
+    if index is None:
+        documents = data if data else get_corpus()
+        key = corpus_key(documents)
+        if InvertedIndex.is_saved(INDEX_DIR, key):
+            index = InvertedIndex.load(INDEX_DIR)
+        else:
+            index = InvertedIndex.from_analysis(analyze(documents, ANALYSIS_CACHE_DIR, key), corpus_hash=key)
+            index.save(INDEX_DIR)
 
-    Args:
-        query_vector: A single vector of numbers defining the query.
-        data_vectors: List of vectors defining the documents being worked at.
+    return index
 
-    Returns:
-        List of indices into data_vectors, sorted by the distance. Closest first.
-    """
-    distances = np.array(
-        euclidean_distances(query_vector, data_vectors)[0])  # result is [[ data ]], so get idx 0 to have [ data ]
 
-    distances_sorted = distances.argsort() + 1  # argsort will return a sorted list of indices of the original data (+1 because documents are indexed from 1)
-    return distances_sorted
+def get_searched_index():
+    """
+    Return the index searched by calculate_distances_euclidean() and calculate_cosine_similarity(): the stored index,
+    or the segmented index once documents were added or deleted by add_documents() or delete_documents().
+    """
+    return get_index() if segmented_index is None else segmented_index
 
 
-def calculate_cosine_similarity(query_vector, data_vectors):
+def add_documents(documents):
     """
-    Calculate distances of query_vector from all of data_vectors using Cosine similarity metric.
-    Return sorted indices based on the distance.
+    Add documents to the collection without rebuilding the index, they are searched right away. The first change
+    opens a segmented_index.SegmentedIndex with the stored index as its first segment (new documents become new
+    segments, merged in the background). Changes are not stored, the stored index and the evaluation
+    (process_queries(), sweep_cutoffs()) keep the original collection.
 
     Args:
-        query_vector: A single vector of numbers defining the query.
-        data_vectors: List of vectors defining the documents being worked at.
+        documents: List of strings, each string is one document.
 
     Returns:
-        List of indices into data_vectors, sorted by the similarity. Most similar first.
+        Array of ids assigned to the documents (continuing after the stored ones).
     """
-    distances = np.array(
-        cosine_similarity(query_vector, data_vectors)[0])  # result is [[ data ]], so get idx 0 to have [ data ]
-
-    # argsort will return a sorted list of indices of the original data (+1 because documents are indexed from 1)
-    # for cosine similarity, higher is better, so invert the list by [::-1]
-    distances_sorted = distances.argsort()[::-1] + 1
-    return distances_sorted
-
-
-def process_query_binary(query):
-    data = list(get_data())
-    data.append(query)
-
-    vectorizer = CountVectorizer(binary=True)
-    count_array = vectorizer.fit_transform(data)
-
-    # print(vectorizer.get_feature_names())
-    # print(count_array.toarray())
-
-    query_vector = count_array[len(data) - 1]  # last row is the query
-    data_vectors = count_array[0:len(data) - 1]  # anything but last row is data
-    # print("Query vector: {}".format(query_vector.toarray()))
-    # print("Data vectors: {}".format(data_vectors.toarray()))
-
-    euclid_distances = calculate_distances_euclidean(query_vector, data_vectors)
-    cosine_similarities = calculate_cosine_similarity(query_vector, data_vectors)
-    print("Binary Euclid: {}".format(euclid_distances))
-    print("Binary Cosine: {}".format(cosine_similarities))
+    return _segmented_index().add_documents(documents)
 
-    return Weighting_Result(euclidean=euclid_distances, cosine=cosine_similarities)
 
+def delete_documents(doc_ids):
+    """ Remove documents (ids indexed from 1) from the searched collection, see add_documents(). """
+    _segmented_index().delete_documents(doc_ids)
 
-def process_query_term_frequency(query):
-    data = list(get_data())
-    data.append(query)
 
-    vectorizer = CountVectorizer()
-    count_array = vectorizer.fit_transform(data)
+def _segmented_index():
+    global segmented_index
+    if segmented_index is None:
+        segmented_index = SegmentedIndex.from_index(get_index(), merge_in_background=True)
 
-    sums = count_array.sum(1)  # Sum over rows (arg 1), produce a vector.
-    normalized_array = count_array.multiply(1 / sums)  # Normalize all rows - divide each row by its sum.
+    return segmented_index
 
-    # Convert to csr_matrix (multiplication kept returning other type and that threw errors ¯\_(ツ)_/¯
-    normalized_array = scipy.sparse.csr_matrix(normalized_array)
 
-    # print(np.array2string(normalized_array.toarray(), max_line_width=800))
-
-    query_vector = normalized_array[len(data) - 1]  # last row is the query
-    data_vectors = normalized_array[0:len(data) - 1]  # anything but last row is data
-
-    # print("Query vector: {}".format(query_vector.toarray()))
-    # print("Data vectors: {}".format(data_vectors.toarray()))
-
-    euclid_distances = calculate_distances_euclidean(query_vector, data_vectors)
-    cosine_similarities = calculate_cosine_similarity(query_vector, data_vectors)
-    print("TF Euclid: {}".format(euclid_distances))
-    print("TF Cosine: {}".format(cosine_similarities))
-
-    return Weighting_Result(euclidean=euclid_distances, cosine=cosine_similarities)
+def calculate_distances_euclidean(query, weighting, limit=None):
+    """
+    Calculate distances of the query from all documents using Euclidean distance.
+    Return sorted indices based on the distance.
 
+    Args:
+        query: Query string.
+        weighting: Weighting scheme of the vectors, one of WEIGHTING_*.
+        limit: Number of closest documents to return, all documents if None.
 
-def process_query_tfidf(query):
-    data = list(get_data())
-    data.append(query)
+    Returns:
+        List of document ids (indexed from 1), sorted by the distance. Closest first.
+    """
+    return query_cache.rank(get_searched_index(), query, weighting, METRIC_EUCLIDEAN, limit)
 
-    tfidf_vectorizer = TfidfVectorizer()
 
-    # prepare matrix
-    tfidf_matrix = tfidf_vectorizer.fit_transform(data)
+def calculate_cosine_similarity(query, weighting, limit=None):
+    """
+    Calculate similarities of the query to all documents using Cosine similarity metric.
+    Return sorted indices based on the similarity.
 
-    # compute similarity between query and all docs (tf-idf) and get top 10 relevant
-    query_vector = tfidf_matrix[len(data) - 1]  # last row is the query
-    data_vectors = tfidf_matrix[0:len(data) - 1]  # anything but last row is data
-    # print("Query vector: {}".format(query_vector.toarray()))
-    # print("Data vectors: {}".format(data_vectors.toarray()))
+    Args:
+        query: Query string.
+        weighting: Weighting scheme of the vectors, one of WEIGHTING_*.
+        limit: Number of most similar documents to return, all documents if None. With a limit, only documents
+               that can still get among the best ones are fully scored (MaxScore pruning).
 
-    euclid_distances = calculate_distances_euclidean(query_vector, data_vectors)
-    cosine_similarities = calculate_cosine_similarity(query_vector, data_vectors)
-    print("TF-IDF Euclid: {}".format(euclid_distances))
-    print("TF-IDF Cosine: {}".format(cosine_similarities))
+    Returns:
+        List of document ids (indexed from 1), sorted by the similarity. Most similar first.
+    """
+    return query_cache.rank(get_searched_index(), query, weighting, METRIC_COSINE, limit)
 
-    return Weighting_Result(euclidean=euclid_distances, cosine=cosine_similarities)
 
+WEIGHTING_LABELS = {WEIGHTING_BINARY: ("Binary", "Binary"),
+                    WEIGHTING_TF: ("TF", "Term frequency"),
+                    WEIGHTING_TFIDF: ("TF-IDF", "TF-IDF")}  # (CSV label, report label)
+MEASURE_LABELS = [("precision", "precision", "Precision"),
+                  ("recall", "recall", "Recall"),
+                  ("fmeasure", "F-measure", "F-Measure")]  # (Evaluation_Result field, CSV label, report label)
 
-def calculate_precision(retrieved_documents, relevant_documents):
-    relevant_count = 0
-    for doc in retrieved_documents:
-        if doc in relevant_documents:
-            relevant_count += 1
 
-    return relevant_count / len(retrieved_documents)
+def format_report(title, values):
+    """ Format measures of one row of the results table (ordered as its columns) as a readable report. """
+    lines = [title, "-" * 37]
+    values = iter(values)
+    for weighting in WEIGHTINGS:
+        lines.append(WEIGHTING_LABELS[weighting][1])
+        for _, _, measure_label in MEASURE_LABELS:
+            lines.append("    - {}:".format(measure_label))
+            for metric in METRICS:
+                lines.append("        - {}: {}".format(metric.capitalize(), next(values)))
+        lines.append("")
 
+    return "\n".join(lines)
 
-def calculate_recall(retrieved_documents, relevant_documents):
-    relevant_count = 0
-    for doc in retrieved_documents:
-        if doc in relevant_documents:
-            relevant_count += 1
 
-    return relevant_count / len(relevant_documents)
+def process_queries():
+    process_docs_count = 15
 
+    queries = get_queries()
+    relevance = relevance_matrix([get_relevant_docs(i) for i in range(1, len(queries) + 1)], get_index().doc_count)
+    results = evaluate(INDEX_DIR, queries, relevance, [process_docs_count], cache=query_cache)
+    query_cache.save()
 
-def calculate_fmeasure(precision, recall):
-    if precision == 0 and recall == 0:
-        return 0
+    # One column per weighting scheme x measure x metric, one row per query
+    columns = [(weighting, measure, metric) for weighting in WEIGHTINGS for measure in MEASURE_LABELS
+               for metric in METRICS]
+    table = np.column_stack([getattr(results[(weighting, metric)], measure[0])[:, 0]
+                             for weighting, measure, metric in columns])
 
-    return 2 * (precision * recall) / (precision + recall)
+    with open('output_data.csv', mode='w') as f, open('output_data_comma.csv', mode='w') as f_comma:
+        writer = csv.writer(f, delimiter=';')
+        writer_comma = csv.writer(f_comma, delimiter=',')
 
+        csv_row = ['Query #'] + ["{} {} - {}".format(WEIGHTING_LABELS[weighting][0], metric, measure[1])
+                                 for weighting, measure, metric in columns]
+        writer.writerow(csv_row)
+        writer_comma.writerow(csv_row)
 
-Query_Results = namedtuple("Query_Results", ["binary_precision",
-                                             "binary_recall",
-                                             "tf_precision",
-                                             "tf_recall",
-                                             "tfidf_precision",
-                                             "tfidf_recall",
-                                             ])
+        for i, row in enumerate(table, 1):
+            writer.writerow([i] + row.tolist())
+            writer_comma.writerow([i] + row.tolist())
+            print(format_report("Query #{}".format(i), row))
 
+        averages = table.mean(0)
+        writer.writerow(["AVERAGE"] + averages.tolist())
+        writer_comma.writerow(["AVERAGE"] + averages.tolist())
+        print(format_report("AVERAGE", averages))
 
-def process_queries():
-    euclidean_results = []
-    cosine_results = []
 
+def sweep_cutoffs():
+    """
+    Evaluate all weighting schemes and metrics at every number of retrieved documents up to RELEVANT_DOCUMENT_COUNT.
+    Average measures are written to output_sweep.csv.
+    """
     queries = get_queries()
-    for i, query in enumerate(queries, 1):
-        binary_result = process_query_binary(query)
-        tf_result = process_query_term_frequency(query)
-        tfidf_result = process_query_tfidf(query)
-
-        relevant_docs = get_relevant_docs(i)
-
-        print("Got:      {}".format(binary_result))
-        print("Expected: {}".format(relevant_docs))
-
-        process_docs_count = 15
-
-        euclidean_results.append(Query_Results(
-            binary_precision=calculate_precision(binary_result.euclidean[:process_docs_count], relevant_docs),
-            binary_recall=calculate_recall(binary_result.euclidean[:process_docs_count], relevant_docs),
-            tf_precision=calculate_precision(tf_result.euclidean[:process_docs_count], relevant_docs),
-            tf_recall=calculate_recall(tf_result.euclidean[:process_docs_count], relevant_docs),
-            tfidf_precision=calculate_precision(tfidf_result.euclidean[:process_docs_count], relevant_docs),
-            tfidf_recall=calculate_recall(tfidf_result.euclidean[:process_docs_count], relevant_docs)
-        ))
-
-        cosine_results.append(Query_Results(
-            binary_precision=calculate_precision(binary_result.cosine[:process_docs_count], relevant_docs),
-            binary_recall=calculate_recall(binary_result.cosine[:process_docs_count], relevant_docs),
-            tf_precision=calculate_precision(tf_result.cosine[:process_docs_count], relevant_docs),
-            tf_recall=calculate_recall(tf_result.cosine[:process_docs_count], relevant_docs),
-            tfidf_precision=calculate_precision(tfidf_result.cosine[:process_docs_count], relevant_docs),
-            tfidf_recall=calculate_recall(tfidf_result.cosine[:process_docs_count], relevant_docs)
-        ))
-
-    binary_euclidean_precision_sum = 0
-    binary_cosine_precision_sum = 0
-    binary_euclidean_recall_sum = 0
-    binary_cosine_recall_sum = 0
-    binary_euclidean_fmeasure_sum = 0
-    binary_cosine_fmeasure_sum = 0
-
-    tf_euclidean_precision_sum = 0
-    tf_cosine_precision_sum = 0
-    tf_euclidean_recall_sum = 0
-    tf_cosine_recall_sum = 0
-    tf_euclidean_fmeasure_sum = 0
-    tf_cosine_fmeasure_sum = 0
-
-    tfidf_euclidean_precision_sum = 0
-    tfidf_cosine_precision_sum = 0
-    tfidf_euclidean_recall_sum = 0
-    tfidf_cosine_recall_sum = 0
-    tfidf_euclidean_fmeasure_sum = 0
-    tfidf_cosine_fmeasure_sum = 0
-
-    import csv
-    with open('output_data.csv', mode='w') as f:
-        with open('output_data_comma.csv', mode='w') as f_comma:
-            writer = csv.writer(f, delimiter=';')
-            writer_comma = csv.writer(f_comma, delimiter=',')
-
-            csv_row = ['Query #',
-                       'Binary euclidean - precision',
-                       'Binary cosine - precision',
-                       'Binary euclidean - recall',
-                       'Binary cosine - recall',
-                       'Binary euclidean - F-measure',
-                       'Binary cosine - F-measure',
-                       'TF euclidean - precision',
-                       'TF cosine - precision',
-                       'TF euclidean - recall',
-                       'TF cosine - recall',
-                       'TF euclidean - F-measure',
-                       'TF cosine - F-measure',
-                       'TF-IDF euclidean - precision',
-                       'TF-IDF cosine - precision',
-                       'TF-IDF euclidean - recall',
-                       'TF-IDF cosine - recall',
-                       'TF-IDF euclidean - F-measure',
-                       'TF-IDF cosine - F-measure',
-                       ]
-            writer.writerow(csv_row)
-            writer_comma.writerow(csv_row)
-
-            for i, query in enumerate(queries, 1):
-                binary_euclidean_precision = euclidean_results[i - 1].binary_precision
-                binary_cosine_precision = cosine_results[i - 1].binary_precision
-                binary_euclidean_recall = euclidean_results[i - 1].binary_recall
-                binary_cosine_recall = cosine_results[i - 1].binary_recall
-                binary_euclidean_fmeasure = calculate_fmeasure(binary_euclidean_precision, binary_euclidean_recall)
-                binary_cosine_fmeasure = calculate_fmeasure(binary_cosine_precision, binary_cosine_recall)
-
-                tf_euclidean_precision = euclidean_results[i - 1].tf_precision
-                tf_cosine_precision = cosine_results[i - 1].tf_precision
-                tf_euclidean_recall = euclidean_results[i - 1].tf_recall
-                tf_cosine_recall = cosine_results[i - 1].tf_recall
-                tf_euclidean_fmeasure = calculate_fmeasure(tf_euclidean_precision, tf_euclidean_recall)
-                tf_cosine_fmeasure = calculate_fmeasure(tf_cosine_precision, tf_cosine_recall)
-
-                tfidf_euclidean_precision = euclidean_results[i - 1].tfidf_precision
-                tfidf_cosine_precision = cosine_results[i - 1].tfidf_precision
-                tfidf_euclidean_recall = euclidean_results[i - 1].tfidf_recall
-                tfidf_cosine_recall = cosine_results[i - 1].tfidf_recall
-                tfidf_euclidean_fmeasure = calculate_fmeasure(tfidf_euclidean_precision, tfidf_euclidean_recall)
-                tfidf_cosine_fmeasure = calculate_fmeasure(tfidf_cosine_precision, tfidf_cosine_recall)
-
-                # Update sums for later average
-                binary_euclidean_precision_sum += binary_euclidean_precision
-                binary_cosine_precision_sum += binary_cosine_precision
-                binary_euclidean_recall_sum += binary_euclidean_recall
-                binary_cosine_recall_sum += binary_cosine_recall
-                binary_euclidean_fmeasure_sum += binary_euclidean_fmeasure
-                binary_cosine_fmeasure_sum += binary_cosine_fmeasure
-
-                tf_euclidean_precision_sum += tf_euclidean_precision
-                tf_cosine_precision_sum += tf_cosine_precision
-                tf_euclidean_recall_sum += tf_euclidean_recall
-                tf_cosine_recall_sum += tf_cosine_recall
-                tf_euclidean_fmeasure_sum += tf_euclidean_fmeasure
-                tf_cosine_fmeasure_sum += tf_cosine_fmeasure
-
-                tfidf_euclidean_precision_sum += tfidf_euclidean_precision
-                tfidf_cosine_precision_sum += tfidf_cosine_precision
-                tfidf_euclidean_recall_sum += tfidf_euclidean_recall
-                tfidf_cosine_recall_sum += tfidf_cosine_recall
-                tfidf_euclidean_fmeasure_sum += tfidf_euclidean_fmeasure
-                tfidf_cosine_fmeasure_sum += tfidf_cosine_fmeasure
-
-                csv_row = [
-                    i,
-                    binary_euclidean_precision,
-                    binary_cosine_precision,
-                    binary_euclidean_recall,
-                    binary_cosine_recall,
-                    binary_euclidean_fmeasure,
-                    binary_cosine_fmeasure,
-                    tf_euclidean_precision,
-                    tf_cosine_precision,
-                    tf_euclidean_recall,
-                    tf_cosine_recall,
-                    tf_euclidean_fmeasure,
-                    tf_cosine_fmeasure,
-                    tfidf_euclidean_precision,
-                    tfidf_cosine_precision,
-                    tfidf_euclidean_recall,
-                    tfidf_cosine_recall,
-                    tfidf_euclidean_fmeasure,
-                    tfidf_cosine_fmeasure,
-                ]
-                writer.writerow(csv_row)
-                writer_comma.writerow(csv_row)
-
-                print(
-                    """
-                    Query #{query_num}
-                    -------------------------------------
-                    Binary
-                        - Precision:
-                            - Euclidean: {binary_euclidean_precision}
-                            - Cosine: {binary_cosine_precision}
-                        - Recall:
-                            - Euclidean: {binary_euclidean_recall}
-                            - Cosine: {binary_cosine_recall}
-                        - F-Measure:
-                            - Euclidean: {binary_euclidean_fmeasure}
-                            - Cosine: {binary_cosine_fmeasure}
-
-                    Term frequency
-                        - Precision:
-                            - Euclidean: {tf_euclidean_precision}
-                            - Cosine: {tf_cosine_precision}
-                        - Recall:
-                            - Euclidean: {tf_euclidean_recall}
-                            - Cosine: {tf_cosine_recall}
-                        - F-Measure:
-                            - Euclidean: {tf_euclidean_fmeasure}
-                            - Cosine: {tf_cosine_fmeasure}
-
-                    TF-IDF
-                        - Precision:
-                            - Euclidean: {tfidf_euclidean_precision}
-                            - Cosine: {tfidf_cosine_precision}
-                        - Recall:
-                            - Euclidean: {tfidf_euclidean_recall}
-                            - Cosine: {tfidf_cosine_recall}
-                        - F-Measure:
-                            - Euclidean: {tfidf_euclidean_fmeasure}
-                            - Cosine: {tfidf_cosine_fmeasure}
-                    """.format(
-                        query_num=i,
-                        binary_euclidean_precision=binary_euclidean_precision,
-                        binary_cosine_precision=binary_cosine_precision,
-                        binary_euclidean_recall=binary_euclidean_recall,
-                        binary_cosine_recall=binary_cosine_recall,
-                        binary_euclidean_fmeasure=binary_euclidean_fmeasure,
-                        binary_cosine_fmeasure=binary_cosine_fmeasure,
-                        tf_euclidean_precision=tf_euclidean_precision,
-                        tf_cosine_precision=tf_cosine_precision,
-                        tf_euclidean_recall=tf_euclidean_recall,
-                        tf_cosine_recall=tf_cosine_recall,
-                        tf_euclidean_fmeasure=tf_euclidean_fmeasure,
-                        tf_cosine_fmeasure=tf_cosine_fmeasure,
-                        tfidf_euclidean_precision=tfidf_euclidean_precision,
-                        tfidf_cosine_precision=tfidf_cosine_precision,
-                        tfidf_euclidean_recall=tfidf_euclidean_recall,
-                        tfidf_cosine_recall=tfidf_cosine_recall,
-                        tfidf_euclidean_fmeasure=tfidf_euclidean_fmeasure,
-                        tfidf_cosine_fmeasure=tfidf_cosine_fmeasure,
-
-                    )
-                )
-
-            print(
-                """
-                -------------------------------------
-                AVERAGE
-                -------------------------------------
-                    Binary
-                        - Precision:
-                            - Euclidean: {binary_euclidean_precision}
-                            - Cosine: {binary_cosine_precision}
-                        - Recall:
-                            - Euclidean: {binary_euclidean_recall}
-                            - Cosine: {binary_cosine_recall}
-                        - F-Measure:
-                            - Euclidean: {binary_euclidean_fmeasure}
-                            - Cosine: {binary_cosine_fmeasure}
-
-                    Term frequency
-                        - Precision:
-                            - Euclidean: {tf_euclidean_precision}
-                            - Cosine: {tf_cosine_precision}
-                        - Recall:
-                            - Euclidean: {tf_euclidean_recall}
-                            - Cosine: {tf_cosine_recall}
-                        - F-Measure:
-                            - Euclidean: {tf_euclidean_fmeasure}
-                            - Cosine: {tf_cosine_fmeasure}
-
-                    TF-IDF
-                        - Precision:
-                            - Euclidean: {tfidf_euclidean_precision}
-                            - Cosine: {tfidf_cosine_precision}
-                        - Recall:
-                            - Euclidean: {tfidf_euclidean_recall}
-                            - Cosine: {tfidf_cosine_recall}
-                        - F-Measure:
-                            - Euclidean: {tfidf_euclidean_fmeasure}
-                            - Cosine: {tfidf_cosine_fmeasure}
-                """.format(
-                    binary_euclidean_precision=binary_euclidean_precision_sum / len(queries),
-                    binary_cosine_precision=binary_cosine_precision_sum / len(queries),
-                    binary_euclidean_recall=binary_euclidean_recall_sum / len(queries),
-                    binary_cosine_recall=binary_cosine_recall_sum / len(queries),
-                    binary_euclidean_fmeasure=binary_euclidean_fmeasure_sum / len(queries),
-                    binary_cosine_fmeasure=binary_cosine_fmeasure_sum / len(queries),
-                    tf_euclidean_precision=tf_euclidean_precision_sum / len(queries),
-                    tf_cosine_precision=tf_cosine_precision_sum / len(queries),
-                    tf_euclidean_recall=tf_euclidean_recall_sum / len(queries),
-                    tf_cosine_recall=tf_cosine_recall_sum / len(queries),
-                    tf_euclidean_fmeasure=tf_euclidean_fmeasure_sum / len(queries),
-                    tf_cosine_fmeasure=tf_cosine_fmeasure_sum / len(queries),
-                    tfidf_euclidean_precision=tfidf_euclidean_precision_sum / len(queries),
-                    tfidf_cosine_precision=tfidf_cosine_precision_sum / len(queries),
-                    tfidf_euclidean_recall=tfidf_euclidean_recall_sum / len(queries),
-                    tfidf_cosine_recall=tfidf_cosine_recall_sum / len(queries),
-                    tfidf_euclidean_fmeasure=tfidf_euclidean_fmeasure_sum / len(queries),
-                    tfidf_cosine_fmeasure=tfidf_cosine_fmeasure_sum / len(queries),
-
-                )
-            )
-
-            csv_row = [
-                "AVERAGE",
-                binary_euclidean_precision_sum / len(queries),
-                binary_cosine_precision_sum / len(queries),
-                binary_euclidean_recall_sum / len(queries),
-                binary_cosine_recall_sum / len(queries),
-                binary_euclidean_fmeasure_sum / len(queries),
-                binary_cosine_fmeasure_sum / len(queries),
-                tf_euclidean_precision_sum / len(queries),
-                tf_cosine_precision_sum / len(queries),
-                tf_euclidean_recall_sum / len(queries),
-                tf_cosine_recall_sum / len(queries),
-                tf_euclidean_fmeasure_sum / len(queries),
-                tf_cosine_fmeasure_sum / len(queries),
-                tfidf_euclidean_precision_sum / len(queries),
-                tfidf_cosine_precision_sum / len(queries),
-                tfidf_euclidean_recall_sum / len(queries),
-                tfidf_cosine_recall_sum / len(queries),
-                tfidf_euclidean_fmeasure_sum / len(queries),
-                tfidf_cosine_fmeasure_sum / len(queries),
-                ]
-            writer.writerow(csv_row)
-            writer_comma.writerow(csv_row)
-
-
-process_queries()
+    relevance = relevance_matrix([get_relevant_docs(i) for i in range(1, len(queries) + 1)], get_index().doc_count)
+    ks = list(range(1, RELEVANT_DOCUMENT_COUNT + 1))
+    results = evaluate(INDEX_DIR, queries, relevance, ks, cache=query_cache)
+    query_cache.save()
+
+    with open('output_sweep.csv', mode='w') as f:
+        writer = csv.writer(f, delimiter=',')
+        writer.writerow(['Weighting', 'Metric', 'k', 'Precision', 'Recall', 'F-measure', 'MAP', 'nDCG'])
+        for (weighting, metric), result in results.items():
+            averages = [getattr(result, field).mean(0) for field in Evaluation_Result._fields]
+            for j, k in enumerate(ks):
+                writer.writerow([WEIGHTING_LABELS[weighting][0], metric, k] + [average[j] for average in averages])
+
+            print("{} {}: MAP@{} = {}, nDCG@{} = {}".format(WEIGHTING_LABELS[weighting][0], metric,
+                                                          ks[-1], averages[3][-1], ks[-1], averages[4][-1]))
+
+
+if __name__ == '__main__':
+    process_queries()
+    # sweep_cutoffs()
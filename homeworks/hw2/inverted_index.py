@@ -0,0 +1,489 @@
+import json
+import os
+
+import numpy as np
+import scipy.sparse
+from sklearn.feature_extraction.text import CountVectorizer
+
+from analysis import analyze
+from postings import PostingLists, CompressedPostingLists, Skip_Blocks, lookup
+
+WEIGHTING_BINARY = "binary"
+WEIGHTING_TF = "tf"
+WEIGHTING_TFIDF = "tfidf"
+WEIGHTINGS = [WEIGHTING_BINARY, WEIGHTING_TF, WEIGHTING_TFIDF]
+
+METRIC_EUCLIDEAN = "euclidean"
+METRIC_COSINE = "cosine"
+
+FORMAT_VERSION = 4
+META_FILE = "meta.json"
+VOCABULARY_FILE = "vocabulary.json"
+DOCS_DATA_FILE = "postings_docs.bin"
+TF_DATA_FILE = "postings_tf.bin"
+
+# Scores are compared rounded to this many decimals, so that documents with the same score computed in a different
+# order of operations (by rank() or rank_batch()) are ties, resolved by the document index
+SCORE_DECIMALS = 12
+# Documents are pruned by rank() only if their score bound is lower than the k-th best score by more than this, so that
+# documents tied with it after rounding are kept
+PRUNING_MARGIN = 2 * 10 ** -SCORE_DECIMALS
+
+
+def weight_query(tokens, vocabulary, weighting, idf):
+    """
+    Build the query vector from its tokens. Terms not present in the vocabulary are dropped (they can not match any
+    document).
+
+    Args:
+        tokens: Tokens of the query.
+        vocabulary: Dict of {term: term_id}.
+        weighting: One of WEIGHTING_*.
+        idf: Idf of all terms of the vocabulary, only used by WEIGHTING_TFIDF.
+
+    Returns:
+        Tuple (term ids, weights of the terms in the query).
+    """
+    term_ids, tf = np.unique(np.array([vocabulary[token] for token in tokens if token in vocabulary], dtype=np.int64),
+                             return_counts=True)
+
+    if weighting == WEIGHTING_BINARY:
+        return term_ids, np.ones(len(term_ids))
+    elif weighting == WEIGHTING_TF:
+        return term_ids, tf / len(tokens)
+    elif weighting == WEIGHTING_TFIDF:
+        weights = tf * idf[term_ids]
+        return term_ids, weights / max(np.linalg.norm(weights), 1e-12)
+    else:
+        raise ValueError(f"Unknown weighting scheme: {weighting}")
+
+
+class InvertedIndex:
+    """
+    Inverted index over the document collection.
+
+    The collection is tokenized and counted once, the result is kept as term -> postings lists (document indices and
+    term frequencies, sorted by document) together with per-document lengths and norms of every weighting scheme.
+    Queries are only transformed with the frozen vocabulary and scored by traversing postings of their terms, so the
+    work per query depends on the length of its posting lists, not on the size of the collection. Top-k queries by
+    cosine similarity are pruned further with per-term score bounds, see top_k_dot_products().
+
+    On disk the postings are compressed (see CompressedPostingLists) and all arrays, including the precomputed norms
+    and term score bounds, are memory-mapped on load, so opening an index does not read or decode the collection.
+
+    Weighting schemes produce the same vectors as the vectorizers used before:
+        - binary: CountVectorizer(binary=True)
+        - tf: CountVectorizer() with every row divided by its sum
+        - tfidf: TfidfVectorizer() (smoothed idf, rows normalized to unit length)
+    """
+
+    def __init__(self, vocabulary, postings, doc_lengths, statistics=None):
+        """
+        Args:
+            vocabulary: Dict of {term: term_id}.
+            postings: PostingLists or CompressedPostingLists of all terms.
+            doc_lengths: Number of tokens of every document.
+            statistics: Precomputed document norms and term score bounds (as stored by save()), computed from the
+                        postings if None.
+        """
+        self.vocabulary = vocabulary
+        self.corpus_hash = None
+        self.postings_lists = postings
+        self.postings_offsets = postings.offsets
+        self.doc_lengths = doc_lengths
+        self.doc_count = len(doc_lengths)
+
+        self.analyzer = CountVectorizer().build_analyzer()
+
+        self.doc_freq = np.diff(self.postings_offsets)
+        self.idf = np.log((1 + self.doc_count) / (1 + self.doc_freq)) + 1
+
+        self._document_matrices = {}
+        self._max_term_scores = {}
+
+        if statistics is None:
+            docs, tf = postings.read_all()
+            # Length of the tf-idf vector before normalization, every posting is divided by it
+            self.tfidf_lengths = self._doc_norms(docs, tf * np.repeat(self.idf, self.doc_freq))
+            self.norms = {
+                WEIGHTING_BINARY: self._doc_norms(docs, np.ones(len(docs))),
+                WEIGHTING_TF: self._doc_norms(docs, tf) / np.maximum(self.doc_lengths, 1),
+                WEIGHTING_TFIDF: (self.tfidf_lengths > 0).astype(float),
+            }
+            # Documents ordered by their norm, used to rank documents that share no term with the query by distance
+            self.docs_by_norm = {weighting: np.argsort(norms, kind="stable") for weighting, norms in self.norms.items()}
+        else:
+            self.tfidf_lengths = statistics["tfidf_lengths"]
+            self.norms = {weighting: statistics[f"norms_{weighting}"] for weighting in WEIGHTINGS}
+            self.docs_by_norm = {weighting: statistics[f"docs_by_norm_{weighting}"] for weighting in WEIGHTINGS}
+            self._max_term_scores = {weighting: statistics[f"max_term_scores_{weighting}"] for weighting in WEIGHTINGS}
+
+    @classmethod
+    def build(cls, documents):
+        """ Tokenize and count all documents once and build the index from them. """
+        return cls.from_analysis(analyze(documents))
+
+    @classmethod
+    def from_analysis(cls, analysis, corpus_hash=None):
+        """
+        Build the index from term counts of the collection.
+
+        Args:
+            analysis: Analysis of the collection, see analysis.analyze().
+            corpus_hash: Key identifying the collection (see analysis.corpus_key()), stored with the index to tell if it
+                         is up to date.
+        """
+        counts = analysis.counts.tocsc()
+        counts.sort_indices()
+
+        index = cls(
+            vocabulary=analysis.vocabulary,
+            postings=PostingLists(counts.indptr.astype(np.int64),
+                                  counts.indices.astype(np.int32),
+                                  counts.data.astype(np.int32)),
+            doc_lengths=np.asarray(counts.sum(1)).ravel().astype(np.int64),
+        )
+        index.corpus_hash = corpus_hash
+        return index
+
+    def save(self, directory):
+        """
+        Store the index to the directory: compressed postings as raw bytes, other arrays as .npy files (both can be
+        memory-mapped by load()) and the vocabulary as JSON.
+        """
+        os.makedirs(directory, exist_ok=True)
+
+        postings = self.postings_lists
+        if not isinstance(postings, CompressedPostingLists):
+            postings = CompressedPostingLists.compress(postings)
+        np.asarray(postings.docs_data, dtype=np.uint8).tofile(os.path.join(directory, DOCS_DATA_FILE))
+        np.asarray(postings.tf_data, dtype=np.uint8).tofile(os.path.join(directory, TF_DATA_FILE))
+
+        arrays = {
+            "postings_offsets": postings.offsets,
+            "docs_byte_offsets": postings.docs_byte_offsets,
+            "tf_byte_offsets": postings.tf_byte_offsets,
+            "doc_lengths": self.doc_lengths,
+            "tfidf_lengths": self.tfidf_lengths,
+        }
+        for field in Skip_Blocks._fields:
+            arrays[f"blocks_{field}"] = getattr(postings.blocks, field)
+        for weighting in WEIGHTINGS:
+            arrays[f"norms_{weighting}"] = self.norms[weighting]
+            arrays[f"docs_by_norm_{weighting}"] = self.docs_by_norm[weighting]
+            arrays[f"max_term_scores_{weighting}"] = self.max_term_scores(weighting)
+        for name, array in arrays.items():
+            np.save(os.path.join(directory, name + ".npy"), array)
+
+        with open(os.path.join(directory, VOCABULARY_FILE), mode="w") as f:
+            json.dump(self.vocabulary, f)
+        with open(os.path.join(directory, META_FILE), mode="w") as f:
+            json.dump({"version": FORMAT_VERSION, "corpus_hash": self.corpus_hash, "arrays": list(arrays)}, f)
+
+    @staticmethod
+    def is_saved(directory, corpus_hash=None):
+        """ Return True if the directory contains an index in the current format (and of the given collection). """
+        try:
+            with open(os.path.join(directory, META_FILE)) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        return meta.get("version") == FORMAT_VERSION and (corpus_hash is None or meta.get("corpus_hash") == corpus_hash)
+
+    @classmethod
+    def load(cls, directory):
+        """ Open an index stored by save(). All arrays are memory-mapped, nothing is decoded up front. """
+        with open(os.path.join(directory, META_FILE)) as f:
+            meta = json.load(f)
+        if meta["version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported index format version: {meta['version']}")
+
+        with open(os.path.join(directory, VOCABULARY_FILE)) as f:
+            vocabulary = json.load(f)
+
+        arrays = {name: np.load(os.path.join(directory, name + ".npy"), mmap_mode="r") for name in meta["arrays"]}
+        postings = CompressedPostingLists(arrays["postings_offsets"],
+                                          cls._map_bytes(os.path.join(directory, DOCS_DATA_FILE)),
+                                          arrays["docs_byte_offsets"],
+                                          cls._map_bytes(os.path.join(directory, TF_DATA_FILE)),
+                                          arrays["tf_byte_offsets"],
+                                          Skip_Blocks(*(arrays[f"blocks_{field}"] for field in Skip_Blocks._fields)))
+
+        index = cls(vocabulary, postings, arrays["doc_lengths"], statistics=arrays)
+        index.corpus_hash = meta.get("corpus_hash")
+        return index
+
+    @property
+    def version(self):
+        """ Identifies the indexed collection, the index itself never changes. """
+        return self.corpus_hash
+
+    @staticmethod
+    def _map_bytes(filename):
+        # numpy can not memory-map an empty file
+        if os.path.getsize(filename) == 0:
+            return np.empty(0, dtype=np.uint8)
+        return np.memmap(filename, dtype=np.uint8, mode="r")
+
+    def _doc_norms(self, docs, posting_values):
+        """ Return L2 norm of every document given one value per posting. """
+        return np.sqrt(np.bincount(docs, weights=posting_values ** 2, minlength=self.doc_count))
+
+    def _posting_weights(self, weighting):
+        """ Return tuple (document indices, weights) of all postings in the given weighting scheme. """
+        docs, tf = self.postings_lists.read_all()
+
+        if weighting == WEIGHTING_BINARY:
+            return docs, np.ones(len(docs))
+        elif weighting == WEIGHTING_TF:
+            return docs, tf / self.doc_lengths[docs]
+        elif weighting == WEIGHTING_TFIDF:
+            return docs, tf * np.repeat(self.idf, self.doc_freq) / self.tfidf_lengths[docs]
+        else:
+            raise ValueError(f"Unknown weighting scheme: {weighting}")
+
+    def max_term_scores(self, weighting):
+        """
+        Return the highest cosine contribution every term can give to any document, i.e. max of (weight / document
+        norm) over its postings. Used as the upper bounds for dynamic pruning.
+        """
+        if weighting not in self._max_term_scores:
+            docs, weights = self._posting_weights(weighting)
+            scores = weights / np.maximum(self.norms[weighting][docs], 1e-12)
+            scores = np.maximum.reduceat(np.append(scores, 0), self.postings_offsets[:-1])
+            self._max_term_scores[weighting] = np.where(self.doc_freq > 0, scores, 0)
+
+        return self._max_term_scores[weighting]
+
+    def postings(self, term_id, weighting):
+        """
+        Return postings of a term weighted by the given scheme.
+
+        Returns:
+            Tuple (document indices, weights of the term in those documents).
+        """
+        docs, tf = self.postings_lists.read(term_id)
+        return docs, self._term_weights(term_id, docs, tf, weighting)
+
+    def probe(self, term_id, docs, weighting):
+        """ Return weights of a term in the sorted documents (0 if a document does not contain it). """
+        return self._term_weights(term_id, docs, self.postings_lists.probe(term_id, docs), weighting)
+
+    def _term_weights(self, term_id, docs, tf, weighting):
+        """ Return weights of a term occurring tf times in the documents. """
+        if weighting == WEIGHTING_BINARY:
+            return (tf > 0).astype(float)
+        elif weighting == WEIGHTING_TF:
+            return tf / self.doc_lengths[docs]
+        elif weighting == WEIGHTING_TFIDF:
+            return tf * self.idf[term_id] / self.tfidf_lengths[docs]
+        else:
+            raise ValueError(f"Unknown weighting scheme: {weighting}")
+
+    def query_vector(self, query, weighting):
+        """
+        Transform the query with the frozen vocabulary, see weight_query().
+
+        Returns:
+            Tuple (term ids, weights of the terms in the query).
+        """
+        return weight_query(self.analyzer(query), self.vocabulary, weighting, self.idf)
+
+    def dot_products(self, term_ids, query_weights, weighting):
+        """
+        Traverse postings of the query terms and accumulate dot products of the query and the documents.
+
+        Returns:
+            Tuple (indices of documents sharing at least one term with the query, their dot products with the query).
+        """
+        if len(term_ids) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+
+        docs, contributions = [], []
+        for term_id, query_weight in zip(term_ids, query_weights):
+            term_docs, term_weights = self.postings(term_id, weighting)
+            docs.append(term_docs)
+            contributions.append(term_weights * query_weight)
+
+        matched_docs, inverse = np.unique(np.concatenate(docs), return_inverse=True)
+        return matched_docs, np.bincount(inverse, weights=np.concatenate(contributions))
+
+    def top_k_dot_products(self, term_ids, query_weights, weighting, limit):
+        """
+        Find documents that can be among the `limit` most similar ones to the query by cosine similarity, with MaxScore
+        pruning, and accumulate their dot products with the query.
+
+        A term can add at most its upper bound (query weight x max_term_scores()) to the similarity of any document.
+        Terms are taken from the highest bound down and their posting lists traversed (essential terms) until the
+        bounds of the remaining terms (non-essential) sum to less than a known lower bound of the `limit`-th best
+        similarity: a document that contains only non-essential terms can not get among the best. Non-essential
+        lists are only probed for the candidates (see CompressedPostingLists.probe()), from the highest bound down,
+        and candidates that can not reach the `limit`-th best similarity even with the bounds of the terms not probed
+        yet are dropped after every list.
+
+        Contributions are summed in the order of the terms like in dot_products(), so the candidates get exactly the
+        same dot products and are ranked the same as by the exhaustive path.
+
+        Returns:
+            Tuple (indices of the candidate documents, their dot products with the query). Documents sharing a term
+            with the query but missing here are worse than the `limit`-th best one.
+        """
+        query_norm = np.linalg.norm(query_weights)
+        if query_norm == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+
+        doc_norms = self.norms[weighting]
+        bounds = query_weights * self.max_term_scores(weighting)[term_ids] / query_norm
+        terms = np.argsort(-bounds, kind="stable")
+        remaining_bounds = np.append(np.cumsum(bounds[terms][::-1])[::-1], 0)  # of the terms from i on
+
+        # Essential terms, the k-th best contribution of a single term is a lower bound of the k-th best similarity
+        essential, threshold = [], 0
+        while len(essential) < len(terms) and remaining_bounds[len(essential)] >= threshold - PRUNING_MARGIN:
+            term = terms[len(essential)]
+            docs, weights = self.postings(term_ids[term], weighting)
+            essential.append((term, docs, weights))
+            if len(docs) >= limit:
+                similarities = weights * query_weights[term] / np.maximum(doc_norms[docs] * query_norm, 1e-12)
+                threshold = max(threshold, np.partition(similarities, len(docs) - limit)[len(docs) - limit])
+
+        # Similarities of all documents in the essential lists, summed over the essential terms
+        similarities = np.zeros(self.doc_count)
+        in_candidates = np.zeros(self.doc_count, dtype=bool)
+        for term, docs, weights in essential:
+            similarities[docs] += weights * query_weights[term] / np.maximum(doc_norms[docs] * query_norm, 1e-12)
+            in_candidates[docs] = True
+        candidates = np.flatnonzero(in_candidates)
+        similarities = similarities[candidates]
+
+        for i in range(len(essential), len(terms) + 1):
+            # Drop candidates that can not get among the best even with all terms not probed yet
+            if len(candidates) > limit:
+                threshold = np.partition(similarities, len(candidates) - limit)[len(candidates) - limit]
+                keep = similarities + remaining_bounds[i] >= threshold - PRUNING_MARGIN
+                candidates, similarities = candidates[keep], similarities[keep]
+
+            if i < len(terms):
+                term = terms[i]
+                similarities += (self.probe(term_ids[term], candidates, weighting) * query_weights[term]
+                                 / np.maximum(doc_norms[candidates] * query_norm, 1e-12))
+
+        # Exact dot products of the remaining candidates, summed in the order of the terms like np.bincount() in
+        # dot_products()
+        essential_postings = {term: (docs, weights) for term, docs, weights in essential}
+        dots = np.zeros(len(candidates))
+        for term, term_id in enumerate(term_ids):
+            if term in essential_postings:
+                weights = lookup(*essential_postings[term], candidates)
+            else:
+                weights = self.probe(term_id, candidates, weighting)
+            dots += weights * query_weights[term]
+        return candidates, dots
+
+    def rank(self, query, weighting, metric, limit=None):
+        """
+        Rank documents of the collection by their similarity to the query.
+
+        Args:
+            query: Query string.
+            weighting: One of WEIGHTING_*.
+            metric: METRIC_EUCLIDEAN or METRIC_COSINE.
+            limit: Number of best documents to return, all documents if None.
+
+        Returns:
+            Array of document ids (indexed from 1), best first.
+        """
+        limit = self.doc_count if limit is None else min(limit, self.doc_count)
+        term_ids, query_weights = self.query_vector(query, weighting)
+        if metric == METRIC_COSINE and limit < self.doc_count:
+            matched_docs, dots = self.top_k_dot_products(term_ids, query_weights, weighting, limit)
+        else:
+            matched_docs, dots = self.dot_products(term_ids, query_weights, weighting)
+        doc_norms = self.norms[weighting][matched_docs]
+
+        if metric == METRIC_COSINE:
+            query_norm = np.linalg.norm(query_weights)
+            scores = -dots / np.maximum(doc_norms * query_norm, 1e-12)  # negated, lower is better
+            # Documents without a common term have zero similarity, keep them in document order
+            unmatched_candidates = np.arange(min(limit + len(matched_docs), self.doc_count))
+            unmatched_scores = np.zeros(len(unmatched_candidates))
+        elif metric == METRIC_EUCLIDEAN:
+            # |q - d|^2 = |q|^2 + |d|^2 - 2 q.d, the |q|^2 part is the same for all documents
+            scores = doc_norms ** 2 - 2 * dots
+            # Documents without a common term are only as far as their own norm
+            unmatched_candidates = self.docs_by_norm[weighting][:limit + len(matched_docs)]
+            unmatched_scores = self.norms[weighting][unmatched_candidates] ** 2
+        else:
+            raise ValueError(f"Unknown metric: {metric}")
+
+        unmatched_mask = ~np.isin(unmatched_candidates, matched_docs)
+        candidates = np.concatenate([matched_docs, unmatched_candidates[unmatched_mask]])
+        candidate_scores = np.concatenate([scores, unmatched_scores[unmatched_mask]])
+
+        order = np.lexsort((candidates, np.round(candidate_scores, SCORE_DECIMALS)))[:limit]  # ties in document order
+        return candidates[order] + 1  # documents are indexed from 1
+
+    def document_matrix(self, weighting):
+        """ Return (documents x terms) CSR matrix of document vectors in the given weighting scheme. """
+        if weighting not in self._document_matrices:
+            # Postings are exactly the columns of the matrix
+            docs, weights = self._posting_weights(weighting)
+            matrix = scipy.sparse.csc_matrix((weights, docs, self.postings_offsets),
+                                             shape=(self.doc_count, len(self.postings_offsets) - 1))
+            self._document_matrices[weighting] = matrix.tocsr()
+
+        return self._document_matrices[weighting]
+
+    def query_matrix(self, queries, weighting):
+        """ Return (queries x terms) CSR matrix of query vectors in the given weighting scheme. """
+        vectors = [self.query_vector(query, weighting) for query in queries]
+        offsets = np.cumsum([0] + [len(term_ids) for term_ids, _ in vectors])
+
+        return scipy.sparse.csr_matrix((np.concatenate([weights for _, weights in vectors] + [np.empty(0)]),
+                                        np.concatenate([term_ids for term_ids, _ in vectors] + [np.empty(0, int)]),
+                                        offsets),
+                                       shape=(len(queries), len(self.postings_offsets) - 1))
+
+    def rank_batch(self, queries, weighting, metric, limit=None):
+        """
+        Rank documents for all queries at once. All queries are scored by a single sparse matrix product.
+
+        Args:
+            queries: List of query strings.
+            weighting: One of WEIGHTING_*.
+            metric: METRIC_EUCLIDEAN or METRIC_COSINE.
+            limit: Number of best documents to return per query, all documents if None.
+
+        Returns:
+            Matrix (queries x limit) of document ids (indexed from 1), best first in every row.
+        """
+        limit = self.doc_count if limit is None else min(limit, self.doc_count)
+        query_matrix = self.query_matrix(queries, weighting)
+        dots = (query_matrix @ self.document_matrix(weighting).T).toarray()
+        doc_norms = self.norms[weighting]
+
+        if metric == METRIC_COSINE:
+            query_norms = np.sqrt(np.asarray(query_matrix.multiply(query_matrix).sum(1)))
+            scores = -dots / np.maximum(query_norms * doc_norms, 1e-12)  # negated, lower is better
+        elif metric == METRIC_EUCLIDEAN:
+            # |q - d|^2 = |q|^2 + |d|^2 - 2 q.d, the |q|^2 part is the same for all documents of a query
+            scores = doc_norms ** 2 - 2 * dots
+        else:
+            raise ValueError(f"Unknown metric: {metric}")
+        scores = np.round(scores, SCORE_DECIMALS)
+
+        if limit == self.doc_count:
+            return np.argsort(scores, axis=1, kind="stable") + 1  # documents are indexed from 1
+
+        # Keep every document tied with the limit-th score, so that ties are resolved by the document index like
+        # in rank()
+        kth_scores = np.partition(scores, limit - 1, axis=1)[:, limit - 1:limit]
+        rows, docs = np.nonzero(scores <= kth_scores)
+        order = np.lexsort((docs, scores[rows, docs], rows))
+        rows, docs = rows[order], docs[order]
+
+        # Every row has at least `limit` candidates, take the first `limit` of each
+        starts = np.searchsorted(rows, np.arange(len(queries)))
+        best = docs[(starts[:, np.newaxis] + np.arange(limit)).ravel()].reshape(len(queries), limit)
+        return best + 1  # documents are indexed from 1
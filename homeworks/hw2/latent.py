@@ -0,0 +1,142 @@
+import time
+
+import numpy as np
+from sklearn.decomposition import TruncatedSVD
+
+import indexing
+from evaluation import relevance_matrix, evaluate_rankings
+from inverted_index import WEIGHTING_TFIDF, METRIC_COSINE
+
+LATENT_COMPONENTS = 200
+IVF_LISTS = 32
+
+
+def normalize_rows(matrix):
+    return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+
+class LatentSpace:
+    """ Latent semantic analysis - truncated SVD of the tf-idf document matrix. """
+
+    def __init__(self, index, components=LATENT_COMPONENTS, random_state=0):
+        """
+        Args:
+            index: InvertedIndex of the collection.
+            components: Number of latent dimensions.
+        """
+        self.index = index
+        self.svd = TruncatedSVD(n_components=components, random_state=random_state)
+        self.doc_vectors = normalize_rows(self.svd.fit_transform(index.document_matrix(WEIGHTING_TFIDF)))
+
+    def query_vectors(self, queries):
+        """ Return (queries x components) matrix of unit length query vectors in the latent space. """
+        return normalize_rows(self.svd.transform(self.index.query_matrix(queries, WEIGHTING_TFIDF)))
+
+    def search_exact(self, query_vectors, limit):
+        """ Rank all documents by cosine similarity to every query, return (queries x limit) document ids. """
+        scores = query_vectors @ self.doc_vectors.T
+        best = np.argpartition(-scores, limit - 1, axis=1)[:, :limit]
+        order = np.argsort(-np.take_along_axis(scores, best, axis=1), axis=1, kind="stable")
+        return np.take_along_axis(best, order, axis=1) + 1  # documents are indexed from 1
+
+
+class IVFIndex:
+    """
+    Approximate nearest neighbour index (inverted file) over unit length vectors.
+
+    Vectors are clustered by spherical k-means, every cluster keeps the list of its vectors. A query is compared to
+    the cluster centroids and only vectors of the `n_probe` closest clusters are scored, so more probed clusters mean
+    better recall and higher latency.
+    """
+
+    def __init__(self, vectors, list_count=IVF_LISTS, iterations=20, random_state=0):
+        """
+        Args:
+            vectors: (n x dimensions) matrix of unit length vectors.
+            list_count: Number of clusters (inverted lists).
+            iterations: Number of k-means iterations.
+        """
+        self.vectors = vectors
+        rng = np.random.default_rng(random_state)
+        self.centroids = vectors[rng.choice(len(vectors), size=min(list_count, len(vectors)), replace=False)]
+
+        for _ in range(iterations):
+            assignment = np.argmax(vectors @ self.centroids.T, axis=1)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assignment, vectors)
+            non_empty = np.bincount(assignment, minlength=len(self.centroids)) > 0
+            self.centroids[non_empty] = normalize_rows(sums[non_empty])  # empty clusters keep their centroid
+
+        assignment = np.argmax(vectors @ self.centroids.T, axis=1)
+        order = np.argsort(assignment, kind="stable")
+        self.list_members = order
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=len(self.centroids)))])
+
+    def search(self, query_vectors, limit, n_probe=1):
+        """
+        Find approximately most similar vectors for every query.
+
+        Args:
+            query_vectors: (queries x dimensions) matrix of unit length vectors.
+            limit: Number of results per query.
+            n_probe: Number of closest clusters to search. More clusters are searched if these do not hold `limit`
+                     vectors.
+
+        Returns:
+            (queries x limit) matrix of vector indices, most similar first.
+        """
+        limit = min(limit, len(self.vectors))
+        list_sizes = np.diff(self.list_offsets)
+        closest_lists = np.argsort(-(query_vectors @ self.centroids.T), axis=1)
+
+        results = np.empty((len(query_vectors), limit), dtype=np.int64)
+        for i, query in enumerate(query_vectors):
+            # Lists needed to get at least `limit` candidates
+            needed = np.searchsorted(np.cumsum(list_sizes[closest_lists[i]]), limit) + 1
+            candidates = np.concatenate([self.list_members[self.list_offsets[list_id]:self.list_offsets[list_id + 1]]
+                                         for list_id in closest_lists[i][:max(n_probe, needed)]])
+            scores = self.vectors[candidates] @ query
+            best = np.argpartition(-scores, limit - 1)[:limit]
+            results[i] = candidates[best[np.argsort(-scores[best], kind="stable")]]
+
+        return results
+
+
+def benchmark(limit=15, probes=(1, 2, 4, 8, 16, IVF_LISTS)):
+    """
+    Compare exact sparse tf-idf cosine ranking, exact LSA ranking and IVF search over LSA vectors with a growing number
+    of probed clusters: latency per query, recall against exact LSA results and retrieval quality on the qrels.
+    """
+    index = indexing.get_index()
+    queries = indexing.get_queries()
+    relevance = relevance_matrix([indexing.get_relevant_docs(i) for i in range(1, len(queries) + 1)], index.doc_count)
+
+    def report(name, rankings, seconds, exact=None):
+        result = evaluate_rankings(rankings, relevance, [limit])
+        line = "{:24} {:8.3f} ms/query  P@{k} = {:.4f}  MAP@{k} = {:.4f}".format(
+            name, 1000 * seconds / len(queries), result.precision.mean(), result.average_precision.mean(), k=limit)
+        if exact is not None:
+            overlap = np.mean([len(np.intersect1d(a, b)) / limit for a, b in zip(rankings, exact)])
+            line += "  recall vs exact LSA = {:.4f}".format(overlap)
+        print(line)
+
+    start = time.perf_counter()
+    rankings = index.rank_batch(queries, WEIGHTING_TFIDF, METRIC_COSINE, limit)
+    report("TF-IDF cosine (sparse)", rankings, time.perf_counter() - start)
+
+    space = LatentSpace(index)
+    query_vectors = space.query_vectors(queries)
+
+    start = time.perf_counter()
+    exact = space.search_exact(query_vectors, limit)
+    report("LSA exact", exact, time.perf_counter() - start)
+
+    ivf = IVFIndex(space.doc_vectors)
+    for n_probe in probes:
+        start = time.perf_counter()
+        rankings = ivf.search(query_vectors, limit, n_probe) + 1  # documents are indexed from 1
+        report("LSA IVF, n_probe={}".format(n_probe), rankings, time.perf_counter() - start, exact)
+
+
+if __name__ == '__main__':
+    benchmark()
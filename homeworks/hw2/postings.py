@@ -0,0 +1,203 @@
+from collections import namedtuple
+
+import numpy as np
+
+# Postings per skip block of a compressed list
+BLOCK_SIZE = 128
+
+# Skip blocks of all lists: blocks of term `t` are [term_offsets[t], term_offsets[t + 1]), block `b` holds the postings
+# [starts[b], starts[b + 1]) of the collection, ending with document last_docs[b], encoded at bytes
+# [docs_byte_offsets[b], ...[b + 1]) and [tf_byte_offsets[b], ...[b + 1])
+Skip_Blocks = namedtuple("Skip_Blocks", ["term_offsets", "starts", "last_docs", "docs_byte_offsets", "tf_byte_offsets"])
+
+
+def encode_varint(values):
+    """
+    Encode non-negative integers as variable length bytes (LEB128). Every byte keeps 7 bits of the value, the highest
+    bit is set on all bytes of a value but the last one.
+
+    Returns:
+        numpy.uint8 array.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    byte_counts = np.ones(len(values), dtype=np.int64)
+    for shift in range(7, 64, 7):
+        byte_counts += values >= (np.uint64(1) << np.uint64(shift))
+
+    value_starts = np.cumsum(byte_counts) - byte_counts
+    encoded = np.empty(int(byte_counts.sum()), dtype=np.uint8)
+    for byte in range(int(byte_counts.max(initial=0))):
+        mask = byte_counts > byte
+        chunk = (values[mask] >> np.uint64(7 * byte)) & np.uint64(0x7f)
+        continuation = np.where(byte_counts[mask] > byte + 1, 0x80, 0).astype(np.uint64)
+        encoded[value_starts[mask] + byte] = chunk | continuation
+
+    return encoded
+
+
+def decode_varint(data):
+    """ Decode bytes produced by encode_varint back to a numpy.int64 array. """
+    data = np.asarray(data, dtype=np.uint8)
+    if len(data) == 0:
+        return np.empty(0, dtype=np.int64)
+
+    value_ends = np.flatnonzero(data < 0x80)
+    value_starts = np.concatenate([[0], value_ends[:-1] + 1])
+    value_ids = np.repeat(np.arange(len(value_starts)), value_ends - value_starts + 1)
+    shifts = (7 * (np.arange(len(data)) - value_starts[value_ids])).astype(np.uint64)
+
+    return np.add.reduceat((data & 0x7f).astype(np.uint64) << shifts, value_starts).astype(np.int64)
+
+
+def delta_encode(docs, offsets):
+    """ Replace sorted document indices by gaps to the previous document of the same posting list. """
+    gaps = np.array(docs, dtype=np.int64)
+    gaps[1:] -= docs[:-1]
+    starts = offsets[:-1][np.diff(offsets) > 0]
+    gaps[starts] = docs[starts]  # first document of every list is kept as is
+    return gaps
+
+
+def delta_decode(gaps, offsets):
+    """ Inverse of delta_encode. """
+    sums = np.cumsum(gaps)
+    counts = np.diff(offsets)
+    before_list = np.concatenate([[0], sums])[offsets[:-1]]
+    return sums - np.repeat(before_list, counts)
+
+
+def gather_ranges(data, starts, ends):
+    """ Return concatenation of data[starts[i]:ends[i]] for all i. """
+    lengths = ends - starts
+    positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    return np.asarray(data[positions])
+
+
+def lookup(list_docs, list_tf, docs):
+    """ Return term frequencies of the documents in a posting list, 0 for documents not in the list. """
+    if len(list_docs) == 0:
+        return np.zeros(len(docs), dtype=np.int64)
+
+    positions = np.minimum(np.searchsorted(list_docs, docs), len(list_docs) - 1)
+    return np.where(list_docs[positions] == docs, list_tf[positions], 0)
+
+
+class PostingLists:
+    """ Uncompressed postings kept in memory. """
+
+    def __init__(self, offsets, docs, tf):
+        """
+        Args:
+            offsets: Postings of term `t` are stored at [offsets[t], offsets[t + 1]).
+            docs: Document indices (0-based) of all postings, sorted within every term.
+            tf: Term frequencies of all postings.
+        """
+        self.offsets = offsets
+        self.docs = docs
+        self.tf = tf
+
+    def read(self, term_id):
+        """ Return tuple (document indices, term frequencies) of the term. """
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        return self.docs[start:end], self.tf[start:end]
+
+    def probe(self, term_id, docs):
+        """ Return term frequencies of the term in the sorted documents, 0 for documents not in its list. """
+        return lookup(*self.read(term_id), docs)
+
+    def read_all(self):
+        """ Return tuple (document indices, term frequencies) of all postings, ordered by term. """
+        return self.docs, self.tf
+
+
+class CompressedPostingLists:
+    """
+    Postings compressed with delta + varint encoding, usually memory-mapped from the index files.
+
+    Document indices are stored as gaps to the previous document of the list, both gaps and term frequencies are
+    varint encoded. Only the byte ranges of the requested terms are touched (and decoded), so the index can be larger
+    than memory and the pages are shared by all processes mapping the same files.
+
+    Lists are split into skip blocks of BLOCK_SIZE postings, with the last document and the byte offsets of every
+    block, so probe() decodes only the blocks that may contain the probed documents.
+    """
+
+    def __init__(self, offsets, docs_data, docs_byte_offsets, tf_data, tf_byte_offsets, blocks):
+        """
+        Args:
+            offsets: Postings of term `t` are the [offsets[t], offsets[t + 1]) postings of the collection.
+            docs_data: Encoded document gaps of all terms.
+            docs_byte_offsets: Document gaps of term `t` are stored at bytes [docs_byte_offsets[t], ...[t + 1]).
+            tf_data: Encoded term frequencies of all terms.
+            tf_byte_offsets: Term frequencies of term `t` are stored at bytes [tf_byte_offsets[t], ...[t + 1]).
+            blocks: Skip_Blocks of all lists.
+        """
+        self.offsets = offsets
+        self.docs_data = docs_data
+        self.docs_byte_offsets = docs_byte_offsets
+        self.tf_data = tf_data
+        self.tf_byte_offsets = tf_byte_offsets
+        self.blocks = blocks
+
+    @classmethod
+    def compress(cls, postings):
+        """ Compress PostingLists. """
+        offsets = np.asarray(postings.offsets, dtype=np.int64)
+        docs, tf = postings.read_all()
+        docs_data, docs_value_offsets = cls._encode_lists(delta_encode(docs, offsets))
+        tf_data, tf_value_offsets = cls._encode_lists(tf)
+
+        # Blocks start every BLOCK_SIZE postings of a list
+        counts = np.diff(offsets)
+        block_counts = -(-counts // BLOCK_SIZE)
+        block_starts = np.repeat(offsets[:-1], block_counts) + BLOCK_SIZE * (
+            np.arange(block_counts.sum()) - np.repeat(np.cumsum(block_counts) - block_counts, block_counts))
+        block_starts = np.append(block_starts, offsets[-1]).astype(np.int64)
+        blocks = Skip_Blocks(term_offsets=np.concatenate([[0], np.cumsum(block_counts)]).astype(np.int64),
+                             starts=block_starts,
+                             last_docs=np.asarray(docs[block_starts[1:] - 1], dtype=np.int64),
+                             docs_byte_offsets=docs_value_offsets[block_starts],
+                             tf_byte_offsets=tf_value_offsets[block_starts])
+
+        return cls(offsets, docs_data, docs_value_offsets[offsets], tf_data, tf_value_offsets[offsets], blocks)
+
+    @staticmethod
+    def _encode_lists(values):
+        """ Encode values of all lists, return tuple (bytes, byte offset of every value and of the end). """
+        encoded = encode_varint(values)
+        value_ends = np.flatnonzero(encoded < 0x80) + 1
+        return encoded, np.concatenate([[0], value_ends]).astype(np.int64)
+
+    def read(self, term_id):
+        """ Return tuple (document indices, term frequencies) of the term. """
+        gaps = decode_varint(self.docs_data[self.docs_byte_offsets[term_id]:self.docs_byte_offsets[term_id + 1]])
+        tf = decode_varint(self.tf_data[self.tf_byte_offsets[term_id]:self.tf_byte_offsets[term_id + 1]])
+        return np.cumsum(gaps), tf
+
+    def probe(self, term_id, docs):
+        """
+        Return term frequencies of the term in the sorted documents, 0 for documents not in its list. Only the blocks
+        that may contain the documents are decoded.
+        """
+        first, end = self.blocks.term_offsets[term_id], self.blocks.term_offsets[term_id + 1]
+        block_ids = np.searchsorted(self.blocks.last_docs[first:end], docs)  # sorted, as the documents are
+        block_ids = block_ids[(block_ids < end - first) & np.append(True, np.diff(block_ids) > 0)] + first
+        if len(block_ids) == 0:
+            return np.zeros(len(docs), dtype=np.int64)
+        if 2 * len(block_ids) > end - first:
+            return lookup(*self.read(term_id), docs)  # most of the list is needed, decode it at once
+
+        gaps = decode_varint(gather_ranges(self.docs_data, self.blocks.docs_byte_offsets[block_ids],
+                                           self.blocks.docs_byte_offsets[block_ids + 1]))
+        tf = decode_varint(gather_ranges(self.tf_data, self.blocks.tf_byte_offsets[block_ids],
+                                         self.blocks.tf_byte_offsets[block_ids + 1]))
+        # Gaps continue from the last document of the previous block, the first gap of a list is the document itself
+        counts = self.blocks.starts[block_ids + 1] - self.blocks.starts[block_ids]
+        bases = np.where(block_ids > first, self.blocks.last_docs[np.maximum(block_ids - 1, 0)], 0)
+        block_docs = delta_decode(gaps, np.concatenate([[0], np.cumsum(counts)])) + np.repeat(bases, counts)
+        return lookup(block_docs, tf, docs)
+
+    def read_all(self):
+        """ Return tuple (document indices, term frequencies) of all postings, ordered by term. """
+        offsets = np.asarray(self.offsets)
+        return delta_decode(decode_varint(self.docs_data), offsets), decode_varint(self.tf_data)
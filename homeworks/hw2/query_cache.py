@@ -0,0 +1,176 @@
+from collections import OrderedDict, namedtuple
+import json
+import os
+import threading
+import weakref
+
+import numpy as np
+
+MAX_ENTRIES = 10000
+MAX_BYTES = 64 * 1024 * 1024
+QUERY_CACHE_DIR = "./cache"
+
+Cache_Stats = namedtuple("Cache_Stats", ["hits", "misses", "evictions", "entries", "bytes"])
+
+
+class QueryCache:
+    """
+    LRU cache of ranking results.
+
+    Entries are keyed by (normalized query, weighting scheme, metric, limit). The normalized query is the sorted list of
+    its tokens, so queries that produce the same query vector share an entry. The cache holds results of one index at
+    a time: it keeps a weak reference to the index and its version, and drops all entries when the version changes (a
+    SegmentedIndex got new or deleted documents) or when it is used with another index object, unless both are
+    InvertedIndex objects of the same collection (same corpus hash). Memory is
+    bounded by the number of entries and by the size of the cached results, the least recently used entries are
+    evicted first.
+
+    With a cache directory, entries of an index whose version identifies the collection (an InvertedIndex with
+    a corpus hash) are stored by save() keyed by that version and loaded again when the cache is first used with an
+    index of the same collection, so reruns of an experiment do not rank the same queries again.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES, cache_dir=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._index = None  # weak reference, a new object at the same address must not match
+        self._index_version = None
+        self._lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _bind(self, index):
+        """ Switch the cache to the index if it is not the one the entries belong to. Call with the lock held. """
+        if self._index is not None and self._index() is index and index.version == self._index_version:
+            return
+
+        version = index.version
+        if not (isinstance(version, str) and version == self._index_version):
+            # Only a corpus hash identifies the collection, other versions are only meaningful for the same object
+            self.clear()
+            self._index_version = version
+            self._load()
+        self._index = weakref.ref(index)
+
+    def _filename(self):
+        if self.cache_dir is None or not isinstance(self._index_version, str):
+            return None
+        return os.path.join(self.cache_dir, "queries-{}".format(self._index_version))
+
+    def key(self, index, query, weighting, metric, limit=None):
+        return tuple(sorted(index.analyzer(query))), weighting, metric, limit
+
+    def get(self, index, query, weighting, metric, limit=None):
+        """ Return the cached result of index.rank(query, weighting, metric, limit), None if it is not cached. """
+        key = self.key(index, query, weighting, metric, limit)
+
+        with self._lock:
+            self._bind(index)
+            result = self._entries.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def put(self, index, query, weighting, metric, limit, result):
+        """ Store the result of index.rank(query, weighting, metric, limit). """
+        key = self.key(index, query, weighting, metric, limit)
+        result = np.array(result)
+        result.setflags(write=False)  # shared by all callers
+
+        with self._lock:
+            self._bind(index)
+            self._insert(key, result)
+
+        return result
+
+    def _insert(self, key, result):
+        if key in self._entries or result.nbytes > self.max_bytes:
+            return
+
+        self._entries[key] = result
+        self._bytes += result.nbytes
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.nbytes
+            self.evictions += 1
+
+    def rank(self, index, query, weighting, metric, limit=None):
+        """ Return index.rank(query, weighting, metric, limit), from the cache if possible. """
+        with self._lock:
+            result = self.get(index, query, weighting, metric, limit)
+            version = self._index_version
+        if result is not None:
+            return result
+
+        result = index.rank(query, weighting, metric, limit)
+
+        with self._lock:
+            # The index may have changed while ranking, do not store a result of an old version
+            if version == index.version:
+                return self.put(index, query, weighting, metric, limit, result)
+        return result
+
+    def rank_batch(self, index, queries, weighting, metric, limit=None):
+        """ Return index.rank_batch(queries, weighting, metric, limit), only queries not in the cache are ranked. """
+        results = [self.get(index, query, weighting, metric, limit) for query in queries]
+        missing = [i for i, result in enumerate(results) if result is None]
+
+        if missing:
+            rankings = index.rank_batch([queries[i] for i in missing], weighting, metric, limit)
+            for i, ranking in zip(missing, rankings):
+                results[i] = self.put(index, queries[i], weighting, metric, limit, ranking)
+
+        return np.vstack(results) if results else np.empty((0, 0), dtype=np.int64)
+
+    def _load(self):
+        """ Load stored entries of the current index version. Call with the lock held. """
+        filename = self._filename()
+        if filename is None or not os.path.exists(filename + ".json"):
+            return
+
+        with open(filename + ".json") as f:
+            keys = json.load(f)
+        with np.load(filename + ".npz") as data:
+            results = np.split(data["results"], data["offsets"][1:-1])
+
+        for (tokens, weighting, metric, limit), result in zip(keys, results):
+            result.setflags(write=False)
+            self._insert((tuple(tokens), weighting, metric, limit), result)
+
+    def save(self):
+        """ Store the entries, if the cache has a directory and the index version identifies the collection. """
+        with self._lock:
+            filename = self._filename()
+            if filename is None:
+                return
+
+            keys = [[list(tokens), weighting, metric, limit] for tokens, weighting, metric, limit in self._entries]
+            results = list(self._entries.values())
+
+        offsets = np.cumsum([0] + [len(result) for result in results])
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if os.path.exists(filename + ".json"):
+            os.remove(filename + ".json")  # the stored entry is incomplete until the new one is written
+        np.savez(filename + ".npz", results=np.concatenate(results + [np.empty(0, dtype=np.int64)]), offsets=offsets)
+        with open(filename + ".json", mode="w") as f:  # written last, marks a complete entry
+            json.dump(keys, f)
+
+    def clear(self):
+        """ Drop all entries (counters are kept). """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        return Cache_Stats(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                           entries=len(self._entries), bytes=self._bytes)
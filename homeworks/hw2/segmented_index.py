@@ -0,0 +1,331 @@
+import threading
+
+import numpy as np
+import scipy.sparse
+from sklearn.feature_extraction.text import CountVectorizer
+
+from inverted_index import WEIGHTING_BINARY, WEIGHTING_TF, WEIGHTING_TFIDF, METRIC_EUCLIDEAN, METRIC_COSINE, \
+    SCORE_DECIMALS, weight_query
+
+MERGE_FACTOR = 8
+
+
+class Segment:
+    """ Immutable batch of documents (term counts), only the deletion marks change. """
+
+    def __init__(self, doc_ids, counts):
+        """
+        Args:
+            doc_ids: Sorted ids of the documents in the segment.
+            counts: (documents x terms) matrix of term counts. Terms added to the vocabulary after the segment was
+                    created are not its columns, they do not occur in it.
+        """
+        self.doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        self.counts = scipy.sparse.csc_matrix(counts, dtype=np.float64)  # columns are the posting lists
+        self.counts.sort_indices()
+        self.rows = self.counts.tocsr()
+        self.deleted = np.zeros(len(self.doc_ids), dtype=bool)
+
+        self.doc_lengths = np.asarray(self.rows.sum(1)).ravel()
+        self.norms = {
+            WEIGHTING_BINARY: np.sqrt(np.diff(self.rows.indptr)),
+            WEIGHTING_TF: np.sqrt(np.asarray(self.rows.multiply(self.rows).sum(1)).ravel())
+                          / np.maximum(self.doc_lengths, 1),
+            WEIGHTING_TFIDF: (self.doc_lengths > 0).astype(float),
+        }
+        # Documents ordered by their norm, used to rank documents that share no term with the query by distance
+        self.docs_by_norm = {weighting: np.argsort(norms, kind="stable") for weighting, norms in self.norms.items()}
+
+        # Lengths of tf-idf vectors depend on the idf of the whole collection, they are computed at query time for the
+        # matched documents only and kept until the idf changes (tagged with the generation of the index)
+        self._tfidf_lengths = np.zeros(len(self.doc_ids))
+        self._tfidf_generations = np.full(len(self.doc_ids), -1, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def doc_freq(self, rows=None):
+        """ Return number of (not deleted) documents containing every term, for the given rows only if set. """
+        rows = self.rows[~self.deleted] if rows is None else self.rows[rows]
+        return np.bincount(rows.indices, minlength=self.counts.shape[1])
+
+    def tfidf_lengths(self, rows, idf, generation):
+        """ Return lengths of tf-idf vectors of the given documents, recomputed only if the idf changed since. """
+        stale = rows[self._tfidf_generations[rows] != generation]
+        if len(stale):
+            counts = self.rows[stale]
+            weighted = counts.data * idf[counts.indices]
+            self._tfidf_lengths[stale] = np.sqrt(np.bincount(np.repeat(np.arange(len(stale)), np.diff(counts.indptr)),
+                                                             weights=weighted ** 2, minlength=len(stale)))
+            self._tfidf_generations[stale] = generation
+
+        return self._tfidf_lengths[rows]
+
+    def dot_products(self, term_ids, query_weights, weighting, idf, generation):
+        """
+        Traverse postings of the query terms and accumulate dot products of the query and the documents of the segment
+        (as weighted vectors).
+
+        Returns:
+            Tuple (rows of documents sharing at least one term with the query, their dot products with the query).
+        """
+        present = term_ids < self.counts.shape[1]
+        term_ids, query_weights = term_ids[present], query_weights[present]
+        starts, ends = self.counts.indptr[term_ids], self.counts.indptr[term_ids + 1]
+        rows = np.concatenate([self.counts.indices[start:end] for start, end in zip(starts, ends)] + [np.empty(0, int)])
+        tf = np.concatenate([self.counts.data[start:end] for start, end in zip(starts, ends)] + [np.empty(0)])
+        posting_terms = np.repeat(np.arange(len(term_ids)), ends - starts)
+        matched_rows, inverse = np.unique(rows, return_inverse=True)
+
+        if weighting == WEIGHTING_BINARY:
+            weights = np.ones(len(rows))
+        elif weighting == WEIGHTING_TF:
+            weights = tf / self.doc_lengths[rows]
+        elif weighting == WEIGHTING_TFIDF:
+            weights = tf * idf[term_ids][posting_terms] / self.tfidf_lengths(matched_rows, idf, generation)[inverse]
+        else:
+            raise ValueError(f"Unknown weighting scheme: {weighting}")
+
+        return matched_rows, np.bincount(inverse, weights=weights * query_weights[posting_terms],
+                                         minlength=len(matched_rows))
+
+
+class SegmentedIndex:
+    """
+    Index that accepts new documents and deletions without a rebuild, organized like an LSM tree.
+
+    Every added batch of documents becomes a new small segment, searchable right away. Deleted documents are only
+    marked in their segment. When there are more than `merge_factor` segments, the smallest ones are merged into one
+    (dropping deleted documents), optionally in a background thread, so the number of segments stays small. Only one
+    merge runs at a time.
+
+    The vocabulary grows with new terms. Document frequencies are updated by every addition and deletion, idf is
+    derived from them when needed. Segments keep raw term counts only: the idf is applied at query time, and tf-idf
+    lengths are computed for the documents matching a query only, so an addition does not touch other segments.
+    Queries are scored by traversing postings of their terms in every segment, like InvertedIndex.rank(), with the
+    same results.
+    """
+
+    def __init__(self, vocabulary=None, merge_factor=MERGE_FACTOR, merge_in_background=False):
+        """
+        Args:
+            vocabulary: Dict of {term: term_id} to start with.
+            merge_factor: Maximal number of segments before the smallest ones are merged.
+            merge_in_background: Merge segments in a background thread instead of during add_documents().
+        """
+        self.vocabulary = dict(vocabulary or {})
+        self.merge_factor = merge_factor
+        self.merge_in_background = merge_in_background
+
+        self.analyzer = CountVectorizer().build_analyzer()
+        self.segments = []
+        self.doc_freq = np.zeros(len(self.vocabulary), dtype=np.int64)
+        self.doc_count = 0
+        self.next_doc_id = 1  # documents are indexed from 1
+        self.generation = 0  # changes with every addition and deletion, invalidates idf derived values
+
+        self._lock = threading.RLock()
+        self._merge_lock = threading.RLock()  # held for a whole merge, the segments change only at its end
+        self._merge_thread = None
+
+    @property
+    def version(self):
+        """ Changes whenever documents are added or deleted. """
+        return self.generation
+
+    @classmethod
+    def from_index(cls, index, **kwargs):
+        """ Create a segmented index with all documents of an InvertedIndex as its first segment. """
+        segmented = cls(index.vocabulary, **kwargs)
+        docs, tf = index.postings_lists.read_all()
+        counts = scipy.sparse.csc_matrix((tf, docs, np.asarray(index.postings_offsets)),
+                                         shape=(index.doc_count, len(index.vocabulary)))
+        segmented._add_segment(Segment(np.arange(1, index.doc_count + 1), counts))
+        return segmented
+
+    def add_documents(self, documents):
+        """
+        Add documents to the index, they are searchable once this returns.
+
+        Returns:
+            Array of ids assigned to the documents.
+        """
+        if not documents:
+            return np.empty(0, dtype=np.int64)
+
+        term_ids, doc_offsets = [], [0]
+        with self._lock:
+            for document in documents:
+                for token in self.analyzer(document):
+                    term_ids.append(self.vocabulary.setdefault(token, len(self.vocabulary)))
+                doc_offsets.append(len(term_ids))
+
+            counts = scipy.sparse.csr_matrix((np.ones(len(term_ids)), term_ids, doc_offsets),
+                                             shape=(len(documents), len(self.vocabulary)))
+            counts.sum_duplicates()
+
+            doc_ids = np.arange(self.next_doc_id, self.next_doc_id + len(documents))
+            self._add_segment(Segment(doc_ids, counts))
+
+        self._maybe_merge()
+        return doc_ids
+
+    def delete_documents(self, doc_ids):
+        """ Remove documents from the index. Unknown or already deleted ids are ignored. """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        with self._lock:
+            for segment in self.segments:
+                if len(segment) == 0:
+                    continue
+                positions = np.minimum(np.searchsorted(segment.doc_ids, doc_ids), len(segment) - 1)
+                rows = np.unique(positions[segment.doc_ids[positions] == doc_ids])
+                rows = rows[~segment.deleted[rows]]
+                if len(rows) == 0:
+                    continue
+
+                df = segment.doc_freq(rows)
+                self.doc_freq[:len(df)] -= df
+                segment.deleted[rows] = True
+                self.doc_count -= len(rows)
+                self.generation += 1
+
+    def _add_segment(self, segment):
+        if len(self.doc_freq) < len(self.vocabulary):
+            self.doc_freq = np.concatenate([self.doc_freq,
+                                            np.zeros(len(self.vocabulary) - len(self.doc_freq), dtype=np.int64)])
+
+        df = segment.doc_freq()
+        self.doc_freq[:len(df)] += df
+        self.segments.append(segment)
+        self.doc_count += len(segment)
+        self.next_doc_id = max(self.next_doc_id, int(segment.doc_ids.max(initial=0)) + 1)
+        self.generation += 1
+
+    def _maybe_merge(self):
+        if len(self.segments) <= self.merge_factor:
+            return
+
+        if not self.merge_in_background:
+            self._merge_if_needed()
+        elif self._merge_thread is None or not self._merge_thread.is_alive():
+            self._merge_thread = threading.Thread(target=self._merge_if_needed, daemon=True)
+            self._merge_thread.start()
+
+    def _merge_if_needed(self):
+        with self._merge_lock:
+            if len(self.segments) > self.merge_factor:
+                self.merge()
+
+    def wait_for_merges(self):
+        """ Block until a running background merge is finished. """
+        if self._merge_thread is not None:
+            self._merge_thread.join()
+
+    def merge(self, segment_count=None):
+        """
+        Merge the smallest segments into one, dropping deleted documents. If another merge is running (e.g. in the
+        background), waits for it to finish and then selects the segments from the merged ones.
+
+        Args:
+            segment_count: Number of segments to merge, by default enough to get back to `merge_factor` segments
+                           (but at least two).
+        """
+        with self._merge_lock:
+            self._merge(segment_count)
+
+    def _merge(self, segment_count):
+        with self._lock:
+            if segment_count is None:
+                segment_count = max(2, len(self.segments) - self.merge_factor + 1)
+            merged = sorted(self.segments, key=len)[:segment_count]
+            if len(merged) < 2:
+                return
+            # Snapshot of deletions, deletions made while merging are applied at the end
+            deleted = [segment.deleted.copy() for segment in merged]
+            width = len(self.vocabulary)
+
+        # The expensive part runs without the lock, segments are immutable apart from deletion marks
+        rows, doc_ids = [], []
+        for segment, segment_deleted in zip(merged, deleted):
+            counts = segment.rows[~segment_deleted]
+            rows.append(scipy.sparse.csr_matrix((counts.data, counts.indices, counts.indptr),
+                                                shape=(counts.shape[0], width)))
+            doc_ids.append(segment.doc_ids[~segment_deleted])
+        doc_ids = np.concatenate(doc_ids)
+        order = np.argsort(doc_ids, kind="stable")
+        new_segment = Segment(doc_ids[order], scipy.sparse.vstack(rows, format="csr")[order])
+
+        with self._lock:
+            for segment, segment_deleted in zip(merged, deleted):
+                deleted_meanwhile = segment.doc_ids[segment.deleted & ~segment_deleted]
+                new_segment.deleted[np.searchsorted(new_segment.doc_ids, deleted_meanwhile)] = True
+            self.segments = [segment for segment in self.segments if not any(segment is m for m in merged)]
+            self.segments.append(new_segment)
+
+    def idf(self):
+        return np.log((1 + self.doc_count) / (1 + self.doc_freq)) + 1
+
+    def query_vector(self, query, weighting, idf=None):
+        """
+        Transform the query with the current vocabulary, see weight_query().
+
+        Returns:
+            Tuple (term ids, weights of the terms in the query).
+        """
+        with self._lock:
+            return weight_query(self.analyzer(query), self.vocabulary, weighting, self.idf() if idf is None else idf)
+
+    def rank(self, query, weighting, metric, limit=None):
+        """
+        Rank live documents of all segments by their similarity to the query.
+
+        Args:
+            query: Query string.
+            weighting: One of WEIGHTING_*.
+            metric: METRIC_EUCLIDEAN or METRIC_COSINE.
+            limit: Number of best documents to return, all documents if None.
+
+        Returns:
+            Array of document ids, best first.
+        """
+        # Segments and their deletions as of now, merges and deletions may change them while scoring
+        with self._lock:
+            segments = list(self.segments)
+            deleted = [segment.deleted.copy() for segment in segments]
+            idf = self.idf()
+            generation = self.generation
+            limit = self.doc_count if limit is None else min(limit, self.doc_count)
+            term_ids, query_weights = self.query_vector(query, weighting, idf)
+
+        doc_ids, scores = [], []
+        for segment, segment_deleted in zip(segments, deleted):
+            matched_rows, dots = segment.dot_products(term_ids, query_weights, weighting, idf, generation)
+            doc_norms = segment.norms[weighting]
+            # Enough documents without a common term to fill up the limit, even if some of them are deleted
+            fill_up = limit + len(matched_rows) + np.count_nonzero(segment_deleted)
+
+            if metric == METRIC_COSINE:
+                matched_scores = -dots / np.maximum(doc_norms[matched_rows] * np.linalg.norm(query_weights), 1e-12)
+                # Documents without a common term have zero similarity, keep them in document order
+                unmatched_rows = np.arange(min(fill_up, len(segment)))
+                unmatched_scores = np.zeros(len(unmatched_rows))
+            elif metric == METRIC_EUCLIDEAN:
+                matched_scores = doc_norms[matched_rows] ** 2 - 2 * dots
+                # Documents without a common term are only as far as their own norm
+                unmatched_rows = segment.docs_by_norm[weighting][:fill_up]
+                unmatched_scores = doc_norms[unmatched_rows] ** 2
+            else:
+                raise ValueError(f"Unknown metric: {metric}")
+
+            unmatched_mask = ~np.isin(unmatched_rows, matched_rows)
+            rows = np.concatenate([matched_rows, unmatched_rows[unmatched_mask]])
+            segment_scores = np.concatenate([matched_scores, unmatched_scores[unmatched_mask]])
+            live = ~segment_deleted[rows]
+            doc_ids.append(segment.doc_ids[rows[live]])
+            scores.append(segment_scores[live])
+
+        doc_ids = np.concatenate(doc_ids + [np.empty(0, dtype=np.int64)])
+        scores = np.concatenate(scores + [np.empty(0)])
+
+        order = np.lexsort((doc_ids, np.round(scores, SCORE_DECIMALS)))[:limit]
+        return doc_ids[order]
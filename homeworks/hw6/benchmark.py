@@ -0,0 +1,312 @@
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Tuple
+
+import numpy
+import scipy
+
+from recommender import Recommender, Evaluator
+
+BENCHMARK_DIR = "./benchmark"
+BENCHMARK_SIZES = (100000, 1000000, 10000000)
+BENCHMARK_REPORT_FILE = "report.json"
+BENCHMARK_REPORT_VERSION = 2
+DATASET_GENERATOR_VERSION = 1
+DATASET_META_FILE = "dataset.json"
+
+# Shape of ml-latest-small: 100k ratings, 671 users, 9066 movies
+SYNTHETIC_RATINGS_PER_USER = 150
+SYNTHETIC_MOVIES_100K = 9000
+SYNTHETIC_TESTING_FRACTION = 0.2
+SYNTHETIC_GENRES = ['Action', 'Adventure', 'Animation', 'Children', 'Comedy', 'Crime', 'Documentary', 'Drama',
+                    'Fantasy', 'Film-Noir', 'Horror', 'IMAX', 'Musical', 'Mystery', 'Romance', 'Sci-Fi', 'Thriller',
+                    'War', 'Western']
+SYNTHETIC_WRITE_CHUNK = 1 << 20
+
+LIMIT_RESULTS = 50
+TOP_N_USERS = 20
+
+
+def synthesize_dataset(directory, n_ratings: int, random_state=0) -> Dict:
+    """
+    Write a synthetic dataset in the MovieLens format of data/ to the directory: movies.csv, ratings.csv and its
+    random split to ratings-training.csv and ratings-testing.csv. Nothing is written if the directory already holds
+    the dataset of the same size, seed and generator version, so repeated runs use the same files.
+
+    The shape follows ml-latest-small scaled up: SYNTHETIC_RATINGS_PER_USER ratings per user on average with a heavy
+    tailed (log-normal) user activity, about SYNTHETIC_MOVIES_100K * (n_ratings / 100k)^0.3 movies with Zipf-like
+    popularity and one to three genres each (1% without genres), half-star ratings around 3.5 shifted by user and
+    movie biases.
+    :return: Dict with the numbers of users, movies and ratings (as stored in the meta file of the dataset).
+    """
+    meta_fn = os.path.join(directory, DATASET_META_FILE)
+    request = {"generator": DATASET_GENERATOR_VERSION, "requested_ratings": n_ratings, "random_state": random_state}
+    try:
+        with open(meta_fn) as f:
+            meta = json.load(f)
+        if all(meta.get(key) == value for key, value in request.items()):
+            return meta
+    except (OSError, ValueError):
+        pass
+
+    os.makedirs(directory, exist_ok=True)
+    rng = numpy.random.default_rng(random_state)
+    n_users = max(10, round(n_ratings / SYNTHETIC_RATINGS_PER_USER))
+    n_movies = max(100, round(SYNTHETIC_MOVIES_100K * (n_ratings / 100000) ** 0.3))
+
+    # Movie IDs have gaps like in MovieLens, most movies have few ratings and a few movies have many
+    movie_ids = numpy.sort(rng.choice(3 * n_movies, size=n_movies, replace=False) + 1)
+    popularity = 1 / numpy.arange(1, n_movies + 1) ** 0.9
+    popularity = rng.permutation(popularity / popularity.sum())
+    activity = rng.lognormal(0, 1.2, n_users)
+    activity /= activity.sum()
+
+    # Draw (user, movie) pairs until there are n_ratings distinct ones
+    pairs = numpy.zeros(0, dtype=numpy.int64)
+    while len(pairs) < min(n_ratings, n_users * n_movies):
+        missing = n_ratings - len(pairs)
+        drawn = rng.choice(n_users, size=missing, p=activity).astype(numpy.int64) * n_movies + \
+            rng.choice(n_movies, size=missing, p=popularity)
+        pairs = numpy.unique(numpy.concatenate((pairs, drawn)))
+    pairs = pairs[numpy.sort(rng.choice(len(pairs), size=min(n_ratings, len(pairs)), replace=False))]
+    user_idxs, movie_idxs = numpy.divmod(pairs, n_movies)
+
+    user_bias = rng.normal(0, 0.5, n_users)
+    movie_bias = rng.normal(0, 0.5, n_movies)
+    ratings = numpy.clip(numpy.round(2 * rng.normal(3.5 + user_bias[user_idxs] + movie_bias[movie_idxs], 0.8)) / 2,
+                         0.5, 5)
+    timestamps = rng.integers(946684800, 1483228800, size=len(pairs))  # 2000 - 2016
+    testing = rng.random(len(pairs)) < SYNTHETIC_TESTING_FRACTION
+
+    with open(os.path.join(directory, "movies.csv"), mode="w", encoding="utf-8", newline="") as f:
+        f.write("sep=,\nmovieId,title,genres\n")
+        genre_counts = rng.integers(1, 4, size=n_movies)
+        genre_counts[rng.random(n_movies) < 0.01] = 0
+        for movie_id, genre_count, year in zip(movie_ids.tolist(), genre_counts.tolist(),
+                                               rng.integers(1920, 2017, size=n_movies).tolist()):
+            genres = "|".join(sorted(rng.choice(SYNTHETIC_GENRES, size=genre_count, replace=False))) or \
+                "(no genres listed)"
+            f.write(f'{movie_id},"Movie {movie_id}, The ({year})",{genres}\n')  # Quoted title with a comma
+
+    columns = (user_idxs + 1, movie_ids[movie_idxs], ratings, timestamps)
+    for fn, selected in (("ratings.csv", slice(None)), ("ratings-training.csv", ~testing),
+                         ("ratings-testing.csv", testing)):
+        with open(os.path.join(directory, fn), mode="w", encoding="utf-8", newline="") as f:
+            f.write("sep=,\nuserId,movieId,rating,timestamp\n")
+            selected_columns = numpy.column_stack([column[selected] for column in columns])
+            for start in range(0, len(selected_columns), SYNTHETIC_WRITE_CHUNK):
+                numpy.savetxt(f, selected_columns[start:start + SYNTHETIC_WRITE_CHUNK], fmt="%d,%d,%.1f,%d")
+
+    meta = dict(request, users=len(numpy.unique(user_idxs)), movies=n_movies, ratings=len(pairs),
+                testing_ratings=int(testing.sum()))
+    with open(meta_fn, mode="w") as f:  # Written last, marks a complete dataset
+        json.dump(meta, f)
+    return meta
+
+
+def _max_rss_mb() -> float:
+    """
+    Peak resident set size of this process so far, in MB. It is a high-water mark of the whole process, so it is
+    cumulative over the stages benchmarked before, not the memory of the last stage alone.
+    """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2 ** 20 if sys.platform == "darwin" else max_rss / 1024  # Bytes on macOS, kilobytes elsewhere
+
+
+def _timed(stages: Dict, name: str, function: Callable, *args, **kwargs):
+    """ Call the function, record its time and the peak memory of the process so far as stage `name`. """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    stages[name] = {"seconds": time.perf_counter() - start, "max_rss_mb": _max_rss_mb()}
+    return result
+
+
+def _latencies(function: Callable, user_ids: List[int]) -> Dict:
+    """ Call function(user_id) for every user, return mean and percentiles of the call times in milliseconds. """
+    times = []
+    for user_id in user_ids:
+        start = time.perf_counter()
+        function(user_id)
+        times.append(time.perf_counter() - start)
+    times = numpy.array(times) * 1000
+    return {"requests": len(times), "mean_ms": times.mean(), "p50_ms": numpy.percentile(times, 50),
+            "p99_ms": numpy.percentile(times, 99)}
+
+
+def benchmark_dataset(directory, requests: int = 200, batch_users: int = 2000, evaluations: int = 20,
+                      random_state=0) -> Dict:
+    """
+    Benchmark the recommender on a dataset written by synthesize_dataset().
+    - stages: time and peak memory so far (cumulative over the stages, see _max_rss_mb()) of building the model
+      from the CSV files, saving and loading its snapshot, building the item neighbours, the factorization and the
+      user index, and building the Evaluator
+    - latency: per-request times of every recommendation system for `requests` random users
+    - throughput: users per second of recommend_all() (hybrid, in this process) for `batch_users` users
+    - evaluation: per-call times of Evaluator.evaluate() for `evaluations` random test users
+    """
+    with open(os.path.join(directory, DATASET_META_FILE)) as f:
+        result = {"dataset": json.load(f), "stages": {}, "latency": {}, "throughput": {}, "evaluation": {}}
+    stages = result["stages"]
+    rng = numpy.random.default_rng(random_state)
+    files = {name: os.path.join(directory, name + ".csv")
+             for name in ("movies", "ratings", "ratings-training", "ratings-testing")}
+
+    recommender = _timed(stages, "build", Recommender, files["movies"], files["ratings"])
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        _timed(stages, "save_snapshot", recommender.save, snapshot_dir)
+        _timed(stages, "load_snapshot", Recommender.load, snapshot_dir)
+    _timed(stages, "item_neighbours", recommender.build_item_neighbours)
+    _timed(stages, "factorization", recommender.train_factorization)
+    _timed(stages, "user_index", recommender.build_user_index)
+
+    user_ids = rng.choice(recommender.user_ids, size=requests).tolist()
+    latency_functions = {
+        "content": lambda user_id: recommender.recommend_content_based(user_id, LIMIT_RESULTS),
+        "collaborative": lambda user_id: recommender.recommend_collaborative_based(user_id, LIMIT_RESULTS,
+                                                                                   TOP_N_USERS),
+        "hybrid": lambda user_id: recommender.recommend_hybrid_based(user_id, LIMIT_RESULTS),
+        "item": lambda user_id: recommender.recommend_item_based(user_id, LIMIT_RESULTS),
+        "factorization": lambda user_id: recommender.recommend_factorization_based(user_id, LIMIT_RESULTS),
+    }
+    user_index, recommender.user_index = recommender.user_index, None
+    for name, function in latency_functions.items():
+        result["latency"][name] = _latencies(function, user_ids)
+    recommender.user_index = user_index
+    result["latency"]["collaborative_lsh"] = _latencies(latency_functions["collaborative"], user_ids)
+    recommender.user_index = None
+
+    batch_user_ids = rng.choice(recommender.user_ids, size=min(batch_users, len(recommender.user_ids)),
+                                replace=False).tolist()
+    with tempfile.TemporaryDirectory() as output_dir:
+        start = time.perf_counter()
+        recommender.recommend_all(os.path.join(output_dir, "recommendations.csv"), batch_user_ids,
+                                  limit_results=LIMIT_RESULTS, processes=1)
+        seconds = time.perf_counter() - start
+    result["throughput"]["recommend_all"] = {"users": len(batch_user_ids), "seconds": seconds,
+                                             "users_per_s": len(batch_user_ids) / seconds}
+    stages["recommend_all"] = {"seconds": seconds, "max_rss_mb": _max_rss_mb()}
+    del recommender
+
+    evaluator = _timed(stages, "evaluator", Evaluator, files["ratings-training"], files["ratings-testing"],
+                       files["movies"])
+    test_user_ids = [user_id for user_id in evaluator.testing_ratings.user_ids.tolist()
+                     if user_id in evaluator.recommender.user_id_to_idx]
+    test_user_ids = rng.choice(test_user_ids, size=min(evaluations, len(test_user_ids)), replace=False).tolist()
+    evaluate_params = {
+        "content": (Evaluator.RECOMMEND_SYSTEM_CONTENT_BASED, {}),
+        "collaborative": (Evaluator.RECOMMEND_SYSTEM_COLLABORATIVE_FILTERING, {"top_n_users": TOP_N_USERS}),
+        "hybrid": (Evaluator.RECOMMEND_SYSTEM_HYBRID, {"top_n_users": TOP_N_USERS, "weight_content_based": 0.3,
+                                                       "weight_collabr_based": 0.7}),
+    }
+    with contextlib.redirect_stdout(io.StringIO()):
+        for name, (recommend_type, params) in evaluate_params.items():
+            result["evaluation"][name] = _latencies(
+                lambda user_id: evaluator.evaluate(user_id, recommend_type, limit_results=LIMIT_RESULTS, **params),
+                test_user_ids)
+    stages["evaluation"] = {"seconds": sum(evaluation["mean_ms"] * evaluation["requests"] / 1000
+                                           for evaluation in result["evaluation"].values()),
+                            "max_rss_mb": _max_rss_mb()}
+
+    return result
+
+
+def _benchmark_size(data_dir, n_ratings: int, random_state, kwargs: Dict) -> Dict:
+    directory = os.path.join(data_dir, f"ml-synthetic-{n_ratings}-{random_state}")
+    start = time.perf_counter()
+    synthesize_dataset(directory, n_ratings, random_state)
+    synthesize_seconds = time.perf_counter() - start
+    result = benchmark_dataset(directory, random_state=random_state, **kwargs)
+    result["synthesize_seconds"] = synthesize_seconds
+    return result
+
+
+def run_benchmark(sizes: Tuple[int] = BENCHMARK_SIZES, data_dir=BENCHMARK_DIR, report_fn=None, random_state=0,
+                  **kwargs) -> Dict:
+    """
+    Synthesize datasets of the given numbers of ratings (cached in data_dir) and benchmark each of them in a fresh
+    process, so that the peak memory of a dataset does not include the previous ones. The JSON report is written to
+    report_fn (data_dir/BENCHMARK_REPORT_FILE if None).
+    :param kwargs: Parameters of benchmark_dataset().
+    """
+    report = {"version": BENCHMARK_REPORT_VERSION, "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+              "environment": {"python": platform.python_version(), "numpy": numpy.__version__,
+                              "scipy": scipy.__version__, "machine": platform.machine(), "system": platform.system(),
+                              "cpus": os.cpu_count()},
+              "parameters": {"limit_results": LIMIT_RESULTS, "top_n_users": TOP_N_USERS, "random_state": random_state,
+                             **kwargs},
+              "datasets": []}
+
+    for n_ratings in sizes:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            result = executor.submit(_benchmark_size, data_dir, n_ratings, random_state, kwargs).result()
+        report["datasets"].append(result)
+        print_dataset_result(result)
+
+    report_fn = os.path.join(data_dir, BENCHMARK_REPORT_FILE) if report_fn is None else report_fn
+    with open(report_fn, mode="w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {report_fn}")
+    return report
+
+
+def print_dataset_result(result: Dict):
+    dataset = result["dataset"]
+    print(f"{dataset['ratings']} ratings, {dataset['users']} users, {dataset['movies']} movies "
+          f"(synthesized in {result['synthesize_seconds']:.1f} s)")
+    for name, stage in result["stages"].items():
+        print(f"    {name:24} {stage['seconds']:9.3f} s   max RSS so far {stage['max_rss_mb']:8.1f} MB")
+    for group in ("latency", "evaluation"):
+        for name, latency in result[group].items():
+            print(f"    {group} {name:20} mean {latency['mean_ms']:8.2f} ms  p50 {latency['p50_ms']:8.2f} ms  "
+                  f"p99 {latency['p99_ms']:8.2f} ms")
+    for name, throughput in result["throughput"].items():
+        print(f"    throughput {name:17} {throughput['users_per_s']:9.1f} users/s")
+
+
+def compare_reports(baseline_fn, report_fn, tolerance: float = 0.2) -> List[str]:
+    """
+    Compare two benchmark reports dataset by dataset (matched by the number of ratings) and print times that grew
+    by more than `tolerance` (relative), and throughputs that dropped by more.
+    :return: List of the regressions found.
+    """
+    with open(baseline_fn) as f:
+        baseline = {dataset["dataset"]["ratings"]: dataset for dataset in json.load(f)["datasets"]}
+    with open(report_fn) as f:
+        report = json.load(f)
+
+    regressions = []
+    for dataset in report["datasets"]:
+        old = baseline.get(dataset["dataset"]["ratings"])
+        if old is None:
+            continue
+        measures = [(f"stages.{name}.seconds", old["stages"].get(name, {}).get("seconds"), stage["seconds"], False)
+                    for name, stage in dataset["stages"].items()]
+        measures += [(f"{group}.{name}.p99_ms", old[group].get(name, {}).get("p99_ms"), latency["p99_ms"], False)
+                     for group in ("latency", "evaluation") for name, latency in dataset[group].items()]
+        measures += [(f"throughput.{name}.users_per_s", old["throughput"].get(name, {}).get("users_per_s"),
+                      throughput["users_per_s"], True) for name, throughput in dataset["throughput"].items()]
+
+        for name, old_value, new_value, higher_is_better in measures:
+            if not old_value:
+                continue
+            change = new_value / old_value - 1
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"{dataset['dataset']['ratings']} ratings, {name}: {old_value:.4g} -> "
+                                   f"{new_value:.4g} ({change:+.0%})")
+
+    for regression in regressions:
+        print(regression)
+    return regressions
+
+
+if __name__ == '__main__':
+    run_benchmark()
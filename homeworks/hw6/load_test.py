@@ -0,0 +1,106 @@
+import asyncio
+import json
+import time
+from typing import List, Dict, Tuple
+
+import numpy
+
+from server import SERVER_HOST, SERVER_PORT
+
+
+async def request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, method: str, target: str,
+                  body: bytes = b"") -> Tuple[int, Dict]:
+    """ Send one HTTP/1.1 request over a kept-alive connection, return tuple (status, JSON payload). """
+    writer.write(f"{method} {target} HTTP/1.1\r\nHost: {SERVER_HOST}\r\nContent-Length: {len(body)}\r\n\r\n"
+                 .encode("latin-1") + body)
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line.strip():
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return status, json.loads(await reader.readexactly(int(headers["content-length"])))
+
+
+async def _client(host: str, port: int, targets: List[str], latencies: List[float], errors: List[int]):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for target in targets:
+            start = time.perf_counter()
+            status, _ = await request(reader, writer, "GET", target)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def load_test(user_ids: List[int], host: str = SERVER_HOST, port: int = SERVER_PORT, requests: int = 10000,
+                    concurrency: int = 64, query: str = "type=hybrid&limit=50", random_state=0) -> Dict:
+    """
+    Send `requests` recommend requests for random users from `concurrency` clients at once, each client sending its
+    next request as soon as it gets the answer to the previous one. The cache of the server is cleared first.
+    :param query: Query string of the requests, without user_id.
+    :return: Dict with throughput and latency percentiles (in milliseconds) of the requests, and the server stats
+             (counters of the test only).
+    """
+    rng = numpy.random.default_rng(random_state)
+    targets = [f"/recommend?user_id={user_id}&{query}" for user_id in rng.choice(user_ids, size=requests).tolist()]
+    latencies, errors = [], []
+
+    reader, writer = await asyncio.open_connection(host, port)
+    await request(reader, writer, "DELETE", "/cache")
+    _, stats_before = await request(reader, writer, "GET", "/stats")
+    writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[_client(host, port, targets[i::concurrency], latencies, errors)
+                           for i in range(concurrency)])
+    seconds = time.perf_counter() - start
+
+    reader, writer = await asyncio.open_connection(host, port)
+    _, stats = await request(reader, writer, "GET", "/stats")
+    writer.close()
+    for name in ("requests", "batches", "batched_users"):
+        stats[name] -= stats_before[name]
+    for name in ("hits", "misses"):
+        stats["cache"][name] -= stats_before["cache"][name]
+
+    latencies = numpy.array(latencies) * 1000
+    return {"query": query, "requests": requests, "concurrency": concurrency, "errors": len(errors), "seconds": seconds,
+            "throughput": requests / seconds, "mean_ms": latencies.mean(),
+            "p50_ms": numpy.percentile(latencies, 50), "p99_ms": numpy.percentile(latencies, 99),
+            "max_ms": latencies.max(), "server": stats}
+
+
+def print_load_test(result: Dict):
+    cache = result["server"]["cache"]
+    batches = max(result["server"]["batches"], 1)
+    print(f"{result['query']}: {result['requests']} requests, {result['concurrency']} concurrent, "
+          f"{result['errors']} errors, {result['seconds']:.2f} s")
+    print(f"Throughput: {result['throughput']:.1f} requests/s")
+    print(f"Latency: mean {result['mean_ms']:.2f} ms, p50 {result['p50_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms, "
+          f"max {result['max_ms']:.2f} ms")
+    print(f"Server: {result['server']['batches']} batches, {result['server']['batched_users'] / batches:.1f} users "
+          f"per batch, cache hits {cache['hits']}, misses {cache['misses']}")
+
+
+def run_load_test():
+    """
+    Load test a server started by server.py (on the same ratings). Requests for 200 recommendations are never cached
+    (see CACHE_CANDIDATES), so they show the effect of micro-batching alone.
+    """
+    user_ids = numpy.unique(numpy.loadtxt('data/ratings.csv', delimiter=',', skiprows=2, usecols=0, dtype=int)).tolist()
+    for query in ("type=hybrid&limit=50", "type=hybrid&limit=200"):
+        for concurrency in (1, 16, 64):
+            print_load_test(asyncio.run(load_test(user_ids, requests=2000, concurrency=concurrency, query=query,
+                                                  random_state=concurrency)))
+            print()
+
+
+if __name__ == '__main__':
+    run_load_test()
@@ -1,23 +1,128 @@
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 import csv
+import json
+import os
+import tempfile
+import time
 from typing import List, Dict, Tuple, Set
 from pprint import pprint
 
 import numpy
-from sklearn.metrics.pairwise import cosine_similarity
+import scipy.sparse
 
 numpy.set_printoptions(precision=2, linewidth=999)
 
 SKIP_GENRES = ['(no genres listed)']
 RATING_THRESHOLD = 2.5
 
+SNAPSHOT_DIR = "./snapshot"
+SNAPSHOT_FORMAT_VERSION = 4
+SNAPSHOT_META_FILE = "meta.json"
+SNAPSHOT_MOVIES_FILE = "movies.json"
+
+RECOMMEND_ALL_BLOCK_SIZE = 128
+ITEM_NEIGHBOURS = 50
+ITEM_NEIGHBOURS_BLOCK_SIZE = 256
+
+MF_FACTORS = 32
+MF_ITERATIONS = 15
+MF_REGULARIZATION = 0.1
+MF_CONFIDENCE = 1.0
+MF_CG_STEPS = 3
+MF_BLOCK_RATINGS = 1 << 18
+
+# Hyperparameters of MatrixFactorization, stored with its factors in snapshots
+MF_PARAMS = ["factors", "iterations", "regularization", "confidence", "cg_steps", "block_ratings", "random_state"]
+
+LSH_TABLES = 8
+LSH_BUCKET_SIZE = 16
+LSH_PROBES = 2
+LSH_STALE_FRACTION = 0.01
+LSH_HASH_BLOCK_SIZE = 1 << 16
+
+RATINGS_DELTA_FRACTION = 0.05
+
+# Measures of one grid search configuration at one cutoff, averaged over the evaluated users
+Grid_Result = namedtuple("Grid_Result", ["recommend_type", "params", "limit_results", "users", "precision", "recall",
+                                         "fmeasure", "map", "ndcg"])
+
+
+def top_k_indices(scores: numpy.ndarray, k: int) -> numpy.ndarray:
+    """
+    Return indices of the k highest scores, highest first (ties in index order). All indices if k <= 0 or k is greater
+    than number of scores.
+    """
+    if k <= 0 or k >= len(scores):
+        return numpy.argsort(-scores, kind="stable")
+
+    # Keep everything tied with the k-th score, so that ties are resolved by the index like in a full sort
+    kth_score = -numpy.partition(-scores, k - 1)[k - 1]
+    candidates = numpy.flatnonzero(scores >= kth_score)
+    return candidates[numpy.argsort(-scores[candidates], kind="stable")][:k]
+
+
+def replace_rows(matrix: scipy.sparse.csr_matrix, row_idxs: numpy.ndarray, rows: scipy.sparse.csr_matrix,
+                 n_rows: int = None) -> scipy.sparse.csr_matrix:
+    """
+    Return a copy of the CSR matrix with rows row_idxs replaced by the rows of `rows`.
+
+    Unchanged rows between the replaced ones are copied as contiguous slices, so apart from copying the arrays the
+    work only depends on the number of replaced rows.
+    :param row_idxs: Unique indices of the replaced rows.
+    :param rows: CSR matrix with one row for every index in row_idxs.
+    :param n_rows: Number of rows of the result, if the matrix grows (appended rows are empty unless replaced).
+    """
+    n_rows = matrix.shape[0] if n_rows is None else n_rows
+    row_idxs = numpy.asarray(row_idxs, dtype=int)
+    old_indptr = numpy.concatenate((matrix.indptr, numpy.full(n_rows - matrix.shape[0], matrix.nnz)))
+
+    lengths = numpy.diff(old_indptr)
+    lengths[row_idxs] = numpy.diff(rows.indptr)
+    indptr = numpy.zeros(n_rows + 1, dtype=numpy.int64)
+    numpy.cumsum(lengths, out=indptr[1:])
+
+    data_parts, indices_parts = [], []
+    previous_end = 0
+    for i in numpy.argsort(row_idxs).tolist():
+        row_idx = row_idxs[i]
+        data_parts += [matrix.data[previous_end:old_indptr[row_idx]], rows.data[rows.indptr[i]:rows.indptr[i + 1]]]
+        indices_parts += [matrix.indices[previous_end:old_indptr[row_idx]],
+                          rows.indices[rows.indptr[i]:rows.indptr[i + 1]]]
+        previous_end = old_indptr[row_idx + 1]
+    data_parts.append(matrix.data[previous_end:])
+    indices_parts.append(matrix.indices[previous_end:])
+
+    index_dtype = numpy.int32 if indptr[-1] <= numpy.iinfo(numpy.int32).max else numpy.int64
+    return scipy.sparse.csr_matrix((numpy.concatenate(data_parts).astype(matrix.dtype, copy=False),
+                                    numpy.concatenate(indices_parts).astype(index_dtype, copy=False),
+                                    indptr.astype(index_dtype, copy=False)),
+                                   shape=(n_rows, matrix.shape[1]))
+
+
+def _reserve_rows(buffer: numpy.ndarray, length: int, n_rows: int) -> numpy.ndarray:
+    """
+    Return a writable buffer of at least n_rows rows, whose first `length` rows are those of the given buffer and the
+    rest are zeros. The buffer itself is returned if it is writable and long enough, otherwise the rows are copied to
+    a new buffer of at least twice the length, so growing an array by appending rows costs amortized time
+    proportional to the appended rows. Users of the buffer keep its first rows in use as a view (buffer[:n_rows]).
+    """
+    if buffer.flags.writeable and len(buffer) >= n_rows:
+        return buffer
+    grown = numpy.zeros((max(n_rows, 2 * len(buffer)),) + buffer.shape[1:], dtype=buffer.dtype)
+    grown[:length] = buffer[:length]
+    return grown
+
 
 class User:
-    def __init__(self, user_id, genres_count):
+    """ View of a single user built on demand from the RatingsStore and genre profiles of a Recommender. """
+
+    def __init__(self, user_id, genre_ratings: numpy.ndarray, ratings: Dict[int, float]):
         super().__init__()
         self.id = user_id
-        self.genre_ratings = numpy.zeros(genres_count, dtype=int)  # Ratings of genres by the user, normalized to (0,1)
-        self.ratings: Dict[int, float] = {}  # Star-rating of given movies
-        self.movies_rated = set()
+        self.genre_ratings = genre_ratings  # Ratings of genres by the user, normalized to (0,1)
+        self.ratings = ratings  # Star-rating of given movies
+        self.movies_rated = set(ratings)
 
     def __repr__(self, *args, **kwargs):
         return "User[{}]: {}".format(self.id, self.genre_ratings)
@@ -45,20 +150,481 @@ class Movie:
         self.id = movie_id
         self.title = title
         self.genres = genres
-        self.genres_vector = None
-
-    def populate_genres_vector(self, genres_str_to_int: Dict[str, int]):
-        self.genres_vector = numpy.zeros(len(genres_str_to_int))
-        for genre in self.genres:
-            genre_id = genres_str_to_int[genre]
-            self.genres_vector[genre_id] = 1
-
-        self.genres_vector = self.genres_vector.reshape(1, -1)
 
     def __repr__(self, *args, **kwargs):
         return "{} ({},{})".format(self.title, self.id, self.genres)
 
 
+class RatingsStore:
+    """
+    Star-ratings of all users in one sparse (n_users, n_movies) CSR matrix with int32 movie indices and float32
+    ratings, instead of a dict and a set per user.
+
+    Rows are users in ascending order of their IDs (self.user_ids, users added by add_ratings() are appended), columns
+    are the movies given to the constructor (self.movie_ids), so the columns line up with the movie arrays of the
+    Recommender.
+
+    Rows changed by add_ratings() are kept aside as pending rows and merged into the CSR matrix only when the whole
+    matrix is needed (self.matrix) or when more than RATINGS_DELTA_FRACTION of the users are pending, so adding ratings
+    costs time proportional to the changed rows. Reads of single users and of blocks of users (user_row(), rows())
+    see the pending rows without merging them.
+    """
+
+    def __init__(self, user_ids: numpy.ndarray, movie_ids: numpy.ndarray, ratings: numpy.ndarray,
+                 all_movie_ids: numpy.ndarray):
+        """
+        :param user_ids: User ID of every rating.
+        :param movie_ids: Movie ID of every rating.
+        :param ratings: Star-rating of every rating. If a user rated a movie more times, the last rating is kept.
+        :param all_movie_ids: Sorted IDs of all movies, defines the columns.
+        """
+        super().__init__()
+        self.movie_ids = all_movie_ids
+        self.movie_id_to_idx = {int(movie_id): i for i, movie_id in enumerate(self.movie_ids)}
+        self.user_ids, user_idxs = numpy.unique(user_ids, return_inverse=True)
+        self.user_id_to_idx = {int(user_id): i for i, user_id in enumerate(self.user_ids)}
+        self._user_ids_buffer = self.user_ids  # self.user_ids is a view of its first rows, see _reserve_rows()
+
+        self._matrix = self._ratings_matrix(user_idxs, self._movie_indices(movie_ids), ratings, len(self.user_ids))
+        self._pending_rows: Dict[int, Tuple[numpy.ndarray, numpy.ndarray]] = {}  # user index -> (movie idxs, ratings)
+        self._column_stats: Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray] = None
+
+    def _movie_indices(self, movie_ids: numpy.ndarray) -> numpy.ndarray:
+        """ Map movie IDs to column indices, raise ValueError for unknown movies. """
+        movie_idxs = numpy.searchsorted(self.movie_ids, movie_ids)
+        unknown = (movie_idxs >= len(self.movie_ids)) | \
+            (self.movie_ids[numpy.minimum(movie_idxs, len(self.movie_ids) - 1)] != movie_ids)
+        if unknown.any():
+            raise ValueError(f"Ratings of unknown movies: {sorted(set(movie_ids[unknown].tolist()))[:10]}")
+        return movie_idxs
+
+    def _ratings_matrix(self, user_idxs: numpy.ndarray, movie_idxs: numpy.ndarray, ratings: numpy.ndarray,
+                        n_rows: int) -> scipy.sparse.csr_matrix:
+        """ Build CSR matrix of the ratings, the last of repeated ratings of a movie by a user is kept. """
+        # Sort by (user, movie), stable so the last of repeated ratings of a movie by a user ends last in its group
+        order = numpy.lexsort((movie_idxs, user_idxs))
+        user_idxs, movie_idxs, ratings = user_idxs[order], movie_idxs[order], ratings[order]
+        last = numpy.ones(len(order), dtype=bool)
+        last[:-1] = (user_idxs[1:] != user_idxs[:-1]) | (movie_idxs[1:] != movie_idxs[:-1])
+
+        indptr = numpy.zeros(n_rows + 1, dtype=numpy.int32)
+        numpy.cumsum(numpy.bincount(user_idxs[last], minlength=n_rows), out=indptr[1:])
+        return scipy.sparse.csr_matrix((ratings[last].astype(numpy.float32), movie_idxs[last].astype(numpy.int32),
+                                        indptr), shape=(n_rows, len(self.movie_ids)))
+
+    def add_ratings(self, user_ids: numpy.ndarray, movie_ids: numpy.ndarray, ratings: numpy.ndarray) -> \
+            Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        Add ratings, replacing earlier ratings of the same movie by the same user. Only rows of the users who rated
+        are rebuilt, new users are appended after the existing ones.
+        :return: Tuple (sorted indices of the users who rated, sorted indices of the rated movies).
+        """
+        movie_idxs = self._movie_indices(movie_ids)
+        new_user_ids = [user_id for user_id in numpy.unique(user_ids).tolist() if user_id not in self.user_id_to_idx]
+        if new_user_ids:
+            n_users = len(self.user_ids)
+            self.user_id_to_idx.update((user_id, n_users + i) for i, user_id in enumerate(new_user_ids))
+            self._user_ids_buffer = _reserve_rows(self._user_ids_buffer, n_users, n_users + len(new_user_ids))
+            self._user_ids_buffer[n_users:n_users + len(new_user_ids)] = new_user_ids
+            self.user_ids = self._user_ids_buffer[:n_users + len(new_user_ids)]
+
+        user_idxs = numpy.array([self.user_id_to_idx[user_id] for user_id in user_ids.tolist()], dtype=int)
+        changed_users = numpy.unique(user_idxs)
+
+        # Existing ratings of the changed users first, so the new ones replace them
+        old_rows = self.rows(changed_users)
+        old_users = numpy.repeat(numpy.arange(old_rows.shape[0]), numpy.diff(old_rows.indptr))
+        rows = self._ratings_matrix(numpy.concatenate((old_users, numpy.searchsorted(changed_users, user_idxs))),
+                                    numpy.concatenate((old_rows.indices, movie_idxs)),
+                                    numpy.concatenate((old_rows.data, ratings)), len(changed_users))
+
+        if self._column_stats is not None:
+            counts, sums, squares = self._column_stats
+            for sign, changed_rows in ((-1, old_rows), (1, rows)):
+                data = changed_rows.data.astype(float)
+                numpy.add.at(counts, changed_rows.indices, sign)
+                numpy.add.at(sums, changed_rows.indices, sign * data)
+                numpy.add.at(squares, changed_rows.indices, sign * data ** 2)
+
+        for i, user_idx in enumerate(changed_users.tolist()):
+            start, end = rows.indptr[i], rows.indptr[i + 1]
+            self._pending_rows[user_idx] = (rows.indices[start:end], rows.data[start:end])
+        if len(self._pending_rows) > RATINGS_DELTA_FRACTION * len(self.user_ids):
+            self._merge_pending_rows()
+
+        return changed_users, numpy.unique(movie_idxs)
+
+    def _merge_pending_rows(self):
+        """ Rebuild the CSR matrix with the pending rows (one copy of the matrix for all of them). """
+        row_idxs = numpy.array(list(self._pending_rows), dtype=int)
+        self._matrix = replace_rows(self._matrix, row_idxs, self._pending_matrix(row_idxs), len(self.user_ids))
+        self._pending_rows = {}
+
+    def _pending_matrix(self, row_idxs: numpy.ndarray) -> scipy.sparse.csr_matrix:
+        """ Return CSR matrix of the pending rows of the given users (empty rows for users without one). """
+        empty = (numpy.empty(0, dtype=numpy.int32), numpy.empty(0, dtype=numpy.float32))
+        rows = [self._pending_rows.get(row_idx, empty) for row_idx in row_idxs.tolist()]
+        indptr = numpy.zeros(len(rows) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(indices) for indices, _ in rows], out=indptr[1:])
+        return scipy.sparse.csr_matrix((numpy.concatenate([data for _, data in rows] + [empty[1]]),
+                                        numpy.concatenate([indices for indices, _ in rows] + [empty[0]]), indptr),
+                                       shape=(len(rows), len(self.movie_ids)))
+
+    @property
+    def matrix(self) -> scipy.sparse.csr_matrix:
+        """ CSR matrix of all ratings, pending rows of add_ratings() are merged first. """
+        if self._pending_rows:
+            self._merge_pending_rows()
+        return self._matrix
+
+    def rows(self, user_idxs: numpy.ndarray) -> scipy.sparse.csr_matrix:
+        """ Return (len(user_idxs), n_movies) CSR matrix of ratings of the given users, pending rows are not merged. """
+        user_idxs = numpy.asarray(user_idxs, dtype=int)
+        in_matrix = user_idxs < self._matrix.shape[0]
+        if self._pending_rows:
+            in_matrix &= numpy.array([user_idx not in self._pending_rows for user_idx in user_idxs.tolist()],
+                                     dtype=bool)
+        rows = self._matrix[numpy.where(in_matrix, user_idxs, 0)] if self._matrix.shape[0] else \
+            scipy.sparse.csr_matrix((len(user_idxs), len(self.movie_ids)), dtype=numpy.float32)
+        if in_matrix.all():
+            return rows
+        return replace_rows(rows, numpy.flatnonzero(~in_matrix), self._pending_matrix(user_idxs[~in_matrix]))
+
+    @property
+    def column_stats(self) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        """
+        Tuple (number of ratings, sum of ratings, sum of squared ratings) of every movie, counted over the whole matrix
+        once and then kept up to date by add_ratings().
+        """
+        if self._column_stats is None:
+            matrix = self.matrix
+            data = matrix.data.astype(float)
+            self._column_stats = (numpy.bincount(matrix.indices, minlength=len(self.movie_ids)),
+                                  numpy.bincount(matrix.indices, weights=data, minlength=len(self.movie_ids)),
+                                  numpy.bincount(matrix.indices, weights=data ** 2, minlength=len(self.movie_ids)))
+        return self._column_stats
+
+    def column_norms(self) -> numpy.ndarray:
+        """ Return length of the ratings column of every movie. """
+        return numpy.sqrt(numpy.maximum(self.column_stats[2], 0))
+
+    @classmethod
+    def from_matrix(cls, matrix: scipy.sparse.csr_matrix, user_ids: numpy.ndarray,
+                    all_movie_ids: numpy.ndarray) -> 'RatingsStore':
+        """ Wrap an already built (n_users, n_movies) CSR matrix of ratings, e.g. memory-mapped from a snapshot. """
+        store = cls.__new__(cls)
+        store._matrix = matrix
+        store._pending_rows = {}
+        store._column_stats = None
+        store.user_ids = user_ids
+        store._user_ids_buffer = user_ids
+        store.user_id_to_idx = {user_id: i for i, user_id in enumerate(user_ids.tolist())}
+        store.movie_ids = all_movie_ids
+        store.movie_id_to_idx = {movie_id: i for i, movie_id in enumerate(all_movie_ids.tolist())}
+        return store
+
+    @classmethod
+    def read_csv(cls, ratings_csv_fn, all_movie_ids: numpy.ndarray) -> 'RatingsStore':
+        """
+        Read ratings from a CSV file of "userId,movieId,rating[,...]" rows with a vectorized parser. Leading lines
+        that are not ratings ("sep=," and/or the header) are skipped.
+        """
+        with open(ratings_csv_fn, encoding="utf-8") as f:
+            skip_lines = 0
+            for line in iter(f.readline, ''):
+                if line[:1].isdigit():
+                    break
+                skip_lines += 1
+            f.seek(0)
+            data = numpy.loadtxt(f, delimiter=',', skiprows=skip_lines, usecols=(0, 1, 2), ndmin=1,
+                                 dtype=[('user', numpy.int64), ('movie', numpy.int64), ('rating', numpy.float32)])
+
+        return cls(data['user'], data['movie'], data['rating'], all_movie_ids)
+
+    def __len__(self):
+        """ Number of ratings. """
+        return int(self.column_stats[0].sum())
+
+    def __contains__(self, user_id):
+        return user_id in self.user_id_to_idx
+
+    def user_row(self, user_id: int) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """ Return (movie indices, ratings) arrays of the user, ordered by movie index. """
+        user_idx = self.user_id_to_idx[user_id]
+        if user_idx in self._pending_rows:
+            return self._pending_rows[user_idx]
+        start, end = self._matrix.indptr[user_idx], self._matrix.indptr[user_idx + 1]
+        return self._matrix.indices[start:end], self._matrix.data[start:end]
+
+    def ratings(self, user_id: int) -> Dict[int, float]:
+        """ Return dict of {movie_id: rating} of the user. """
+        movie_idxs, ratings = self.user_row(user_id)
+        return dict(zip(self.movie_ids[movie_idxs].tolist(), ratings.tolist()))
+
+    def movies_rated(self, user_id: int) -> Set[int]:
+        """ Return set of IDs of movies rated by the user. """
+        return set(self.movie_ids[self.user_row(user_id)[0]].tolist())
+
+    def rating(self, user_id: int, movie_id: int) -> float:
+        """ Return rating of the movie by the user, NaN if the user did not rate it. """
+        movie_idxs, ratings = self.user_row(user_id)
+        movie_idx = self.movie_id_to_idx[movie_id]
+        i = numpy.searchsorted(movie_idxs, movie_idx)
+        return float(ratings[i]) if i < len(movie_idxs) and movie_idxs[i] == movie_idx else float('nan')
+
+
+class MatrixFactorization:
+    """
+    Latent factor model for implicit feedback (Hu, Koren, Volinsky: Collaborative Filtering for Implicit Feedback
+    Datasets) trained by alternating least squares.
+
+    A rating is an observed preference of 1 with confidence 1 + MF_CONFIDENCE * rating, missing ratings are
+    preferences of 0 with confidence 1. Every least squares step is solved approximately by a few steps of conjugate
+    gradient started from the current factors (Takacs, Pilaszy, Tikk: Applications of the conjugate gradient method
+    for implicit feedback collaborative filtering). Conjugate gradient runs for a whole block of users (or items) at
+    once, so the work is dense products with the factor matrices (multi-threaded by BLAS) and sparse products over
+    the ratings of the block.
+    """
+
+    def __init__(self, factors: int = MF_FACTORS, iterations: int = MF_ITERATIONS,
+                 regularization: float = MF_REGULARIZATION, confidence: float = MF_CONFIDENCE,
+                 cg_steps: int = MF_CG_STEPS, block_ratings: int = MF_BLOCK_RATINGS, random_state=0):
+        """
+        :param factors: Number of latent factors.
+        :param iterations: Number of ALS iterations (each updates user factors and then item factors).
+        :param regularization: L2 regularization of the factors.
+        :param confidence: Confidence of an observed rating is 1 + confidence * rating.
+        :param cg_steps: Number of conjugate gradient steps of every least squares step.
+        :param block_ratings: Approximate number of ratings of a block of users (items) updated at once.
+        """
+        super().__init__()
+        self.factors = factors
+        self.iterations = iterations
+        self.regularization = regularization
+        self.confidence = confidence
+        self.cg_steps = cg_steps
+        self.block_ratings = block_ratings
+        self.random_state = random_state
+
+        self.user_factors: numpy.ndarray = None  # (n_users, factors)
+        self.item_factors: numpy.ndarray = None  # (n_movies, factors)
+        self._user_factors_buffer: numpy.ndarray = None  # self.user_factors is a view of its first rows
+
+    def fit(self, ratings: scipy.sparse.csr_matrix) -> 'MatrixFactorization':
+        """ Train the factors on the (n_users, n_movies) matrix of ratings. """
+        confidences = scipy.sparse.csr_matrix(ratings, dtype=numpy.float32, copy=True)
+        confidences.data *= self.confidence
+        confidences_t = confidences.T.tocsr()
+
+        rng = numpy.random.default_rng(self.random_state)
+        self.user_factors = rng.normal(0, 0.01, (ratings.shape[0], self.factors)).astype(numpy.float32)
+        self.item_factors = rng.normal(0, 0.01, (ratings.shape[1], self.factors)).astype(numpy.float32)
+        self._user_factors_buffer = self.user_factors
+
+        for _ in range(self.iterations):
+            self._least_squares(confidences, self.user_factors, self.item_factors)
+            self._least_squares(confidences_t, self.item_factors, self.user_factors)
+
+        return self
+
+    def update_users(self, user_idxs: numpy.ndarray, ratings: scipy.sparse.csr_matrix, n_users: int):
+        """
+        Recompute factors of the given users from their current rows of ratings with the item factors fixed (users
+        not seen before start from zero factors).
+        :param n_users: Number of all users, factors of new users are appended.
+        """
+        self._user_factors_buffer = _reserve_rows(self._user_factors_buffer, len(self.user_factors), n_users)
+        self.user_factors = self._user_factors_buffer[:n_users]
+        confidences = scipy.sparse.csr_matrix(ratings, dtype=numpy.float32, copy=True)
+        confidences.data *= self.confidence
+
+        user_factors = self.user_factors[user_idxs]
+        self._least_squares(confidences, user_factors, self.item_factors)
+        self.user_factors[user_idxs] = user_factors
+
+    def _least_squares(self, confidences: scipy.sparse.csr_matrix, x: numpy.ndarray, y: numpy.ndarray):
+        """
+        Update rows of x in place, to minimize the loss with y fixed. For a row u the system is
+        (Y^T C_u Y + reg * I) x_u = Y^T C_u p_u, with Y^T C_u Y = Y^T Y + Y^T (C_u - I) Y, where only the rated items
+        contribute to the second term (confidences holds C_u - I of them).
+        """
+        gramian = y.T @ y + self.regularization * numpy.eye(self.factors, dtype=numpy.float32)
+
+        start = 0
+        while start < confidences.shape[0]:
+            end = max(start + 1, numpy.searchsorted(confidences.indptr, confidences.indptr[start] + self.block_ratings,
+                                                    side="right") - 1)
+            block = confidences[start:end]
+            rows = numpy.repeat(numpy.arange(end - start), numpy.diff(block.indptr))
+            rated_factors = y[block.indices]
+
+            def product(v):
+                """ Multiply every row of v by the matrix of its system. """
+                dots = numpy.einsum("ij,ij->i", v[rows], rated_factors) * block.data
+                return v @ gramian + scipy.sparse.csr_matrix((dots, block.indices, block.indptr), shape=block.shape) @ y
+
+            x_block = x[start:end]
+            # Right-hand side sum of c_ui * y_i over rated items, c_ui = 1 + confidences[u, i]
+            residual = scipy.sparse.csr_matrix((block.data + 1, block.indices, block.indptr), shape=block.shape) @ y \
+                - product(x_block)
+            direction = residual.copy()
+            residual_norms = numpy.einsum("ij,ij->i", residual, residual)
+            for _ in range(self.cg_steps):
+                projected = product(direction)
+                step = numpy.divide(residual_norms, numpy.einsum("ij,ij->i", direction, projected),
+                                    out=numpy.zeros_like(residual_norms), where=residual_norms > 0)
+                x_block += step[:, None] * direction
+                residual -= step[:, None] * projected
+                new_residual_norms = numpy.einsum("ij,ij->i", residual, residual)
+                direction = residual + numpy.divide(new_residual_norms, residual_norms,
+                                                    out=numpy.zeros_like(residual_norms),
+                                                    where=residual_norms > 0)[:, None] * direction
+                residual_norms = new_residual_norms
+
+            start = end
+
+
+class UserLSHIndex:
+    """
+    Approximate nearest neighbour index of users by cosine similarity of their profile vectors (random projection
+    locality sensitive hashing).
+
+    Every one of the `tables` hash tables maps a vector to the signs of its projections on `bits` random hyperplanes
+    (vectors are centered by the mean vector first, profiles are non-negative and would mostly fall on the same side).
+    Users of a table are kept sorted by their hash, so a bucket is a slice found by binary search. A query takes users
+    from its bucket in every table and from `probes` neighbouring buckets (the hash with one of the least certain bits
+    flipped) and only these candidates are scored exactly. More tables and probes mean better recall and higher
+    latency, more bits mean smaller buckets (by default there are about LSH_BUCKET_SIZE users per bucket).
+
+    Users changed by update() are scored for every query until the tables are sorted again, which happens once they
+    make LSH_STALE_FRACTION of all users, so an update only hashes the changed users.
+    """
+
+    def __init__(self, vectors: numpy.ndarray, norms: numpy.ndarray, tables: int = LSH_TABLES, bits: int = None,
+                 probes: int = LSH_PROBES, random_state=0):
+        """
+        :param vectors: (n_users, dimensions) matrix of profile vectors.
+        :param norms: Norms of the vectors.
+        :param tables: Number of hash tables.
+        :param bits: Number of hyperplanes (hash bits) of every table, at most 62. If None, log2 of the number of users
+                     per LSH_BUCKET_SIZE.
+        :param probes: Number of neighbouring buckets searched in every table besides the bucket of the query.
+        """
+        super().__init__()
+        if bits is None:
+            bits = int(numpy.clip(numpy.round(numpy.log2(max(len(vectors), 1) / LSH_BUCKET_SIZE)), 1, 62))
+        self.tables = tables
+        self.bits = bits
+        self.probes = probes
+        self.vectors = vectors
+        self.norms = norms
+
+        rng = numpy.random.default_rng(random_state)
+        self.planes = rng.normal(size=(tables, bits, vectors.shape[1]))
+        self.center = vectors.mean(axis=0) if len(vectors) else numpy.zeros(vectors.shape[1])
+        self.codes = numpy.concatenate([self._hash(self._projections(vectors[start:start + LSH_HASH_BLOCK_SIZE]))
+                                        for start in range(0, len(vectors), LSH_HASH_BLOCK_SIZE)] or
+                                       [numpy.zeros((0, tables), dtype=numpy.int64)])  # (n_users, tables)
+        self._codes_buffer = self.codes  # self.codes is a view of its first rows, see _reserve_rows()
+        self._sort()
+
+    @classmethod
+    def from_arrays(cls, vectors: numpy.ndarray, norms: numpy.ndarray, planes: numpy.ndarray, center: numpy.ndarray,
+                    codes: numpy.ndarray, members: numpy.ndarray, sorted_codes: numpy.ndarray,
+                    probes: int = LSH_PROBES) -> 'UserLSHIndex':
+        """ Create the index from arrays of a sorted index (e.g. memory-mapped from a snapshot), without hashing. """
+        index = cls.__new__(cls)
+        index.tables, index.bits = planes.shape[:2]
+        index.probes = probes
+        index.vectors, index.norms = vectors, norms
+        index.planes, index.center = planes, center
+        index.codes, index.members, index.sorted_codes = codes, members, sorted_codes
+        index._codes_buffer = codes
+        index.stale = index._stale_buffer = numpy.zeros(0, dtype=int)
+        return index
+
+    def _projections(self, vectors: numpy.ndarray) -> numpy.ndarray:
+        """ Return (n_vectors, tables, bits) projections of the centered vectors on the hyperplanes. """
+        return numpy.einsum("tbd,nd->ntb", self.planes, vectors - self.center)
+
+    def _hash(self, projections: numpy.ndarray) -> numpy.ndarray:
+        """ Return (n_vectors, tables) hash codes, bit b of a code is set if the projection on hyperplane b is > 0. """
+        return (projections > 0).astype(numpy.int64) @ (1 << numpy.arange(self.bits, dtype=numpy.int64))
+
+    def _sort(self):
+        """ Sort users of every table by their codes, no user is stale afterwards. """
+        self.members = numpy.argsort(self.codes.T, axis=1, kind="stable")  # (tables, n_users)
+        self.sorted_codes = numpy.take_along_axis(self.codes.T, self.members, axis=1)
+        self.stale = self._stale_buffer = numpy.zeros(0, dtype=int)
+
+    def update(self, vectors: numpy.ndarray, norms: numpy.ndarray, row_idxs: numpy.ndarray):
+        """
+        Rehash the given users after their vectors changed (hyperplanes and centering stay the same).
+        :param vectors: All current vectors, rows beyond the indexed ones are new users.
+        :param norms: Their norms.
+        :param row_idxs: Indices of the changed (or new) users.
+        """
+        self.vectors, self.norms = vectors, norms
+        self._codes_buffer = _reserve_rows(self._codes_buffer, len(self.codes), len(vectors))
+        self.codes = self._codes_buffer[:len(vectors)]
+        self.codes[row_idxs] = self._hash(self._projections(vectors[row_idxs]))
+
+        # Appended without removing duplicates (search() removes them), so an update does not copy the stale users
+        n_stale = len(self.stale)
+        self._stale_buffer = _reserve_rows(self._stale_buffer, n_stale, n_stale + len(row_idxs))
+        self._stale_buffer[n_stale:n_stale + len(row_idxs)] = row_idxs
+        self.stale = self._stale_buffer[:n_stale + len(row_idxs)]
+        if len(self.stale) > LSH_STALE_FRACTION * len(vectors):
+            self._sort()
+
+    def search(self, query_vectors: numpy.ndarray, limit: int, exclude: numpy.ndarray = None,
+               probes: int = None) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        Find approximately most similar users for every query vector. Users of all tables are searched if the
+        probed buckets do not hold `limit` candidates.
+        :param query_vectors: (n_queries, dimensions) matrix.
+        :param limit: Number of users to return for every query.
+        :param exclude: User index to leave out of the result of every query (e.g. the querying user itself).
+        :param probes: Overrides the number of probed neighbouring buckets of the index.
+        :return: Tuple (user indices, cosine similarities), both (n_queries, limit) matrices with rows sorted in
+                 descending order based on similarity (ties in index order).
+        """
+        n_users = len(self.vectors)
+        probes = min(self.probes if probes is None else probes, self.bits)
+        limit = min(limit, n_users - (exclude is not None))
+
+        projections = self._projections(query_vectors)
+        codes = self._hash(projections)
+        flipped_bits = numpy.argsort(numpy.abs(projections), axis=2)[:, :, :probes]
+        probe_codes = numpy.concatenate((codes[:, :, None], codes[:, :, None] ^ (1 << flipped_bits)), axis=2)
+        query_norms = numpy.linalg.norm(query_vectors, axis=1)
+
+        neighbours = numpy.empty((len(query_vectors), limit), dtype=int)
+        similarities = numpy.empty((len(query_vectors), limit))
+        for i, query in enumerate(query_vectors):
+            starts = [numpy.searchsorted(self.sorted_codes[t], probe_codes[i, t], side="left")
+                      for t in range(self.tables)]
+            ends = [numpy.searchsorted(self.sorted_codes[t], probe_codes[i, t], side="right")
+                    for t in range(self.tables)]
+            candidates = numpy.sort(numpy.concatenate(
+                [self.stale] + [self.members[t, start:end] for t in range(self.tables)
+                                for start, end in zip(starts[t].tolist(), ends[t].tolist())]))
+            candidates = candidates[numpy.concatenate(([True], candidates[1:] != candidates[:-1]))]  # unique
+            if exclude is not None:
+                candidates = candidates[candidates != exclude[i]]
+            if len(candidates) < limit:
+                candidates = numpy.arange(n_users) if exclude is None else numpy.delete(numpy.arange(n_users),
+                                                                                          exclude[i])
+
+            norms = self.norms[candidates] * query_norms[i]
+            candidate_similarities = numpy.divide(self.vectors[candidates] @ query, norms,
+                                                  out=numpy.zeros(len(candidates)), where=norms > 0)
+            best = top_k_indices(candidate_similarities, limit)[:limit]
+            neighbours[i], similarities[i] = candidates[best], candidate_similarities[best]
+
+        return neighbours, similarities
+
+
 class Recommender:
     def __init__(self, movies_csv, ratings_csv):
         super().__init__()
@@ -70,28 +636,328 @@ class Recommender:
         self.movies, self.genres_list = self._read_movies()
         self.genre_str_to_id = {genre: i for i, genre in enumerate(self.genres_list)}
         self.genre_id_to_str = {i: genre for i, genre in enumerate(self.genres_list)}
-        for movie in self.movies.values():
-            movie.populate_genres_vector(self.genre_str_to_id)
+        self._build_movie_genres()
+
+        self.ratings: RatingsStore = self._read_ratings(self.ratings_csv_fn)
+        self.user_ids = self.ratings.user_ids
+        self.user_id_to_idx = self.ratings.user_id_to_idx
+        self._build_user_profiles()
+        self.ratings_updated = False  # ratings were added by add_ratings(), the model differs from the source files
+
+        # Sparse (n_movies, n_movies) top-K item-item similarities, see build_item_neighbours()
+        self.item_neighbours: scipy.sparse.csr_matrix = None
+        self.item_neighbours_k: int = None
+        # Movies whose rating columns changed by add_ratings(), see refresh_item_neighbours()
+        self._dirty_item_neighbours: Set[int] = set()
+        # Latent factor model, see train_factorization()
+        self.factorization: MatrixFactorization = None
+        # Approximate nearest neighbour index of user profiles, see build_user_index()
+        self.user_index: UserLSHIndex = None
+
+    @staticmethod
+    def _sources_stamp(movies_csv, ratings_csv) -> List[List]:
+        """ Identify versions of the source files by their paths, sizes and modification times. """
+        return [[os.path.abspath(fn), os.stat(fn).st_size, os.stat(fn).st_mtime_ns] for fn in (movies_csv, ratings_csv)]
+
+    def save(self, directory):
+        """
+        Store the fully built model to the directory: arrays (genre matrix, ratings CSR, user profiles, the item
+        neighbours, latent factors and user index if they were built) as .npy files that load() memory-maps, movie
+        titles, genres and hyperparameters of the latent factor model as JSON.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.refresh_item_neighbours()
+
+        arrays = {
+            "movie_ids": self.movie_ids,
+            "movie_genres_data": self.movie_genres.data,
+            "movie_genres_indices": self.movie_genres.indices,
+            "movie_genres_indptr": self.movie_genres.indptr,
+            "movie_genre_norms": self.movie_genre_norms,
+            "user_ids": self.user_ids,
+            "ratings_data": self.ratings.matrix.data,
+            "ratings_indices": self.ratings.matrix.indices,
+            "ratings_indptr": self.ratings.matrix.indptr,
+            "user_profiles": self.user_profiles,
+            "user_profile_norms": self.user_profile_norms,
+        }
+        if self.item_neighbours is not None:
+            arrays.update({
+                "item_neighbours_data": self.item_neighbours.data,
+                "item_neighbours_indices": self.item_neighbours.indices,
+                "item_neighbours_indptr": self.item_neighbours.indptr,
+            })
+        if self.factorization is not None:
+            arrays.update({
+                "user_factors": self.factorization.user_factors,
+                "item_factors": self.factorization.item_factors,
+            })
+        if self.user_index is not None:
+            if len(self.user_index.stale):
+                self.user_index._sort()
+            arrays.update({
+                "user_index_planes": self.user_index.planes,
+                "user_index_center": self.user_index.center,
+                "user_index_codes": self.user_index.codes,
+                "user_index_members": self.user_index.members,
+                "user_index_sorted_codes": self.user_index.sorted_codes,
+            })
+        for name, array in arrays.items():
+            numpy.save(os.path.join(directory, name + ".npy"), array)
+
+        with open(os.path.join(directory, SNAPSHOT_MOVIES_FILE), mode="w", encoding="utf-8") as f:
+            json.dump([[self.movies[movie_id].title, self.movies[movie_id].genres]
+                       for movie_id in self.movie_ids.tolist()], f)
+        # Written last, marks a complete snapshot
+        with open(os.path.join(directory, SNAPSHOT_META_FILE), mode="w") as f:
+            json.dump({"version": SNAPSHOT_FORMAT_VERSION,
+                       "sources": None if self.ratings_updated else self._sources_stamp(self.movies_csv_fn,
+                                                                                        self.ratings_csv_fn),
+                       "genres": self.genres_list,
+                       "item_neighbours_k": self.item_neighbours_k,
+                       "user_index_probes": self.user_index.probes if self.user_index is not None else None,
+                       "factorization": {name: getattr(self.factorization, name) for name in MF_PARAMS}
+                       if self.factorization is not None else None,
+                       "arrays": list(arrays)}, f)
+
+    @classmethod
+    def is_saved(cls, directory, movies_csv=None, ratings_csv=None) -> bool:
+        """
+        Return True if the directory contains a snapshot in the current format (and built from the current versions
+        of the given source files, without ratings added later).
+        """
+        try:
+            with open(os.path.join(directory, SNAPSHOT_META_FILE)) as f:
+                meta = json.load(f)
+            sources = cls._sources_stamp(movies_csv, ratings_csv) if movies_csv and ratings_csv else None
+        except (OSError, ValueError):
+            return False
+
+        return meta.get("version") == SNAPSHOT_FORMAT_VERSION and (sources is None or meta.get("sources") == sources)
+
+    @classmethod
+    def load(cls, directory) -> 'Recommender':
+        """
+        Open a model stored by save(). Arrays are memory-mapped read-only, so nothing is parsed or recomputed and
+        processes loading the same snapshot share its pages.
+        """
+        with open(os.path.join(directory, SNAPSHOT_META_FILE)) as f:
+            meta = json.load(f)
+        if meta["version"] != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(f"Unsupported snapshot format version: {meta['version']}")
+        with open(os.path.join(directory, SNAPSHOT_MOVIES_FILE), encoding="utf-8") as f:
+            movies = json.load(f)
+
+        arrays = {name: numpy.load(os.path.join(directory, name + ".npy"), mmap_mode="r") for name in meta["arrays"]}
+
+        recommender = cls.__new__(cls)
+        recommender.ratings_updated = meta["sources"] is None
+        recommender.movies_csv_fn, recommender.ratings_csv_fn = [source[0] for source in meta["sources"]] \
+            if meta["sources"] else (None, None)
+        recommender.genres_list = meta["genres"]
+        recommender.genre_str_to_id = {genre: i for i, genre in enumerate(recommender.genres_list)}
+        recommender.genre_id_to_str = {i: genre for i, genre in enumerate(recommender.genres_list)}
+
+        recommender.movie_ids = arrays["movie_ids"]
+        recommender.movie_id_to_idx = {movie_id: i for i, movie_id in enumerate(recommender.movie_ids.tolist())}
+        recommender.movie_genres = scipy.sparse.csr_matrix(
+            (arrays["movie_genres_data"], arrays["movie_genres_indices"], arrays["movie_genres_indptr"]),
+            shape=(len(recommender.movie_ids), len(recommender.genres_list)))
+        recommender.movie_genre_norms = arrays["movie_genre_norms"]
+        recommender.movies = {movie_id: Movie(movie_id, title, genres)
+                              for movie_id, (title, genres) in zip(recommender.movie_ids.tolist(), movies)}
+
+        recommender.ratings = RatingsStore.from_matrix(
+            scipy.sparse.csr_matrix((arrays["ratings_data"], arrays["ratings_indices"], arrays["ratings_indptr"]),
+                                    shape=(len(arrays["user_ids"]), len(recommender.movie_ids))),
+            arrays["user_ids"], recommender.movie_ids)
+        recommender.user_ids = recommender.ratings.user_ids
+        recommender.user_id_to_idx = recommender.ratings.user_id_to_idx
+        recommender.user_profiles = recommender._user_profiles_buffer = arrays["user_profiles"]
+        recommender.user_profile_norms = recommender._user_profile_norms_buffer = arrays["user_profile_norms"]
+
+        recommender.item_neighbours = None
+        recommender.item_neighbours_k = meta["item_neighbours_k"]
+        recommender._dirty_item_neighbours = set()
+        if "item_neighbours_data" in arrays:
+            recommender.item_neighbours = scipy.sparse.csr_matrix(
+                (arrays["item_neighbours_data"], arrays["item_neighbours_indices"], arrays["item_neighbours_indptr"]),
+                shape=(len(recommender.movie_ids), len(recommender.movie_ids)))
+
+        recommender.factorization = None
+        if "user_factors" in arrays:
+            params = meta["factorization"]
+            # The factors must have been trained with the stored hyperparameters, or folding in new ratings would
+            # solve a different model
+            if params is None or sorted(params) != sorted(MF_PARAMS) or \
+                    arrays["user_factors"].shape != (len(recommender.user_ids), params["factors"]) or \
+                    arrays["item_factors"].shape != (len(recommender.movie_ids), params["factors"]):
+                raise ValueError(f"Factorization hyperparameters of the snapshot do not match its factors: {params}")
+            recommender.factorization = MatrixFactorization(**params)
+            recommender.factorization.user_factors = arrays["user_factors"]
+            recommender.factorization._user_factors_buffer = arrays["user_factors"]
+            recommender.factorization.item_factors = arrays["item_factors"]
+
+        recommender.user_index = None
+        if "user_index_planes" in arrays:
+            recommender.user_index = UserLSHIndex.from_arrays(
+                recommender.user_profiles, recommender.user_profile_norms, arrays["user_index_planes"],
+                arrays["user_index_center"], arrays["user_index_codes"], arrays["user_index_members"],
+                arrays["user_index_sorted_codes"], meta["user_index_probes"])
+        return recommender
+
+    @classmethod
+    def open(cls, movies_csv, ratings_csv, snapshot_dir=SNAPSHOT_DIR) -> 'Recommender':
+        """
+        Load the model from the snapshot directory if it holds a snapshot of the given files, otherwise build it from
+        the files and store the snapshot for the next time.
+        """
+        if cls.is_saved(snapshot_dir, movies_csv, ratings_csv):
+            return cls.load(snapshot_dir)
 
-        self.users: Dict[int, User] = self._read_users(self.ratings_csv_fn)
+        recommender = cls(movies_csv, ratings_csv)
+        recommender.save(snapshot_dir)
+        return recommender
+
+    def _build_movie_genres(self):
+        """
+        Build one sparse (n_movies, n_genres) matrix of movie genres (1 if the movie is of the genre) with precomputed
+        row norms, shared by all content-based computations.
+        """
+        self.movie_ids = numpy.array(sorted(self.movies), dtype=int)
+        self.movie_id_to_idx = {movie_id: i for i, movie_id in enumerate(self.movie_ids)}
+
+        rows, cols = [], []
+        for i, movie_id in enumerate(self.movie_ids):
+            for genre in self.movies[movie_id].genres:
+                rows.append(i)
+                cols.append(self.genre_str_to_id[genre])
+        self.movie_genres = scipy.sparse.csr_matrix((numpy.ones(len(rows)), (rows, cols)),
+                                                    shape=(len(self.movie_ids), len(self.genres_list)))
+        self.movie_genre_norms = numpy.sqrt(numpy.asarray(self.movie_genres.sum(1)).ravel())
+
+    def _build_user_profiles(self):
+        """
+        Build genre ratings of all users as one (n_users, n_genres) matrix with precomputed norms, so similarities
+        of a user to all other users are a single matrix-vector product.
+
+        Genre rating of a user is the number of positively rated (>= RATING_THRESHOLD) movies of the genre, counted
+        for all users at once as a product of the positive ratings and the movie genres.
+        """
+        self.user_profiles, self.user_profile_norms = self._genre_profiles(self.ratings.matrix)
+        # The profiles are views of the first rows of these, see _reserve_rows()
+        self._user_profiles_buffer, self._user_profile_norms_buffer = self.user_profiles, self.user_profile_norms
+
+    def _genre_profiles(self, ratings: scipy.sparse.csr_matrix) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """ Return tuple (genre ratings, their norms) of users with the given rows of ratings. """
+        positive = ratings >= RATING_THRESHOLD
+        genre_counts = (positive.astype(float) @ self.movie_genres).toarray()
+
+        # TODO Not sure about this - normalizing user rating vector to have scores in (0,1).
+        # Reason - Vector (3,1,0) would be closer to (0,1,0) than (3,0,0), but user clearly more prefers the first genre
+        # Users without any positive rating have no profile, they are not similar to anyone
+        max_counts = genre_counts.max(axis=1, keepdims=True) if genre_counts.size else genre_counts[:, :1]
+        profiles = numpy.divide(genre_counts, max_counts, out=numpy.zeros_like(genre_counts), where=max_counts > 0)
+        return profiles, numpy.linalg.norm(profiles, axis=1)
+
+    def add_ratings(self, user_ids: List[int], movie_ids: List[int], ratings: List[float]):
+        """
+        Add new ratings (replacing earlier ratings of the same movie by the same user) and update the model
+        incrementally, in time proportional to the rows of the users who rated:
+        - rows of the users and rating statistics of the movies in the ratings store (see RatingsStore)
+        - genre ratings of the users and their norms
+        - neighbour lists of the movies rated by the users are marked dirty, if the item neighbours were built, and
+          recomputed together by the next refresh_item_neighbours()
+        - factors of the users, solved with the movie factors fixed, if the factorization was trained
+        - hash codes of the users in the user index, if it was built
+        :param user_ids: User ID of every rating, unknown users are added.
+        :param movie_ids: Movie ID of every rating, the movies must be known.
+        :param ratings: Star-rating of every rating.
+        """
+        user_idxs, movie_idxs = self.ratings.add_ratings(numpy.asarray(user_ids, dtype=self.user_ids.dtype),
+                                                         numpy.asarray(movie_ids, dtype=self.movie_ids.dtype),
+                                                         numpy.asarray(ratings, dtype=numpy.float32))
+        self.user_ids = self.ratings.user_ids
+        self.ratings_updated = True
+
+        user_ratings = self.ratings.rows(user_idxs)
+        n_users, n_profiles = len(self.user_ids), len(self.user_profiles)
+        self._user_profiles_buffer = _reserve_rows(self._user_profiles_buffer, n_profiles, n_users)
+        self._user_profile_norms_buffer = _reserve_rows(self._user_profile_norms_buffer, n_profiles, n_users)
+        self.user_profiles = self._user_profiles_buffer[:n_users]
+        self.user_profile_norms = self._user_profile_norms_buffer[:n_users]
+        self.user_profiles[user_idxs], self.user_profile_norms[user_idxs] = self._genre_profiles(user_ratings)
+
+        if self.item_neighbours is not None:
+            # Columns of the rated movies changed, so did their products with the other movies rated by the users
+            self._dirty_item_neighbours.update(user_ratings.indices.tolist())
+
+        if self.factorization is not None:
+            self.factorization.update_users(user_idxs, user_ratings, len(self.user_ids))
+
+        if self.user_index is not None:
+            self.user_index.update(self.user_profiles, self.user_profile_norms, user_idxs)
+
+    def user(self, user_id: int) -> User:
+        """ Return User view with genre ratings and star-ratings of the given user. """
+        return User(user_id, self.user_profiles[self.user_id_to_idx[user_id]], self.ratings.ratings(user_id))
+
+    def build_user_index(self, **kwargs):
+        """
+        Build the approximate nearest neighbour index of user profiles, used by similar_users_batch() (and so by all
+        collaborative recommendations) from now on.
+        :param kwargs: Parameters of UserLSHIndex.
+        """
+        self.user_index = UserLSHIndex(self.user_profiles, self.user_profile_norms, **kwargs)
+
+    def similar_users(self, user_id: int, top_n: int) -> List[Tuple[int, float]]:
+        """
+        Find users most similar to the given one (cosine similarity of their genre ratings).
+        :param user_id: ID of the user
+        :param top_n: Number of users to return.
+        :return: List of (user_id, similarity) tuples sorted in descending order based on similarity.
+        """
+        neighbours, similarities = self.similar_users_batch([user_id], top_n)
+        return [(int(self.user_ids[i]), float(similarity)) for i, similarity in zip(neighbours[0], similarities[0])]
+
+    def similar_users_batch(self, user_ids: List[int], top_n: int,
+                            exact: bool = False) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        Find users most similar to each of the given users, similarities to all users computed in one matrix product,
+        or approximately by the user index if it was built.
+        :param user_ids: IDs of the users
+        :param top_n: Number of similar users to find for every user.
+        :param exact: Compare to all users even if the user index was built.
+        :return: Tuple (indices of the similar users, their similarities), both (len(user_ids), top_n) matrices with
+                 rows sorted in descending order based on similarity.
+        """
+        user_idxs = [self.user_id_to_idx[user_id] for user_id in user_ids]
+        if self.user_index is not None and not exact:
+            return self.user_index.search(self.user_profiles[user_idxs], top_n,
+                                          exclude=numpy.array(user_idxs, dtype=int))
+
+        norms = numpy.outer(self.user_profile_norms[user_idxs], self.user_profile_norms)
+        similarities = numpy.divide(self.user_profiles[user_idxs] @ self.user_profiles.T, norms,
+                                    out=numpy.zeros(norms.shape), where=norms > 0)
+        similarities[numpy.arange(len(user_idxs)), user_idxs] = -numpy.inf  # skip the user itself
+
+        top_n = min(top_n, len(self.user_ids) - 1)
+        neighbours = numpy.array([top_k_indices(user_similarities, top_n)[:top_n]
+                                  for user_similarities in similarities], dtype=int).reshape(len(user_idxs), top_n)
+        return neighbours, numpy.take_along_axis(similarities, neighbours, axis=1)
 
     def print_movies_ratings(self):
         """ Print average ratings for all movies. """
-        score_sums: Dict[int, List[float, int]] = {}
-        for user in self.users.values():
-            for movie_id, rating in user.ratings.items():
-                if movie_id not in score_sums:
-                    score_sums[movie_id] = [0, 0]
+        users_counts, score_sums, _ = self.ratings.column_stats
 
-                score_sums[movie_id][0] += user.ratings[movie_id]
-                score_sums[movie_id][1] += 1
-
-        for movie_id, (score_sum, users_count) in score_sums.items():
-            print(f"{self.movies[movie_id].title:{100}.{50}} ({movie_id:{6}}): {score_sum/users_count:{6}.{4}}")
+        for movie_idx in numpy.flatnonzero(users_counts):
+            movie_id = int(self.movie_ids[movie_idx])
+            print(f"{self.movies[movie_id].title:{100}.{50}} ({movie_id:{6}}): "
+                  f"{score_sums[movie_idx] / users_counts[movie_idx]:{6}.{4}}")
 
     def print_user_genre_ratings(self, user_id):
         """ Print summary of which genre was ranked how many times by the user. """
-        self.users[user_id].print_genre_ratings(self.genre_id_to_str)
+        self.user(user_id).print_genre_ratings(self.genre_id_to_str)
 
     def print_recommended_movies(self, recommended_movies):
         """ Pretty-print list of recommendations. """
@@ -114,24 +980,150 @@ class Recommender:
 
     def recommend_hybrid_based(self, user_id, limit_results: int, content_based_weight: float = 0.3,
                                collab_based_weight: float = 0.7, collab_use_top_n_similar_users: int = 20):
-        content_recommendations = self.recommend_content_based(user_id)
-        collab_recommendations = self.recommend_collaborative_based(
-            user_id,
-            use_top_n_similar_users=collab_use_top_n_similar_users)
-
-        final_recommendations: Dict[int, float] = {mov_id: (score * content_based_weight) for mov_id, score
-                                                   in content_recommendations}
-
-        for mov_id, score in collab_recommendations:
-            if mov_id not in final_recommendations:
-                final_recommendations[mov_id] = 0
-            final_recommendations[mov_id] += score
-
-        sorted_final = sorted(final_recommendations.items(), key=lambda item: item[1], reverse=True)
-        if limit_results > 0:
-            return sorted_final[:limit_results]
-        else:
-            return sorted_final
+        scores, candidates = self.hybrid_scores([user_id], content_based_weight, collab_based_weight,
+                                                collab_use_top_n_similar_users)
+        return self._top_recommendations(scores, candidates, limit_results)[0]
+
+    def hybrid_scores(self, user_ids: List[int], content_based_weight: float = 0.3, collab_based_weight: float = 0.7,
+                      collab_use_top_n_similar_users: int = 20) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        Calculate hybrid scores of all movies for the given users: weighted content-based score plus weighted
+        collaborative score (0 for movies no similar user rated).
+        :return: Tuple (scores, candidates), both (len(user_ids), n_movies) matrices, candidates are True for movies
+                 not rated by the user.
+        """
+        content, collab, candidates = self.hybrid_score_components(user_ids, collab_use_top_n_similar_users)
+        return self.weighted_hybrid_scores(content, collab, content_based_weight, collab_based_weight), candidates
+
+    def hybrid_score_components(self, user_ids: List[int], collab_use_top_n_similar_users: int = 20) -> \
+            Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        """
+        Calculate the parts of hybrid scores that do not depend on the weights, so that scores with different weights
+        (see weighted_hybrid_scores) are computed from them without scoring the users again.
+        :return: Tuple (content-based scores, collaborative scores, candidates), all (len(user_ids), n_movies) matrices
+                 aligned by movie.
+        """
+        collab, _ = self.collaborative_scores(user_ids, collab_use_top_n_similar_users)
+        return self.content_scores(user_ids), collab, ~self.rated_masks(user_ids)
+
+    @staticmethod
+    def weighted_hybrid_scores(content: numpy.ndarray, collab: numpy.ndarray, content_based_weight: float,
+                               collab_based_weight: float) -> numpy.ndarray:
+        """ Return content * content_based_weight + collab * collab_based_weight, with a single temporary array. """
+        scores = numpy.multiply(content, content_based_weight)
+        scores += numpy.multiply(collab, collab_based_weight)
+        return scores
+
+    def recommend_all(self, output_fn, user_ids: List[int] = None, limit_results: int = 50,
+                      content_based_weight: float = 0.3, collab_based_weight: float = 0.7,
+                      collab_use_top_n_similar_users: int = 20, block_size: int = RECOMMEND_ALL_BLOCK_SIZE,
+                      processes: int = None, snapshot_dir=None) -> int:
+        """
+        Precompute hybrid recommendations (see recommend_hybrid_based) for many users and write them to a CSV file
+        of "userId,rank,movieId,score" rows.
+
+        Users are processed in blocks of `block_size`, scores of a whole block are computed by matrix products. Blocks
+        are handed to a process pool whose workers memory-map a snapshot of the model, and the results are written
+        as the blocks are finished, in the order of the users.
+        :param output_fn: Name of the output CSV file.
+        :param user_ids: IDs of the users, all users if None.
+        :param block_size: Number of users scored at once.
+        :param processes: Number of worker processes, recommend in this process if 1.
+        :param snapshot_dir: Directory with a snapshot of this model (see save()), a temporary snapshot is stored if
+                             None and the process pool is used.
+        :return: Number of users written.
+        """
+        user_ids = self.user_ids.tolist() if user_ids is None else list(user_ids)
+        blocks = [user_ids[start:start + block_size] for start in range(0, len(user_ids), block_size)]
+        params = (limit_results, content_based_weight, collab_based_weight, collab_use_top_n_similar_users)
+
+        with open(output_fn, mode="w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["userId", "rank", "movieId", "score"])
+
+            def write_block(block_user_ids, block_recommendations):
+                for user_id, recommendations in zip(block_user_ids, block_recommendations):
+                    writer.writerows((user_id, rank, movie_id, f"{score:.6f}")
+                                     for rank, (movie_id, score) in enumerate(recommendations, start=1))
+
+            tasks = [(block,) + params for block in blocks]
+            for block, block_recommendations in zip(blocks, self.map_blocks(Recommender._recommend_block, tasks,
+                                                                            processes, snapshot_dir)):
+                write_block(block, block_recommendations)
+
+        return len(user_ids)
+
+    def map_blocks(self, function, tasks: List[tuple], processes: int = None, snapshot_dir=None):
+        """
+        Generate function(recommender, *task) for every task, in the order of the tasks.
+
+        Tasks are handed to a process pool whose workers memory-map a snapshot of this model, so the model arrays
+        are shared by all workers instead of being copied to each of them.
+        :param function: Module-level function (or Recommender method) taking the recommender and a task.
+        :param tasks: List of argument tuples.
+        :param processes: Number of worker processes, run in this process if 1.
+        :param snapshot_dir: Directory with a snapshot of this model (see save()), a temporary snapshot is stored if
+                             None and the process pool is used.
+        """
+        if processes == 1:
+            for task in tasks:
+                yield function(self, *task)
+            return
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            if snapshot_dir is None:
+                snapshot_dir = temp_dir
+                self.save(snapshot_dir)
+
+            with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                                     initargs=(snapshot_dir,)) as executor:
+                yield from executor.map(_call_in_worker, [function] * len(tasks), tasks)
+
+    def _recommend_block(self, user_ids: List[int], limit_results: int, content_based_weight: float,
+                         collab_based_weight: float, collab_use_top_n_similar_users: int) -> \
+            List[List[Tuple[int, float]]]:
+        scores, candidates = self.hybrid_scores(user_ids, content_based_weight, collab_based_weight,
+                                                collab_use_top_n_similar_users)
+        return self._top_recommendations(scores, candidates, limit_results)
+
+    def _top_recommendations(self, scores: numpy.ndarray, candidates: numpy.ndarray, limit_results: int) -> \
+            List[List[Tuple[int, float]]]:
+        """
+        Select the best candidate movies of every row of the scores.
+        :return: List of (movie_id, score) tuples sorted in descending order based on score, for every row.
+        """
+        recommendations = []
+        for user_scores, user_candidates in zip(scores, candidates):
+            user_candidates = numpy.flatnonzero(user_candidates)
+            best = user_candidates[top_k_indices(user_scores[user_candidates], limit_results)]
+            recommendations.append([(int(self.movie_ids[i]), float(user_scores[i])) for i in best])
+
+        return recommendations
+
+    def content_scores(self, user_ids: List[int]) -> numpy.ndarray:
+        """
+        Calculate cosine similarity of genre ratings of the given users to genres of all movies, in one sparse product.
+        :param user_ids: IDs of the users
+        :return: Matrix (len(user_ids), n_movies) of similarities, columns ordered as self.movie_ids.
+        """
+        user_idxs = [self.user_id_to_idx[user_id] for user_id in user_ids]
+        profiles = self.user_profiles[user_idxs]
+        norms = numpy.outer(self.user_profile_norms[user_idxs], self.movie_genre_norms)
+        products = (self.movie_genres @ profiles.T).T
+        return numpy.divide(products, norms, out=numpy.zeros(norms.shape), where=norms > 0)
+
+    def rated_mask(self, user_id: int) -> numpy.ndarray:
+        """ Return boolean array over self.movie_ids, True for movies rated by the user. """
+        mask = numpy.zeros(len(self.movie_ids), dtype=bool)
+        mask[self.ratings.user_row(user_id)[0]] = True
+        return mask
+
+    def rated_masks(self, user_ids: List[int]) -> numpy.ndarray:
+        """ Return boolean (len(user_ids), n_movies) matrix, True for movies rated by the user. """
+        user_ratings = self.ratings.rows([self.user_id_to_idx[user_id] for user_id in user_ids])
+        masks = numpy.zeros(user_ratings.shape, dtype=bool)
+        masks[numpy.repeat(numpy.arange(len(user_ids)), numpy.diff(user_ratings.indptr)), user_ratings.indices] = True
+        return masks
 
     def recommend_content_based(self, user_id: int, limit_results: int = -1) -> List[Tuple[int, float]]:
         """
@@ -144,28 +1136,24 @@ class Recommender:
         :param limit_results: Number of top results to return.
         :return: List of (movie_id, similarity) tuples sorted in descending order based on similarity.
         """
-        similarities: Dict[int, float] = {}
-
-        non_rated_movies = [movie for movie in self.movies.values() if movie.id not in self.users[user_id].movies_rated]
-        for movie in non_rated_movies:
-            similarity = cosine_similarity(self.users[user_id].genre_ratings.reshape(1, -1), movie.genres_vector)[0][0]
-            similarities[movie.id] = similarity
+        return self.recommend_content_based_batch([user_id], limit_results)[0]
 
-        # Sort obtained similarities, best first
-        sorted_similarities: List[Tuple[int, float]] = sorted(similarities.items(),
-                                                              key=lambda item: item[1],
-                                                              reverse=True)
-        if limit_results > 0:
-            return sorted_similarities[:limit_results]
-        else:
-            return sorted_similarities
+    def recommend_content_based_batch(self, user_ids: List[int], limit_results: int = -1) -> \
+            List[List[Tuple[int, float]]]:
+        """
+        Recommend top N results with Content-based recommending approach for many users at once.
+        :param user_ids: IDs of the users
+        :param limit_results: Number of top results to return for every user.
+        :return: List of recommendations (see recommend_content_based) for every user.
+        """
+        return self._top_recommendations(self.content_scores(user_ids), ~self.rated_masks(user_ids), limit_results)
 
     def recommend_collaborative_based(self, user_id: int, limit_results: int = -1, use_top_n_similar_users: int = 5) -> \
             List[Tuple[int, float]]:
         """
         Recommend top N results with Collaborative filtering approach.
 
-        - Calculate cosine similarity of the given user's rating vector to all other users.
+        - Calculate cosine similarity of the given user's rating vector to all other users (one matrix-vector product).
         - Select the best N matches
         - Build a new movie rating vector as a weighted mean of all the ratings the other users made.
         - Sort the ratings descendingly, recommend the movies with the highest ranking that the user has not seen yet
@@ -174,55 +1162,274 @@ class Recommender:
         :param use_top_n_similar_users:
         :return:
         """
-        this_user = self.users[user_id]
-
-        similarities: Dict[int, float] = {}
-        for user in self.users.values():
-            if user_id == user.id:
-                continue  # skip this user
+        scores, candidates = self.collaborative_scores([user_id], use_top_n_similar_users)
+        return self._top_recommendations(scores, candidates, limit_results)[0]
 
-            similarity = \
-                cosine_similarity(this_user.genre_ratings.reshape(1, -1), user.genre_ratings.reshape(1, -1))[0][0]
-            similarities[user.id] = similarity
-
-        # Sort obtained similarities, best first
-        sorted_similar_users: List[Tuple[int, float]] = sorted(similarities.items(),
-                                                               key=lambda item: item[1],
-                                                               reverse=True)[:use_top_n_similar_users]
+    def collaborative_scores(self, user_ids: List[int], use_top_n_similar_users: int = 5) -> \
+            Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        Calculate collaborative filtering scores of all movies for the given users, see recommend_collaborative_based.
+
+        Neighbour ratings of all the users are aggregated by two sparse products: (users x neighbours) similarity
+        weights times the (neighbours x movies) ratings of the picked neighbours give the weighted sums, the same with
+        ones instead of similarities and ratings counts the neighbours who rated each movie.
+        :param user_ids: IDs of the users
+        :param use_top_n_similar_users: Number of the most similar users whose ratings are used.
+        :return: Tuple (scores, candidates), both (len(user_ids), n_movies) matrices. Candidates are movies rated by a
+                 similar user and not by the user, scores of other movies are 0.
+        """
+        neighbours, similarities = self.similar_users_batch(user_ids, use_top_n_similar_users)
+        neighbour_idxs, columns = numpy.unique(neighbours.ravel(), return_inverse=True)
+        shape = (len(user_ids), len(neighbour_idxs))
+        indptr = numpy.arange(len(user_ids) + 1) * neighbours.shape[1]
+        weights = scipy.sparse.csr_matrix((similarities.ravel(), columns, indptr), shape=shape)
+        picked = scipy.sparse.csr_matrix((numpy.ones(neighbours.size), columns, indptr), shape=shape)
+        neighbour_ratings = self.ratings.rows(neighbour_idxs)
+        neighbour_rated = scipy.sparse.csr_matrix((numpy.ones(neighbour_ratings.nnz, dtype=numpy.float32),
+                                                   neighbour_ratings.indices, neighbour_ratings.indptr),
+                                                  shape=neighbour_ratings.shape)
 
-        # print("*" * 80)
-        # print("Using similar users:")
-        # pprint(sorted_similar_users)
-        # print("*" * 80)
         # Build a new movie rating from similar users
-        # ranking = (A_ranking * A_weight + B_ranking*B_weight +... ) / len(users)
-        temp_ratings: Dict[int, List[float, int]] = {}  # Dict of {movie_id: (sum_ratings, count_people)}
-        for user, user_similarity in [(self.users[user_id], _user_similarity)
-                                      for user_id, _user_similarity in
-                                      sorted_similar_users]:  # Iterate through User objects and their similarities
-            for movie_id, movie_rating in user.ratings.items():  # Iterate through the Users' ratings
-                if movie_id in this_user.movies_rated:  # Skip movies that the user has already rated
-                    continue
-
-                if movie_id not in temp_ratings:
-                    temp_ratings[movie_id] = [0, 0]
-
-                temp_ratings[movie_id][0] += movie_rating * user_similarity  # Add weighed sum to the total movie rating
-                temp_ratings[movie_id][1] += 1
-
-        # Calculate weighed average from the dictionary constructed above, just divide the values
-        new_ratings: Dict[int, float] = {movie_id: temp_rating[0] / temp_rating[1]
-                                         for movie_id, temp_rating in temp_ratings.items()}
-        sorted_new_ratings: Dict[int, float] = sorted(new_ratings.items(), key=lambda rating: rating[1], reverse=True)
+        # ranking = (A_ranking * A_weight + B_ranking*B_weight +... ) / number of similar users who rated the movie
+        rating_sums = (weights @ neighbour_ratings).toarray()
+        rating_counts = (picked @ neighbour_rated).toarray()
+
+        # Skip movies that the user has already rated
+        candidates = (rating_counts > 0) & ~self.rated_masks(user_ids)
+        scores = numpy.divide(rating_sums, rating_counts, out=numpy.zeros(rating_sums.shape), where=candidates)
 
         # Normalize ratings to be in interval (0,1)
-        max_val = sorted_new_ratings[0][1]
-        normalized_sorted_new_ratings = [(rating[0], (rating[1] / max_val)) for rating in sorted_new_ratings]
+        max_scores = scores.max(axis=1, keepdims=True) if scores.size else scores[:, :1]
+        scores = numpy.divide(scores, max_scores, out=numpy.zeros(scores.shape), where=max_scores > 0)
+        return scores, candidates
 
-        if limit_results > 0:
-            return normalized_sorted_new_ratings[:limit_results]
-        else:
-            return normalized_sorted_new_ratings
+    def build_item_neighbours(self, k: int = ITEM_NEIGHBOURS, block_size: int = ITEM_NEIGHBOURS_BLOCK_SIZE):
+        """
+        Precompute the item-item index used by recommend_item_based: for every movie its k most similar movies (cosine
+        similarity of the movies' rating columns).
+
+        Similarities of a block of movies to all movies are one sparse product, every block is pruned to k neighbours
+        per movie before the next one is computed, so the whole movie x movie matrix is never held in memory.
+        :param k: Number of neighbours kept for every movie.
+        :param block_size: Number of movies whose similarities are computed at once.
+        """
+        if k < 1:
+            raise ValueError(f"Number of item neighbours must be positive: {k}")
+
+        normalized = self._normalized_rating_columns(self.ratings.matrix, self.ratings.column_norms())
+        normalized_t = normalized.T.tocsr()
+
+        blocks = [self._item_neighbour_rows((normalized_t[start:start + block_size] @ normalized).tocsr(),
+                                            numpy.arange(start, min(start + block_size, len(self.movie_ids))), k)
+                  for start in range(0, len(self.movie_ids), block_size)]
+        indices, data = self._neighbour_slots(scipy.sparse.vstack(blocks, format="csr"),
+                                              numpy.arange(len(self.movie_ids)), k)
+        self.item_neighbours = scipy.sparse.csr_matrix(
+            (data.ravel(), indices.ravel(), numpy.arange(len(self.movie_ids) + 1) * k),
+            shape=(len(self.movie_ids), len(self.movie_ids)))
+        self.item_neighbours_k = k
+        self._dirty_item_neighbours = set()
+
+    def refresh_item_neighbours(self, block_size: int = ITEM_NEIGHBOURS_BLOCK_SIZE):
+        """
+        Bring the item neighbours up to date after add_ratings(), for all ratings added since the last refresh at once.
+        The result is the same as of build_item_neighbours().
+
+        Only similarities of pairs with a dirty movie (one rated by the users who rated) changed, so:
+        - lists of the dirty movies are recomputed
+        - lists of other movies holding a dirty movie or that a dirty movie gets into (its similarity reaches the k-th
+          one of the list) are merged with the new similarities to the dirty movies, unless a dirty movie of a full list
+          fell to its k-th similarity: a movie outside the list may take its place, so such lists are recomputed
+        Similarities are computed only over the users who rated the recomputed movies, and the lists are overwritten
+        in place (see _neighbour_slots()), so the whole ratings matrix or neighbour table is never copied. Called by
+        item_based_scores() and save().
+        :param block_size: Number of movies whose similarities are computed at once.
+        """
+        if not self._dirty_item_neighbours:
+            return
+
+        k = self.item_neighbours_k
+        norms = self.ratings.column_norms()
+        dirty = numpy.array(sorted(self._dirty_item_neighbours), dtype=int)
+        dirty_similarities = self._item_similarities(dirty, norms)
+        # (n_movies, len(dirty)) new similarities of all movies to the dirty movies
+        to_dirty = dirty_similarities.T.tocsr()
+
+        # Unused slots hold similarity 0, so the minimum of a list is its k-th similarity (0 if the list is not full)
+        neighbours = self.item_neighbours.indices.reshape(-1, k)
+        similarities = self.item_neighbours.data.reshape(-1, k)
+        kth = similarities.min(axis=1)
+        listed_rows, listed_slots = numpy.nonzero(numpy.isin(neighbours, dirty) & (similarities > 0))
+        listed_similarities = numpy.asarray(to_dirty[listed_rows, numpy.searchsorted(
+            dirty, neighbours[listed_rows, listed_slots])]).ravel()
+        fallen = (listed_similarities < similarities[listed_rows, listed_slots]) & \
+            (listed_similarities <= kth[listed_rows]) & (kth[listed_rows] > 0)
+        entering = dirty_similarities.indices[(dirty_similarities.data > 0) & (
+            dirty_similarities.data >= kth[dirty_similarities.indices])]
+        recomputed = numpy.setdiff1d(listed_rows[fallen], dirty)
+        merged = numpy.setdiff1d(numpy.union1d(listed_rows, entering), numpy.union1d(dirty, recomputed))
+
+        for start in range(0, len(dirty), block_size):
+            block = dirty[start:start + block_size]
+            self._set_neighbour_rows(block, self._item_neighbour_rows(
+                dirty_similarities[start:start + block_size], block, k))
+        for start in range(0, len(recomputed), block_size):
+            block = recomputed[start:start + block_size]
+            self._set_neighbour_rows(block, self._item_neighbour_rows(self._item_similarities(block, norms), block, k))
+        for start in range(0, len(merged), block_size):
+            # Unchanged similarities to movies that are not dirty, and the new ones to the dirty movies
+            block = merged[start:start + block_size]
+            kept = ~numpy.isin(neighbours[block], dirty) & (similarities[block] > 0)
+            new = to_dirty[block].tocoo()
+            rows = numpy.concatenate((numpy.nonzero(kept)[0], new.row))
+            columns = numpy.concatenate((neighbours[block][kept], dirty[new.col]))
+            values = numpy.concatenate((similarities[block][kept], new.data))
+            candidates = scipy.sparse.csr_matrix((values, (rows, columns)), shape=(len(block), len(self.movie_ids)))
+            self._set_neighbour_rows(block, self._item_neighbour_rows(candidates, block, k))
+        self._dirty_item_neighbours = set()
+
+    def _item_similarities(self, movie_idxs: numpy.ndarray, norms: numpy.ndarray) -> scipy.sparse.csr_matrix:
+        """
+        Return (len(movie_idxs), n_movies) CSR matrix of cosine similarities of the given movies to all movies,
+        computed over the users who rated the given movies only (no one else contributes to the products).
+        """
+        matrix = self.ratings.matrix
+        raters = numpy.flatnonzero(numpy.diff(matrix[:, movie_idxs].indptr))
+        normalized = self._normalized_rating_columns(matrix[raters], norms)
+        return (normalized[:, movie_idxs].T.tocsr() @ normalized).tocsr()
+
+    @staticmethod
+    def _normalized_rating_columns(ratings: scipy.sparse.csr_matrix, norms: numpy.ndarray) -> scipy.sparse.csr_matrix:
+        """ Return the rows of ratings with every column (ratings of a movie) scaled by its length in norms. """
+        return ratings.astype(float) @ scipy.sparse.diags(numpy.divide(1, norms, out=numpy.zeros_like(norms),
+                                                                       where=norms > 0))
+
+    @staticmethod
+    def _neighbour_slots(rows: scipy.sparse.csr_matrix, movie_idxs: numpy.ndarray, k: int) -> \
+            Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        Lay out neighbour lists in k slots per movie, so a list can be overwritten in place. Unused slots point to the
+        movie itself with similarity 0, they do not contribute to any product.
+        :param rows: CSR matrix with at most k neighbours in every row.
+        :param movie_idxs: Index of the movie of every row.
+        :return: Tuple (neighbour indices, similarities), both (len(movie_idxs), k) matrices.
+        """
+        counts = numpy.diff(rows.indptr)
+        row_idxs = numpy.repeat(numpy.arange(rows.shape[0]), counts)
+        slots = numpy.arange(rows.nnz) - numpy.repeat(rows.indptr[:-1], counts)
+        indices = numpy.repeat(numpy.asarray(movie_idxs, dtype=numpy.int32)[:, None], k, axis=1)
+        data = numpy.zeros((rows.shape[0], k))
+        indices[row_idxs, slots], data[row_idxs, slots] = rows.indices, rows.data
+        return indices, data
+
+    def _set_neighbour_rows(self, movie_idxs: numpy.ndarray, rows: scipy.sparse.csr_matrix):
+        """ Overwrite neighbour lists of the given movies (arrays memory-mapped from a snapshot are copied once). """
+        k = self.item_neighbours_k
+        if not (self.item_neighbours.indices.flags.writeable and self.item_neighbours.data.flags.writeable):
+            self.item_neighbours = scipy.sparse.csr_matrix(
+                (numpy.array(self.item_neighbours.data), numpy.array(self.item_neighbours.indices),
+                 numpy.array(self.item_neighbours.indptr)), shape=self.item_neighbours.shape)
+        indices, data = self._neighbour_slots(rows, movie_idxs, k)
+        self.item_neighbours.indices.reshape(-1, k)[movie_idxs] = indices
+        self.item_neighbours.data.reshape(-1, k)[movie_idxs] = data
+        self.item_neighbours.has_sorted_indices = False
+
+    @staticmethod
+    def _item_neighbour_rows(block: scipy.sparse.csr_matrix, movie_idxs: numpy.ndarray, k: int) -> \
+            scipy.sparse.csr_matrix:
+        """
+        Compute neighbour lists of the given movies.
+        :param block: (len(movie_idxs), n_movies) CSR matrix of similarities of the movies to all movies.
+        :param movie_idxs: Indices of the movies.
+        :param k: Number of neighbours kept for every movie.
+        :return: (len(movie_idxs), n_movies) CSR matrix with the k largest positive similarities of every movie.
+        """
+        block.sort_indices()
+        counts = numpy.diff(block.indptr)
+        block_rows = numpy.repeat(numpy.arange(block.shape[0]), counts)
+        block.data[block.indices == movie_idxs[block_rows]] = 0  # a movie is not its own neighbour
+
+        # Keep positive similarities above the k-th largest one of the row, and as many of those equal to it as
+        # needed for k neighbours (in the order of movie indices, like top_k_indices)
+        kth_column = min(k, block.shape[1]) - 1
+        kth = -numpy.partition(-block.toarray(), kth_column, axis=1)[:, kth_column][block_rows]
+        above = block.data > kth
+        tied = block.data == kth
+        needed = k - numpy.bincount(block_rows[above], minlength=block.shape[0])
+        tied_before = numpy.cumsum(tied)
+        tied_rank = tied_before - numpy.repeat(numpy.concatenate(([0], tied_before))[block.indptr[:-1]], counts)
+        keep = numpy.flatnonzero((above | (tied & (tied_rank <= needed[block_rows]))) & (block.data > 0))
+        return scipy.sparse.csr_matrix((block.data[keep], (block_rows[keep], block.indices[keep])), shape=block.shape)
+
+    def recommend_item_based(self, user_id: int, limit_results: int = -1) -> List[Tuple[int, float]]:
+        """
+        Recommend top N results with item-based Collaborative filtering approach.
+
+        - Take the precomputed neighbours (most similar movies) of every movie the user rated, see
+          build_item_neighbours(), which is called with default parameters if the index was not built yet
+        - Score every neighbour by the sum of its similarities to the rated movies, weighted by the ratings
+        - Recommend the movies with the highest score that the user has not seen yet
+        :param user_id: ID of the user
+        :param limit_results: Number of top results to return.
+        :return: List of (movie_id, score) tuples sorted in descending order based on score, normalized to (0,1).
+        """
+        scores, candidates = self.item_based_scores([user_id])
+        return self._top_recommendations(scores, candidates, limit_results)[0]
+
+    def item_based_scores(self, user_ids: List[int]) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        Calculate item-based scores of all movies for the given users (see recommend_item_based) as one product of
+        their ratings and the item neighbours.
+        :return: Tuple (scores, candidates), both (len(user_ids), n_movies) matrices. Candidates are neighbours of
+                 movies rated by the user which the user did not rate, scores of other movies are 0.
+        """
+        if self.item_neighbours is None:
+            self.build_item_neighbours()
+        self.refresh_item_neighbours()
+
+        user_ratings = self.ratings.rows([self.user_id_to_idx[user_id] for user_id in user_ids])
+        scores = (user_ratings @ self.item_neighbours).toarray()
+        candidates = (scores > 0) & ~self.rated_masks(user_ids)
+        scores[~candidates] = 0
+
+        # Normalize scores to be in interval (0,1)
+        max_scores = scores.max(axis=1, keepdims=True) if scores.size else scores[:, :1]
+        scores = numpy.divide(scores, max_scores, out=numpy.zeros(scores.shape), where=max_scores > 0)
+        return scores, candidates
+
+    def train_factorization(self, **kwargs):
+        """
+        Train the latent factor model used by recommend_factorization_based on all ratings.
+        :param kwargs: Parameters of MatrixFactorization.
+        """
+        self.factorization = MatrixFactorization(**kwargs).fit(self.ratings.matrix)
+
+    def recommend_factorization_based(self, user_id: int, limit_results: int = -1) -> List[Tuple[int, float]]:
+        """
+        Recommend top N results with the latent factor model (see MatrixFactorization), trained with default
+        parameters if it was not trained yet.
+
+        Predicted preference of a movie is the dot product of the user's and the movie's factors, the movies with the
+        highest preference that the user has not seen yet are recommended.
+        :param user_id: ID of the user
+        :param limit_results: Number of top results to return.
+        :return: List of (movie_id, preference) tuples sorted in descending order based on preference.
+        """
+        scores, candidates = self.factorization_scores([user_id])
+        return self._top_recommendations(scores, candidates, limit_results)[0]
+
+    def factorization_scores(self, user_ids: List[int]) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        Calculate predicted preferences of all movies for the given users as one product of user factors and movie
+        factors.
+        :return: Tuple (scores, candidates), both (len(user_ids), n_movies) matrices, candidates are True for movies
+                 not rated by the user.
+        """
+        if self.factorization is None:
+            self.train_factorization()
+
+        user_factors = self.factorization.user_factors[[self.user_id_to_idx[user_id] for user_id in user_ids]]
+        return user_factors @ self.factorization.item_factors.T, ~self.rated_masks(user_ids)
 
     def _read_movies(self) -> Tuple[Dict[int, Movie], List[str]]:
         """
@@ -251,43 +1458,189 @@ class Recommender:
 
         return movies, sorted(list(genres_set))
 
-    def _read_users(self, ratings_csv_fn) -> Dict[int, User]:
-        users: Dict[int, User] = {}
-
-        with open(ratings_csv_fn, encoding="utf-8") as f:
-            f.readline()
-            f.readline()
-            reader = csv.reader(f, delimiter=',', )
-            for i, rating_row in enumerate(reader):
-                user_id = int(rating_row[0])
-                movie_id = int(rating_row[1])
-                rating = float(rating_row[2])
-                if user_id not in users:
-                    users[user_id] = User(user_id, len(self.genre_str_to_id))
-
-                users[user_id].movies_rated.add(movie_id)
-                users[user_id].ratings[movie_id] = rating
-                for movie_genre in self.movies[movie_id].genres:
-                    if rating >= RATING_THRESHOLD:
-                        users[user_id].genre_ratings[self.genre_str_to_id[movie_genre]] += 1
-
-        # TODO Not sure about this - normalizing user rating vector to have scores in (0,1).
-        # Reason - Vector (3,1,0) would be closer to (0,1,0) than (3,0,0), but user clearly more prefers the first genre
-        for user in users.values():
-            user.genre_ratings = user.genre_ratings / numpy.amax(user.genre_ratings)
-
-        return users
+    def _read_ratings(self, ratings_csv_fn) -> RatingsStore:
+        """
+        Read datafile with ratings.
+        :return: RatingsStore with movies aligned to self.movie_ids.
+        """
+        return RatingsStore.read_csv(ratings_csv_fn, self.movie_ids)
+
+
+_worker_recommender: Recommender = None
+
+
+def _init_worker(snapshot_dir):
+    """ Load the model once per worker process of Recommender.map_blocks(). """
+    global _worker_recommender
+    _worker_recommender = Recommender.load(snapshot_dir)
+
+
+def _call_in_worker(function, task):
+    return function(_worker_recommender, *task)
+
+
+def top_candidates(scores: numpy.ndarray, candidates: numpy.ndarray, k: int) -> numpy.ndarray:
+    """
+    Return (n_rows, k) matrix of column indices of the k best candidates of every row of the scores, best first, -1
+    where a row has fewer than k candidates.
+    """
+    best = numpy.full((len(scores), k), -1, dtype=int)
+    for i, (row_scores, row_candidates) in enumerate(zip(scores, candidates)):
+        row_candidates = numpy.flatnonzero(row_candidates)
+        row_best = row_candidates[top_k_indices(row_scores[row_candidates], k)[:k]]
+        best[i, :len(row_best)] = row_best
+    return best
+
+
+def evaluate_rankings(rankings: numpy.ndarray, relevance: scipy.sparse.csr_matrix, ks: List[int]) -> \
+        Dict[str, numpy.ndarray]:
+    """
+    Calculate measures of all rankings at all cutoffs at once.
+    :param rankings: (n_users, n) matrix of recommended movie indices, best first, -1 for missing recommendations,
+                     n >= max(ks).
+    :param relevance: (n_users, n_movies) boolean matrix, True for movies relevant to the user (rated in testing data).
+    :param ks: Cutoffs (numbers of recommended movies) to evaluate.
+    :return: Dict of {measure: (n_users, len(ks)) matrix} for measures precision, recall, fmeasure, map, ndcg.
+    """
+    ks = numpy.asarray(ks)
+    depth = ks.max()
+    rankings = rankings[:, :depth]
+    recommended = rankings >= 0
+    rows = numpy.repeat(numpy.arange(len(rankings)), rankings.shape[1])
+    hits = numpy.asarray(relevance[rows, numpy.maximum(rankings, 0).ravel()]).reshape(rankings.shape) & recommended
+    hits = hits.astype(float)
+
+    relevant_counts = numpy.asarray(relevance.sum(1), dtype=float)  # column vector
+    positions = numpy.arange(1, depth + 1)
+
+    hits_cumulative = numpy.cumsum(hits, axis=1)
+    # Precision is relative to the number of movies actually recommended, like Evaluator._calc_precision
+    precision = hits_cumulative / numpy.maximum(numpy.cumsum(recommended, axis=1), 1)
+    recall = hits_cumulative / numpy.maximum(relevant_counts, 1)
+    fmeasure = numpy.divide(2 * precision * recall, precision + recall,
+                            out=numpy.zeros_like(precision), where=(precision + recall) > 0)
+
+    # Sum of precisions at the ranks of relevant movies, divided by the number of relevant movies
+    average_precision = numpy.cumsum(precision * hits, axis=1) / numpy.maximum(relevant_counts, 1)
+
+    discounts = 1 / numpy.log2(positions + 1)
+    dcg = numpy.cumsum(hits * discounts, axis=1)
+    idcg = numpy.cumsum((positions <= relevant_counts) * discounts, axis=1)  # all relevant movies first
+    ndcg = numpy.divide(dcg, idcg, out=numpy.zeros_like(dcg), where=idcg > 0)
+
+    columns = ks - 1
+    return {"precision": precision[:, columns], "recall": recall[:, columns], "fmeasure": fmeasure[:, columns],
+            "map": average_precision[:, columns], "ndcg": ndcg[:, columns]}
+
+
+def _evaluate_grid_block(recommender: Recommender, user_ids: List[int], relevance: scipy.sparse.csr_matrix,
+                         grid: List[Tuple[int, Dict]], ks: List[int]) -> List[Dict[str, numpy.ndarray]]:
+    """ Recommend to a block of users with every configuration of the grid and evaluate the recommendations. """
+    results = []
+    hybrid_components = {}  # top_n_users: parts of hybrid scores shared by configurations with different weights
+    for recommend_type, params in grid:
+        if recommend_type == Evaluator.RECOMMEND_SYSTEM_HYBRID:
+            if params['top_n_users'] not in hybrid_components:
+                hybrid_components[params['top_n_users']] = recommender.hybrid_score_components(user_ids,
+                                                                                               params['top_n_users'])
+            content, collab, candidates = hybrid_components[params['top_n_users']]
+            scores = recommender.weighted_hybrid_scores(content, collab, params['weight_content_based'],
+                                                        params['weight_collabr_based'])
+        else:
+            scores, candidates = Evaluator.scores(recommender, user_ids, recommend_type, **params)
+        results.append(evaluate_rankings(top_candidates(scores, candidates, max(ks)), relevance, ks))
+    return results
 
 
 class Evaluator:
     RECOMMEND_SYSTEM_CONTENT_BASED = 1
     RECOMMEND_SYSTEM_COLLABORATIVE_FILTERING = 2
     RECOMMEND_SYSTEM_HYBRID = 3
+    RECOMMEND_SYSTEM_MATRIX_FACTORIZATION = 4
 
-    def __init__(self, training_fn, testing_fn, movies_fn):
+    def __init__(self, training_fn, testing_fn, movies_fn, snapshot_dir=None):
+        """
+        :param snapshot_dir: If set, the recommender is loaded from a snapshot there (see Recommender.open()).
+        """
         super().__init__()
-        self.recommender = Recommender(movies_fn, training_fn)
-        self.testing_users_data = self.recommender._read_users(testing_fn)
+        if snapshot_dir is None:
+            self.recommender = Recommender(movies_fn, training_fn)
+        else:
+            self.recommender = Recommender.open(movies_fn, training_fn, snapshot_dir)
+        self.testing_ratings = self.recommender._read_ratings(testing_fn)
+
+    @staticmethod
+    def scores(recommender: Recommender, user_ids: List[int], recommend_type: int, **kwargs) -> \
+            Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        Calculate scores of all movies for the given users with the given recommendation system.
+        :param kwargs: Parameters of the recommendation system, see evaluate() (except limit_results).
+        :return: Tuple (scores, candidates), both (len(user_ids), n_movies) matrices.
+        """
+        if recommend_type == Evaluator.RECOMMEND_SYSTEM_CONTENT_BASED:
+            return recommender.content_scores(user_ids), ~recommender.rated_masks(user_ids)
+        elif recommend_type == Evaluator.RECOMMEND_SYSTEM_COLLABORATIVE_FILTERING:
+            return recommender.collaborative_scores(user_ids, kwargs['top_n_users'])
+        elif recommend_type == Evaluator.RECOMMEND_SYSTEM_HYBRID:
+            return recommender.hybrid_scores(user_ids, kwargs['weight_content_based'], kwargs['weight_collabr_based'],
+                                             kwargs['top_n_users'])
+        elif recommend_type == Evaluator.RECOMMEND_SYSTEM_MATRIX_FACTORIZATION:
+            return recommender.factorization_scores(user_ids)
+        else:
+            raise ValueError(f"Unknown recommendation system type ID: {recommend_type}")
+
+    def grid_search(self, grid: List[Tuple[int, Dict]], limit_results: List[int], user_ids: List[int] = None,
+                    block_size: int = RECOMMEND_ALL_BLOCK_SIZE, processes: int = None, snapshot_dir=None) -> \
+            List[Grid_Result]:
+        """
+        Evaluate every configuration of the grid on all test users at once.
+
+        Users are split into blocks, every block is scored with all configurations by matrix products and evaluated
+        at all cutoffs, see Recommender.map_blocks() for the process pool.
+        :param grid: List of (recommend_type, params) configurations, params as kwargs of evaluate() without
+                     limit_results.
+        :param limit_results: Cutoffs (numbers of recommended movies) to evaluate.
+        :param user_ids: IDs of the evaluated users, all users with both training and testing ratings if None.
+        :param block_size: Number of users scored at once.
+        :param processes: Number of worker processes, evaluate in this process if 1.
+        :param snapshot_dir: See Recommender.map_blocks().
+        :return: List of results for every configuration and cutoff, measures averaged over the users.
+        """
+        if user_ids is None:
+            user_ids = [user_id for user_id in self.testing_ratings.user_ids.tolist()
+                        if user_id in self.recommender.user_id_to_idx]
+        if self.recommender.factorization is None and \
+                any(recommend_type == Evaluator.RECOMMEND_SYSTEM_MATRIX_FACTORIZATION for recommend_type, _ in grid):
+            self.recommender.train_factorization()  # trained once here, not in every worker
+
+        relevance = self.testing_ratings.matrix[[self.testing_ratings.user_id_to_idx[user_id] for user_id in user_ids]]
+        relevance = relevance.astype(bool)
+        tasks = [(user_ids[start:start + block_size], relevance[start:start + block_size], grid, limit_results)
+                 for start in range(0, len(user_ids), block_size)]
+        block_results = list(self.recommender.map_blocks(_evaluate_grid_block, tasks, processes, snapshot_dir))
+
+        results = []
+        for i, (recommend_type, params) in enumerate(grid):
+            measures = {measure: numpy.concatenate([block[i][measure] for block in block_results]).mean(axis=0)
+                        for measure in block_results[0][i]}
+            for j, k in enumerate(limit_results):
+                results.append(Grid_Result(recommend_type, params, k, len(user_ids),
+                                           **{measure: float(values[j]) for measure, values in measures.items()}))
+        return results
+
+    def print_grid_results(self, results: List[Grid_Result]):
+        """ Print results of grid_search() as a table, best F-measure first. """
+        width = 146
+        print("-" * width)
+        print(f"{'Recommendation system':24} | {'Parameters':64} | {'Limit':5} | {'Precision':9} | {'Recall':7} | "
+              f"{'F-measure':9} | {'MAP':6} | {'nDCG':6}")
+        print("-" * width)
+        for result in sorted(results, key=lambda result: result.fmeasure, reverse=True):
+            name = self._recom_sys_id_to_str(result.recommend_type)
+            params = ", ".join(f"{param}={value}" for param, value in result.params.items())
+            print(f"{name:24} | {params:64.64} | {result.limit_results:5} | {result.precision:9.4f} | "
+                  f"{result.recall:7.4f} | {result.fmeasure:9.4f} | {result.map:6.4f} | {result.ndcg:6.4f}")
+        print("-" * width)
 
     def _recom_sys_id_to_str(self, recommend_type: int) -> str:
         if recommend_type == Evaluator.RECOMMEND_SYSTEM_CONTENT_BASED:
@@ -296,6 +1649,8 @@ class Evaluator:
             return "Collaborative filtering"
         elif recommend_type == Evaluator.RECOMMEND_SYSTEM_HYBRID:
             return "Hybrid"
+        elif recommend_type == Evaluator.RECOMMEND_SYSTEM_MATRIX_FACTORIZATION:
+            return "Matrix factorization"
         else:
             raise ValueError(f"Unknown recommendation system type ID: {recommend_type}")
 
@@ -317,6 +1672,8 @@ class Evaluator:
                             - top_n_users - number of most similar users to take into account
                             - weight_content_based - weight of the content-based recommendations
                             - weight_collabr_based - weight of the collaborative recommendations
+                        - Matrix factorization:
+                            - no params (the model is trained on the first use, see Recommender.train_factorization)
         :return:
         """
         limit_results = kwargs['limit_results']
@@ -332,12 +1689,14 @@ class Evaluator:
             top_n_users = kwargs['top_n_users']
             recommended_movies = self.recommender.recommend_hybrid_based(user_id, limit_results, weight_content_based,
                                                                          weight_collabr_based, top_n_users)
+        elif recommend_type == Evaluator.RECOMMEND_SYSTEM_MATRIX_FACTORIZATION:
+            recommended_movies = self.recommender.recommend_factorization_based(user_id, limit_results)
         else:
             raise ValueError(f"Unknown recommendation system type ID: {recommend_type}")
 
-        testing_user: User = self.testing_users_data[user_id]
-        recall = self._calc_recall([item[0] for item in recommended_movies], testing_user.movies_rated)
-        precision = self._calc_precision([item[0] for item in recommended_movies], testing_user.movies_rated)
+        testing_movies_rated = self.testing_ratings.movies_rated(user_id)
+        recall = self._calc_recall([item[0] for item in recommended_movies], testing_movies_rated)
+        precision = self._calc_precision([item[0] for item in recommended_movies], testing_movies_rated)
         fmeasure = self._calc_fmeasure(precision, recall)
 
         self._print_eval_stats(recommend_type, user_id, precision, recall, fmeasure, **kwargs)
@@ -367,6 +1726,8 @@ class Evaluator:
     Using top similar users: {top_n_users}
     Content-based weight:    {weight_content_based}
     Collaboration weight:    {weight_collabr_based}""")
+        elif recommend_type == Evaluator.RECOMMEND_SYSTEM_MATRIX_FACTORIZATION:
+            pass
         else:
             raise ValueError(f"Unknown recommendation system type ID: {recommend_type}")
 
@@ -415,7 +1776,7 @@ class Evaluator:
 
 
 def run_eval():
-    evaluator = Evaluator('data/ratings-training.csv', 'data/ratings-testing.csv', 'data/movies.csv')
+    evaluator = Evaluator('data/ratings-training.csv', 'data/ratings-testing.csv', 'data/movies.csv', SNAPSHOT_DIR)
 
     user_id = 15
     limit_results = 50
@@ -431,6 +1792,7 @@ def run_eval():
     evaluator.evaluate(user_id, Evaluator.RECOMMEND_SYSTEM_COLLABORATIVE_FILTERING, limit_results=limit_results,
                        top_n_users=top_n_users)
     evaluator.evaluate(user_id, Evaluator.RECOMMEND_SYSTEM_CONTENT_BASED, limit_results=limit_results)
+    evaluator.evaluate(user_id, Evaluator.RECOMMEND_SYSTEM_MATRIX_FACTORIZATION, limit_results=limit_results)
 
     for collab_weight, content_weight in weights:
         evaluator.evaluate(user_id, Evaluator.RECOMMEND_SYSTEM_HYBRID, limit_results=limit_results,
@@ -439,6 +1801,96 @@ def run_eval():
                            weight_content_based=content_weight)
 
 
+def run_recommend_all():
+    recommender = Recommender.open('data/movies.csv', 'data/ratings.csv')
+    recommender.recommend_all('recommendations.csv', limit_results=50, collab_use_top_n_similar_users=20,
+                              snapshot_dir=SNAPSHOT_DIR)
+
+
+def run_grid_search():
+    evaluator = Evaluator('data/ratings-training.csv', 'data/ratings-testing.csv', 'data/movies.csv', SNAPSHOT_DIR)
+
+    limit_results = [10, 20, 50]
+    top_n_users = [5, 20, 50]
+    weights = [
+        (1, 9),
+        (3, 7),
+        (5, 5),
+        (7, 3),
+        (9, 1),
+    ]
+
+    grid = [(Evaluator.RECOMMEND_SYSTEM_CONTENT_BASED, {}),
+            (Evaluator.RECOMMEND_SYSTEM_MATRIX_FACTORIZATION, {})]
+    grid += [(Evaluator.RECOMMEND_SYSTEM_COLLABORATIVE_FILTERING, {'top_n_users': n}) for n in top_n_users]
+    grid += [(Evaluator.RECOMMEND_SYSTEM_HYBRID, {'top_n_users': n, 'weight_collabr_based': collab_weight,
+                                                  'weight_content_based': content_weight})
+             for n in top_n_users for collab_weight, content_weight in weights]
+
+    evaluator.print_grid_results(evaluator.grid_search(grid, limit_results))
+
+
+def run_user_index_benchmark(synthetic_users: int = 1000000, queries: int = 200, top_n_users: int = 20,
+                             limit_results: int = 50, configs=((4, 0), (8, 0), (8, 2), (16, 2), (16, 4))):
+    """
+    Compare exact neighbour search with the user index (UserLSHIndex) for (tables, probes) configurations:
+    - collaborative filtering quality on the test users and recall of their neighbours against the exact search
+    - latency per query and neighbour recall on `synthetic_users` profiles (real profiles with noise), where the exact
+      search has to compare every query to all users
+    """
+    evaluator = Evaluator('data/ratings-training.csv', 'data/ratings-testing.csv', 'data/movies.csv')
+    recommender = evaluator.recommender
+    grid = [(Evaluator.RECOMMEND_SYSTEM_COLLABORATIVE_FILTERING, {'top_n_users': top_n_users})]
+    user_ids = recommender.user_ids.tolist()
+    exact_neighbours, _ = recommender.similar_users_batch(user_ids, top_n_users, exact=True)
+
+    def neighbour_recall(neighbours, exact):
+        return numpy.mean([len(numpy.intersect1d(a, b)) / len(b) for a, b in zip(neighbours, exact)])
+
+    print(f"Collaborative filtering, {top_n_users} similar users, {len(user_ids)} users")
+    for config in (None,) + tuple(configs):
+        recommender.user_index = None if config is None else UserLSHIndex(
+            recommender.user_profiles, recommender.user_profile_norms, tables=config[0], probes=config[1])
+        result = evaluator.grid_search(grid, [limit_results], processes=1)[0]
+        name = 'exact' if config is None else \
+            f"LSH tables={config[0]}, bits={recommender.user_index.bits}, probes={config[1]}"
+        line = f"{name:36} " \
+               f"P@{limit_results} = {result.precision:.4f}  MAP@{limit_results} = {result.map:.4f}"
+        if config is not None:
+            neighbours, _ = recommender.similar_users_batch(user_ids, top_n_users)
+            line += f"  recall vs exact = {neighbour_recall(neighbours, exact_neighbours):.4f}"
+        print(line)
+
+    rng = numpy.random.default_rng(0)
+    profiles = recommender.user_profiles[rng.integers(len(user_ids), size=synthetic_users)]
+    profiles = numpy.clip(profiles + rng.normal(0, 0.1, profiles.shape), 0, 1)
+    norms = numpy.linalg.norm(profiles, axis=1)
+    query_idxs = rng.choice(synthetic_users, size=queries, replace=False)
+
+    print(f"\nNeighbour search, {top_n_users} similar users, {synthetic_users} synthetic users")
+    start = time.perf_counter()
+    exact_neighbours = []
+    for user_idx in query_idxs.tolist():
+        products = norms * norms[user_idx]
+        similarities = numpy.divide(profiles @ profiles[user_idx], products, out=numpy.zeros(synthetic_users),
+                                    where=products > 0)
+        similarities[user_idx] = -numpy.inf
+        exact_neighbours.append(top_k_indices(similarities, top_n_users))
+    print(f"{'exact':36} {1000 * (time.perf_counter() - start) / queries:8.3f} ms/query")
+
+    for config in configs:
+        start = time.perf_counter()
+        index = UserLSHIndex(profiles, norms, tables=config[0], probes=config[1])
+        build_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        neighbours = [index.search(profiles[[user_idx]], top_n_users, exclude=numpy.array([user_idx]))[0][0]
+                      for user_idx in query_idxs.tolist()]
+        name = f"LSH tables={config[0]}, bits={index.bits}, probes={config[1]}"
+        print(f"{name:36} "
+              f"{1000 * (time.perf_counter() - start) / queries:8.3f} ms/query  "
+              f"recall vs exact = {neighbour_recall(neighbours, exact_neighbours):.4f}  build {build_seconds:.2f} s")
+
+
 def main():
     run_eval()
     exit()
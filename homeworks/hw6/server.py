@@ -0,0 +1,392 @@
+import asyncio
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import json
+import math
+import time
+from typing import Dict, List, Tuple
+from urllib.parse import urlsplit, parse_qs
+
+from recommender import Recommender, Evaluator, SNAPSHOT_DIR
+
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8066
+
+BATCH_WAIT = 0.002  # Seconds a request waits for other requests to be scored with
+BATCH_MAX_USERS = 256
+
+CACHE_TTL = 300.0
+CACHE_MAX_ENTRIES = 100000
+CACHE_CANDIDATES = 100  # Number of recommendations computed and cached for a user, longer lists are not cached
+
+MAX_BODY_BYTES = 16 * 1024 * 1024
+
+RECOMMEND_TYPES = {
+    "content": Evaluator.RECOMMEND_SYSTEM_CONTENT_BASED,
+    "collaborative": Evaluator.RECOMMEND_SYSTEM_COLLABORATIVE_FILTERING,
+    "hybrid": Evaluator.RECOMMEND_SYSTEM_HYBRID,
+    "factorization": Evaluator.RECOMMEND_SYSTEM_MATRIX_FACTORIZATION,
+}
+# Parameters of the recommendation systems (see Evaluator.scores()) with their types and default values
+RECOMMEND_PARAMS = {
+    "content": {},
+    "collaborative": {"top_n_users": (int, 20)},
+    "hybrid": {"top_n_users": (int, 20), "weight_content_based": (float, 0.3), "weight_collabr_based": (float, 0.7)},
+    "factorization": {},
+}
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large",
+                500: "Internal Server Error"}
+
+Cache_Stats = namedtuple("Cache_Stats", ["hits", "misses", "expirations", "evictions", "entries"])
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class CandidateCache:
+    """
+    Cache of recommendation lists of users with a time to live.
+
+    Entries are kept in the order they were stored, which is also the order in which they expire, so expired entries
+    are always at the front and are evicted from there on every lookup and store. When there are more than
+    max_entries entries, the oldest ones are evicted as well.
+    """
+
+    def __init__(self, ttl: float = CACHE_TTL, max_entries: int = CACHE_MAX_ENTRIES, clock=time.monotonic):
+        """
+        :param ttl: Seconds an entry is valid for.
+        :param max_entries: Maximal number of entries.
+        :param clock: Function returning the current time in seconds.
+        """
+        super().__init__()
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+
+        self._entries: OrderedDict = OrderedDict()  # key: (expiration time, value)
+
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Return the value stored under the key, None if there is none or it expired. """
+        self._evict_expired()
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        """ Store the value under the key, valid for `ttl` seconds from now. """
+        self._evict_expired()
+        self._entries.pop(key, None)
+        self._entries[key] = (self.clock() + self.ttl, value)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """ Drop all entries (counters are kept). """
+        self._entries.clear()
+
+    def _evict_expired(self):
+        now = self.clock()
+        while self._entries and next(iter(self._entries.values()))[0] <= now:
+            self._entries.popitem(last=False)
+            self.expirations += 1
+
+    def stats(self) -> Cache_Stats:
+        return Cache_Stats(hits=self.hits, misses=self.misses, expirations=self.expirations, evictions=self.evictions,
+                           entries=len(self._entries))
+
+
+class RecommendService:
+    """
+    Recommendations for concurrent requests, from one Recommender loaded for the lifetime of the service.
+
+    Requests for the same recommendation system with the same parameters are scored together, as blocks of up to
+    `batch_max_users` users (one set of matrix products per block, like recommend_all()). A batching loop waits
+    `batch_wait` seconds after the first pending request, takes all pending requests and scores them, and requests
+    arriving meanwhile wait for the next round - so under load the blocks grow instead of queueing up. The top
+    CACHE_CANDIDATES recommendations of every scored user are cached, requests for fewer recommendations are answered
+    from the cache while it is valid.
+
+    All work with the model runs in a single worker thread, so batches and rating updates never run at the same time,
+    while the event loop keeps accepting requests (NumPy releases the GIL in the products). Models that are built on
+    first use are built by prepare() before the service accepts requests, so no batch waits for training.
+    """
+
+    def __init__(self, recommender: Recommender, batch_wait: float = BATCH_WAIT,
+                 batch_max_users: int = BATCH_MAX_USERS, cache: CandidateCache = None):
+        super().__init__()
+        self.recommender = recommender
+        self.batch_wait = batch_wait
+        self.batch_max_users = batch_max_users
+        self.cache = CandidateCache() if cache is None else cache
+
+        self.version = 0  # Incremented by every update of the model, results of older versions are not cached
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending: Dict[Tuple, List[Tuple[int, asyncio.Future]]] = {}  # batch key: [(user_id, future)]
+        self._has_pending: asyncio.Event = None
+        self._batch_task: asyncio.Task = None
+
+        self.requests = 0
+        self.batches = 0
+        self.batched_users = 0
+
+    def prepare(self):
+        """ Build the models used by the recommendation systems of RECOMMEND_TYPES that are not built yet. """
+        if self.recommender.factorization is None:
+            self.recommender.train_factorization()
+
+    async def recommend(self, user_id: int, recommend_type: str, params: Dict, limit_results: int) -> \
+            Tuple[List[Tuple[int, float]], bool]:
+        """
+        Recommend movies to the user.
+        :param recommend_type: Key of RECOMMEND_TYPES.
+        :param params: Parameters of the recommendation system, see RECOMMEND_PARAMS.
+        :param limit_results: Number of recommendations.
+        :return: Tuple (list of (movie_id, score) tuples sorted in descending order based on score, True if the
+                 recommendations came from the cache).
+        :raise KeyError: The user is not known (checked in the worker thread, which also adds the ratings).
+        """
+        self.requests += 1
+
+        key = (user_id, recommend_type, tuple(sorted(params.items())))
+        cacheable = limit_results <= CACHE_CANDIDATES
+        if cacheable:
+            recommendations = self.cache.get(key)
+            if recommendations is not None:
+                return recommendations[:limit_results], True
+
+        version = self.version
+        batch_key = key[1:] + (max(limit_results, CACHE_CANDIDATES),)
+        if self._batch_task is None:
+            self._has_pending = asyncio.Event()
+            self._batch_task = asyncio.ensure_future(self._batch_loop())
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(batch_key, []).append((user_id, future))
+        self._has_pending.set()
+
+        recommendations = await future
+        if cacheable and version == self.version:
+            self.cache.put(key, recommendations)
+        return recommendations[:limit_results], False
+
+    async def add_ratings(self, user_ids: List[int], movie_ids: List[int], ratings: List[float]):
+        """ Add ratings to the model (see Recommender.add_ratings()) and drop all cached recommendations. """
+        await asyncio.get_running_loop().run_in_executor(self._executor, self.recommender.add_ratings, user_ids,
+                                                         movie_ids, ratings)
+        self.version += 1
+        self.cache.clear()
+
+    def stats(self) -> Dict:
+        return {"users": len(self.recommender.user_ids), "requests": self.requests, "batches": self.batches,
+                "batched_users": self.batched_users, "cache": self.cache.stats()._asdict()}
+
+    async def _batch_loop(self):
+        """ Score all pending requests in rounds, for the lifetime of the event loop. """
+        while True:
+            await self._has_pending.wait()
+            await asyncio.sleep(self.batch_wait)  # Let simultaneous requests join the round
+            pending, self._pending = self._pending, {}
+            self._has_pending.clear()
+
+            for batch_key, requests in pending.items():
+                user_ids = list(dict.fromkeys(user_id for user_id, _ in requests))
+                for start in range(0, len(user_ids), self.batch_max_users):
+                    await self._run_batch(batch_key, user_ids[start:start + self.batch_max_users], requests)
+
+    async def _run_batch(self, batch_key: Tuple, user_ids: List[int], requests: List[Tuple[int, asyncio.Future]]):
+        """ Score a block of users and resolve their requests (of the requests of all blocks of the batch key). """
+        recommend_type, params, limit_results = batch_key
+        self.batches += 1
+        self.batched_users += len(user_ids)
+
+        try:
+            recommendations = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._score, user_ids, recommend_type, dict(params), limit_results)
+        except Exception as e:
+            recommendations = [e] * len(user_ids)
+
+        user_recommendations = dict(zip(user_ids, recommendations))
+        for user_id, future in requests:
+            if user_id in user_recommendations and not future.done():
+                if isinstance(user_recommendations[user_id], Exception):
+                    future.set_exception(user_recommendations[user_id])
+                else:
+                    future.set_result(user_recommendations[user_id])
+
+    def _score(self, user_ids: List[int], recommend_type: str, params: Dict, limit_results: int) -> \
+            List[List[Tuple[int, float]]]:
+        """ Recommend to a block of users in the worker thread, unknown users get KeyError instead. """
+        known_user_ids = [user_id for user_id in user_ids if user_id in self.recommender.user_id_to_idx]
+        recommendations = {}
+        if known_user_ids:
+            scores, candidates = Evaluator.scores(self.recommender, known_user_ids, RECOMMEND_TYPES[recommend_type],
+                                                  **params)
+            recommendations = dict(zip(known_user_ids,
+                                       self.recommender._top_recommendations(scores, candidates, limit_results)))
+        return [recommendations[user_id] if user_id in recommendations else KeyError(user_id) for user_id in user_ids]
+
+
+class RecommendServer:
+    """
+    HTTP/JSON interface of a RecommendService (HTTP/1.1 with keep-alive, on asyncio streams):
+    - GET /recommend?user_id=1&type=hybrid&limit=50 (and parameters of the type, see RECOMMEND_PARAMS) returns
+      {"user_id": 1, "recommendations": [[movie_id, score], ...], "cached": false}
+    - POST /ratings with {"ratings": [[user_id, movie_id, rating], ...]} adds the ratings
+    - GET /stats returns counters of the service and its cache
+    - DELETE /cache drops all cached recommendations
+    Errors are returned as {"error": message} with the HTTP status.
+    """
+
+    def __init__(self, service: RecommendService):
+        super().__init__()
+        self.service = service
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode("latin-1").split(" ", 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                body = b""
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY_BYTES:
+                    status, payload = 413, {"error": "Request body too large"}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length)
+                    status, payload = await self.dispatch(method, target, body)
+                    keep_alive = version.strip() == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+
+                data = json.dumps(payload).encode("utf-8")
+                writer.write(f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(data)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n"
+                             f"\r\n".encode("latin-1") + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass  # Client disconnected or sent a malformed request
+        finally:
+            writer.close()
+
+    async def dispatch(self, method: str, target: str, body: bytes) -> Tuple[int, Dict]:
+        """ Handle one request, return tuple (HTTP status, JSON payload). """
+        url = urlsplit(target)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            if url.path == "/recommend":
+                self._expect_method(method, "GET")
+                return 200, await self.recommend(query)
+            elif url.path == "/ratings":
+                self._expect_method(method, "POST")
+                return 200, await self.add_ratings(body)
+            elif url.path == "/stats":
+                self._expect_method(method, "GET")
+                return 200, self.service.stats()
+            elif url.path == "/cache":
+                self._expect_method(method, "DELETE")
+                self.service.cache.clear()
+                return 200, {"cleared": True}
+            raise HTTPError(404, f"Unknown path: {url.path}")
+        except HTTPError as e:
+            return e.status, {"error": str(e)}
+        except Exception as e:
+            return 500, {"error": f"{type(e).__name__}: {e}"}
+
+    @staticmethod
+    def _expect_method(method: str, expected: str):
+        if method != expected:
+            raise HTTPError(405, f"Method {method} not allowed, use {expected}")
+
+    async def recommend(self, query: Dict[str, str]) -> Dict:
+        recommend_type = query.get("type", "hybrid")
+        if recommend_type not in RECOMMEND_TYPES:
+            raise HTTPError(400, f"Unknown recommendation type: {recommend_type}")
+        try:
+            user_id = int(query["user_id"])
+            limit_results = int(query.get("limit", 50))
+            params = {name: param_type(query.get(name, default))
+                      for name, (param_type, default) in RECOMMEND_PARAMS[recommend_type].items()}
+        except KeyError:
+            raise HTTPError(400, "Missing parameter: user_id")
+        except ValueError as e:
+            raise HTTPError(400, f"Invalid parameter: {e}")
+        if limit_results <= 0:
+            raise HTTPError(400, "Parameter limit must be positive")
+        for name, value in params.items():
+            if RECOMMEND_PARAMS[recommend_type][name][0] is int and value <= 0:
+                raise HTTPError(400, f"Parameter {name} must be positive")
+            if not math.isfinite(value) or value < 0:
+                raise HTTPError(400, f"Parameter {name} must be a non-negative number")
+
+        try:
+            recommendations, cached = await self.service.recommend(user_id, recommend_type, params, limit_results)
+        except KeyError:
+            raise HTTPError(404, f"Unknown user: {user_id}")
+        return {"user_id": user_id, "recommendations": recommendations, "cached": cached}
+
+    async def add_ratings(self, body: bytes) -> Dict:
+        try:
+            user_ids, movie_ids, ratings = zip(*json.loads(body)["ratings"])
+            user_ids, movie_ids = [int(user_id) for user_id in user_ids], [int(movie_id) for movie_id in movie_ids]
+            ratings = [float(rating) for rating in ratings]
+        except (ValueError, KeyError, TypeError):
+            raise HTTPError(400, 'Expected {"ratings": [[user_id, movie_id, rating], ...]}')
+
+        try:
+            await self.service.add_ratings(user_ids, movie_ids, ratings)
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+        return {"added": len(ratings)}
+
+
+async def serve(recommender: Recommender, host: str = SERVER_HOST, port: int = SERVER_PORT, **kwargs):
+    """
+    Serve recommendations of the recommender until cancelled. Connections are accepted once the models of all
+    recommendation systems are built (see RecommendService.prepare()).
+    :param kwargs: Parameters of RecommendService.
+    """
+    service = RecommendService(recommender, **kwargs)
+    await asyncio.get_running_loop().run_in_executor(service._executor, service.prepare)
+    server = RecommendServer(service)
+    async with await asyncio.start_server(server.handle_connection, host, port) as tcp_server:
+        print(f"Serving {len(recommender.user_ids)} users on http://{host}:{port}")
+        await tcp_server.serve_forever()
+
+
+def run_server():
+    recommender = Recommender.open('data/movies.csv', 'data/ratings.csv', SNAPSHOT_DIR)
+    if recommender.factorization is None:
+        # Train once and keep the factors in the snapshot, later starts load them
+        recommender.train_factorization()
+        recommender.save(SNAPSHOT_DIR)
+    try:
+        asyncio.run(serve(recommender))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    run_server()
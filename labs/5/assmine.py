@@ -1,52 +1,120 @@
 # Lab #5 - Association Rules Mining
 # Generating rules - only one item on the right side
 
-from collections import Counter
 from pprint import pprint
 import itertools
 
+import numpy
 import pandas as pd
 
 
-def frequent_items(transactions, support):
-    counter = Counter()
-    for trans in transactions:
-        counter.update(frozenset([t]) for t in trans)
-    return set(item for item in counter if counter[item] / len(transactions) >= support), counter
+CHUNK_SIZE = 1 << 16  # Candidates counted at once
 
 
-def generate_candidates(L, k):
-    candidates = set()
-    for a in L:
-        for b in L:
-            union = a | b
-            if len(union) == k and a != b:
-                candidates.add(union)
-    return candidates
+def encode_transactions(transactions):
+    """
+    Give items integer ids (in sorted order) and store the transactions as a packed bit matrix: row i is the bitset of
+    the transactions containing item i, 64 transactions per uint64 word.
+    Returns tuple (list of items, (items x words) uint64 matrix).
+    """
+    items = sorted(set(itertools.chain.from_iterable(transactions)))
+    item_ids = {item: i for i, item in enumerate(items)}
+    pairs = numpy.array([(item_ids[item], t) for t, trans in enumerate(transactions) for item in set(trans)],
+                        dtype=numpy.int64).reshape(-1, 2)
 
+    bits = numpy.zeros((len(items), (len(transactions) + 63) // 64), dtype=numpy.uint64)
+    masks = numpy.left_shift(numpy.uint64(1), (pairs[:, 1] % 64).astype(numpy.uint64))
+    numpy.bitwise_or.at(bits, (pairs[:, 0], pairs[:, 1] // 64), masks)
+    return items, bits
 
-def filter_candidates(transactions, itemsets, support):
-    counter = Counter()
-    for trans in transactions:
-        subsets = [itemset for itemset in itemsets if itemset.issubset(trans)]
-        counter.update(subsets)
-    return set(item for item in counter if counter[item] / len(transactions) >= support), counter
+
+def popcount(bits):
+    """ Number of set bits in every row of the uint64 matrix. """
+    if hasattr(numpy, "bitwise_count"):  # NumPy >= 2.0
+        return numpy.bitwise_count(bits).sum(axis=1, dtype=numpy.int64)
+    return numpy.unpackbits(bits.view(numpy.uint8), axis=1).sum(axis=1, dtype=numpy.int64)
+
+
+def rows_as_keys(itemsets):
+    """ View every row of the itemsets matrix as one opaque value, so that rows can be looked up by numpy.isin. """
+    itemsets = numpy.ascontiguousarray(itemsets)
+    return itemsets.view(numpy.dtype((numpy.void, itemsets.dtype.itemsize * itemsets.shape[1]))).ravel()
+
+
+def join_candidates(itemsets):
+    """
+    Prefix join: every two k-itemsets that share their first k-1 items give a (k+1)-itemset candidate.
+    Itemsets are rows of sorted item ids, rows sorted lexicographically, so itemsets with the same prefix are
+    consecutive and the candidates come out sorted the same way.
+    Returns tuple (left, right) of row indices of the joined pairs, left < right.
+    """
+    m, k = itemsets.shape
+    new_prefix = numpy.ones(m, dtype=bool)
+    new_prefix[1:] = numpy.any(itemsets[1:, :k - 1] != itemsets[:-1, :k - 1], axis=1)
+    group_starts = numpy.flatnonzero(new_prefix)
+    group_ends = numpy.append(group_starts[1:], m)[numpy.cumsum(new_prefix) - 1]
+
+    counts = group_ends - numpy.arange(m) - 1  # Rows after each row in its group
+    left = numpy.repeat(numpy.arange(m), counts)
+    right = left + 1 + numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    return left, right
+
+
+def prune_candidates(candidates, itemsets):
+    """
+    Mask of candidates all of whose k-subsets are frequent k-itemsets. Subsets without one of the last two items are
+    the joined itemsets, only the others are looked up.
+    """
+    keep = numpy.ones(len(candidates), dtype=bool)
+    keys = rows_as_keys(itemsets)
+    for position in range(candidates.shape[1] - 2):
+        keep &= numpy.isin(rows_as_keys(numpy.delete(candidates, position, axis=1)), keys)
+    return keep
 
 
 def apriori(transactions, support):
+    """
+    Find all itemsets with support >= `support` level by level. Items are encoded by encode_transactions(), every
+    frequent itemset keeps the bitset of transactions containing it, so the support of a candidate is a popcount of
+    the AND of the bitsets of the two itemsets it was joined from.
+    Returns tuple (list of frequent itemsets as frozensets, dict of their supports).
+    """
+    items, item_bits = encode_transactions(transactions)
+    n = len(transactions)
+
+    supports = popcount(item_bits) / n
+    frequent = supports >= support
+    itemsets = numpy.flatnonzero(frequent).reshape(-1, 1)
+    bits = item_bits[frequent]
+    level_supports = supports[frequent]
+
     result = list()
-    resultc = Counter()
-    candidates, counter = frequent_items(transactions, support)
-    result += candidates
-    resultc += counter
-    k = 2
-    while candidates:
-        candidates = generate_candidates(candidates, k)
-        candidates, counter = filter_candidates(transactions, candidates, support)
-        result += candidates
-        resultc += counter
-        k += 1
-    resultc = {item: (resultc[item] / len(transactions)) for item in resultc}
+    resultc = dict()
+    while len(itemsets):
+        for itemset, itemset_support in zip(itemsets.tolist(), level_supports.tolist()):
+            itemset = frozenset(items[i] for i in itemset)
+            result.append(itemset)
+            resultc[itemset] = itemset_support
+
+        left, right = join_candidates(itemsets)
+        candidates = numpy.hstack((itemsets[left], itemsets[right, -1:]))
+        keep = prune_candidates(candidates, itemsets)
+        left, right, candidates = left[keep], right[keep], candidates[keep]
+
+        next_bits, next_supports, next_itemsets = [], [], []
+        for start in range(0, len(candidates), CHUNK_SIZE):
+            chunk = slice(start, start + CHUNK_SIZE)
+            chunk_bits = bits[left[chunk]] & bits[right[chunk]]
+            chunk_supports = popcount(chunk_bits) / n
+            frequent = chunk_supports >= support
+            next_bits.append(chunk_bits[frequent])
+            next_supports.append(chunk_supports[frequent])
+            next_itemsets.append(candidates[chunk][frequent])
+
+        itemsets = numpy.concatenate(next_itemsets) if next_itemsets else candidates[:0]
+        bits = numpy.concatenate(next_bits) if next_bits else bits[:0]
+        level_supports = numpy.concatenate(next_supports) if next_supports else level_supports[:0]
+
     return result, resultc
 
 
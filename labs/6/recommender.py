@@ -1,9 +1,19 @@
+from concurrent.futures import ProcessPoolExecutor
 from math import sqrt
+import sys
+import time
 from numpy import genfromtxt
 import numpy
+import scipy.sparse
 from sklearn.metrics.pairwise import cosine_similarity
 import csv
 
+SIMILARITY_BLOCK_SIZE = 256
+
+METRIC_COSINE = "cosine"
+METRIC_PEARSON = "pearson"
+METRIC_ADJUSTED_COSINE = "adjusted_cosine"
+
 
 class UserRating:
     def __init__(self, name, ratings):
@@ -82,6 +92,118 @@ def user_sim_pearson_corr(person1, person2):
     return similarity
 
 
+def ratings_matrix(users):
+    """ Sparse (users x items) matrix of the ratings of UserRating objects, 0 means not rated. """
+    return scipy.sparse.csr_matrix(numpy.vstack([user.ratings for user in users]))
+
+
+def load_movielens(fn):
+    """
+    Load MovieLens ratings (CSV with a header and userId,movieId,rating,timestamp columns).
+    Returns tuple (sorted user ids, sorted movie ids, sparse (users x movies) matrix of ratings).
+    """
+    data = numpy.loadtxt(fn, delimiter=',', skiprows=1, usecols=(0, 1, 2))
+    user_ids, user_idxs = numpy.unique(data[:, 0].astype(int), return_inverse=True)
+    movie_ids, movie_idxs = numpy.unique(data[:, 1].astype(int), return_inverse=True)
+    matrix = scipy.sparse.csr_matrix((data[:, 2], (user_idxs, movie_idxs)), shape=(len(user_ids), len(movie_ids)))
+    return user_ids, movie_ids, matrix
+
+
+def similarity_operands(matrix, metric):
+    """
+    Return (values, squared values, rated mask) sparse matrices the similarities of the rows are computed from.
+
+    For METRIC_ADJUSTED_COSINE every rating is centered by the mean rating of its column - with items as rows (the
+    matrix transposed) these are the usual adjusted cosine item similarities, centered by the means of the users.
+    """
+    matrix = scipy.sparse.csr_matrix(matrix, dtype=float)
+    matrix.eliminate_zeros()
+    mask = matrix.copy()
+    mask.data[:] = 1
+
+    values = matrix.copy()
+    if metric == METRIC_ADJUSTED_COSINE:
+        counts = numpy.bincount(matrix.indices, minlength=matrix.shape[1])
+        sums = numpy.bincount(matrix.indices, weights=matrix.data, minlength=matrix.shape[1])
+        means = numpy.divide(sums, counts, out=numpy.zeros(len(sums)), where=counts > 0)
+        values.data -= means[matrix.indices]  # centered ratings that became 0 are still marked as rated by the mask
+    elif metric not in (METRIC_COSINE, METRIC_PEARSON):
+        raise ValueError(f"Unknown similarity metric: {metric}")
+
+    return values, values.multiply(values).tocsr(), mask
+
+
+def similarity_block(operands, metric, start, end):
+    """
+    Similarities of rows start:end to all rows, computed like user_sim_cosine_sim and user_sim_pearson_corr only from
+    items both rows rated. Every sum over the co-rated items of a pair is an entry of a sparse product: e.g. sum of
+    a_i^2 over items rated by b is (squares @ mask.T)[a, b]. Pairs without co-rated items (or with zero variance) have
+    similarity 0.
+    """
+    values, squares, mask = operands
+    block_values, block_mask = values[start:end], mask[start:end]
+
+    products = (block_values @ values.T).toarray()
+    squares_1 = (squares[start:end] @ mask.T).toarray()
+    squares_2 = (block_mask @ squares.T).toarray()
+
+    if metric == METRIC_PEARSON:
+        # Center by the means over the co-rated items,
+        # sum((a - mean_a) * (b - mean_b)) = sum(a * b) - sum(a) * sum(b) / n, the same for the squares
+        counts = (block_mask @ mask.T).toarray()
+        sums_1 = (block_values @ mask.T).toarray()
+        sums_2 = (block_mask @ values.T).toarray()
+        numpy.divide(sums_1, counts, out=sums_1, where=counts > 0)  # means
+        products -= sums_1 * sums_2
+        squares_1 -= sums_1 * sums_1 * counts
+        numpy.divide(sums_2, counts, out=sums_2, where=counts > 0)
+        squares_2 -= sums_2 * sums_2 * counts
+
+    denominators = numpy.sqrt(numpy.maximum(squares_1, 0) * numpy.maximum(squares_2, 0))
+    similarities = numpy.divide(products, denominators, out=numpy.zeros(products.shape), where=denominators > 1e-9)
+    return numpy.clip(similarities, -1, 1, out=similarities)
+
+
+_worker_operands = None
+
+
+def _init_worker(operands):
+    global _worker_operands
+    _worker_operands = operands
+
+
+def _similarity_block_in_worker(metric, start, end):
+    return similarity_block(_worker_operands, metric, start, end)
+
+
+def pairwise_similarity(matrix, metric=METRIC_COSINE, block_size=SIMILARITY_BLOCK_SIZE, processes=1):
+    """
+    Compute the full (rows x rows) matrix of similarities of rows of the sparse ratings matrix (0 means not rated),
+    block_size rows at a time.
+
+    Args:
+        metric: METRIC_COSINE, METRIC_PEARSON or METRIC_ADJUSTED_COSINE.
+        processes: Number of worker processes the blocks are computed by, computed in this process if 1, number of
+                   CPUs if None.
+    """
+    operands = similarity_operands(matrix, metric)
+    n = operands[0].shape[0]
+    starts = list(range(0, n, block_size))
+
+    similarities = numpy.zeros((n, n))
+    if processes == 1:
+        for start in starts:
+            similarities[start:start + block_size] = similarity_block(operands, metric, start, start + block_size)
+    else:
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(operands,)) as executor:
+            blocks = executor.map(_similarity_block_in_worker, [metric] * len(starts), starts,
+                                  [start + block_size for start in starts])
+            for start, block in zip(starts, blocks):
+                similarities[start:start + block_size] = block
+
+    return similarities
+
+
 # computes similarity between two users based on the pearson similarity metric
 
 def most_similar_users(person, number_of_users, other_users):
@@ -119,6 +241,27 @@ def user_recommendations(person, other_persons, use_k_users=2):
     print(f"Sorted recommendation scores (movie_id, score): {sorted_scores}")
 
 
+def most_similar_users_matrix(similarities, user_index, number_of_users):
+    """ Indices of the users most similar to the given one (by a row of pairwise_similarity()), most similar first. """
+    user_similarities = similarities[user_index].copy()
+    user_similarities[user_index] = -numpy.inf
+    return numpy.argsort(-user_similarities, kind="stable")[:number_of_users]
+
+
+def user_recommendations_matrix(matrix, similarities, user_index, use_k_users=2):
+    """
+    Same as user_recommendations(), on the sparse ratings matrix: every item the user did not rate is scored by the
+    average rating of the most similar users (0 if they did not rate it either).
+    Returns list of (item index, score) tuples sorted by score.
+    """
+    top_similar_users = most_similar_users_matrix(similarities, user_index, use_k_users)
+    missing_items_indices = numpy.flatnonzero(matrix[user_index].toarray().ravel() == 0)
+
+    item_scores = numpy.asarray(matrix[top_similar_users].mean(axis=0)).ravel()[missing_items_indices]
+    order = numpy.argsort(-item_scores, kind="stable")
+    return list(zip(missing_items_indices[order].tolist(), item_scores[order].tolist()))
+
+
 def main():
     data = loadData('small-dataset.csv')
     person1 = data[2]
@@ -127,5 +270,24 @@ def main():
     user_recommendations(person1, other_persons, use_k_users=2)
 
 
+def main_movielens(user_id=1, use_k_users=20, metric=METRIC_PEARSON, processes=None):
+    user_ids, movie_ids, matrix = load_movielens('ml-latest-small/ratings.csv')
+
+    start = time.perf_counter()
+    similarities = pairwise_similarity(matrix, metric, processes=processes)
+    print(f"Similarities ({metric}) of {len(user_ids)} users computed in {time.perf_counter() - start:.2f} s")
+
+    user_index = numpy.searchsorted(user_ids, user_id)
+    similar = most_similar_users_matrix(similarities, user_index, use_k_users)
+    print(f"Most similar users to {user_id}: "
+          f"{list(zip(user_ids[similar].tolist(), similarities[user_index, similar].tolist()))}")
+
+    scores = user_recommendations_matrix(matrix, similarities, user_index, use_k_users)
+    print(f"Top recommendation scores (movie_id, score): {[(int(movie_ids[i]), score) for i, score in scores[:10]]}")
+
+
 if __name__ == '__main__':
-    main()
+    if sys.argv[1:] == ['movielens']:
+        main_movielens()
+    else:
+        main()